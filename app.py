@@ -1,6 +1,7 @@
 import os
 import argparse
-from pftools.PFDicom import PFDicom
+from pftools.PFDicom import PFDicom, TRANSFER_SYNTAXES
+from pftools.PFCache import enableCache, DEFAULT_CACHE_SIZE
 import logging
 
 if __name__ == '__main__':
@@ -14,6 +15,23 @@ if __name__ == '__main__':
     parser.add_argument('-t', '--type', help='Output type: CT, RS, RP, RD or ALL, default to ALL')
     parser.add_argument('-p', '--planid', help='PlanID to work-on')
     parser.add_argument('-s', '--imagesetid', help='CT ImageSet ID to work-on')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of workers for writing CT slices and reading beam doses, default to 1')
+    parser.add_argument('--ct-multiframe', action='store_true',
+                        help='Write each CT ImageSet as one Enhanced CT multi-frame file')
+    parser.add_argument('--transfer-syntax', choices=list(TRANSFER_SYNTAXES), default='explicit',
+                        help='Transfer syntax of CT and RD files: explicit VR little endian, deflated '
+                        'or RLE lossless, default to %(default)s')
+    parser.add_argument('--rd-summation', choices=['PLAN', 'BEAM'], default='PLAN',
+                        help='RD per trial (PLAN) or per beam (BEAM), default to %(default)s')
+    parser.add_argument('--rd-crop', type=float,
+                        help='Crop the RD to the voxels above this fraction of Dmax, e.g. 0.01, off by default')
+    parser.add_argument('--rd-bits', choices=['16', '32', 'auto'], default='32',
+                        help='RD pixel size; auto takes 16 bits if the dose step stays within 1 mGy, default to %(default)s')
+    parser.add_argument('--cache-dir', help='Cache parsed Pinnacle files in this folder, off by default')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // (1024*1024),
+                        help='Maximum cache size in MB, default to %(default)s')
+    parser.add_argument('--cache-clear', action='store_true', help='Empty the cache before running')
     args = parser.parse_args()
 
     dcmdir  = ''
@@ -53,14 +71,23 @@ if __name__ == '__main__':
         exit()
 
 
+    rdbits = None if args.rd_bits == 'auto' else int(args.rd_bits)
+
+    if args.cache_dir:
+        cache = enableCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        if args.cache_clear:
+            cache.clear()
+    elif args.cache_clear:
+        print('--cache-clear needs --cache-dir')
+
     print('Start creating DICOM Files ...')
-    pfDicom = PFDicom(ptdir, dcmdir)
+    pfDicom = PFDicom(ptdir, dcmdir, args.transfer_syntax)
     
     if dcmCT:
         for imgset in pfDicom.Patient.ImageSetList.ImageSet:
             if imgsetid == str(imgset.ImageSetID) or imgsetid == 'ALL':
                 print('Creating DICOM CT for ImageSet_%s ...' % imgset.ImageSetID) 
-                pfDicom.createDicomCT(imgset.ImageSetID)
+                pfDicom.createDicomCT(imgset.ImageSetID, args.jobs, args.ct_multiframe)
                 print('Done for creating ImageSet_%s!\n' % imgset.ImageSetID)
 
     if dcmRS:        
@@ -74,7 +101,7 @@ if __name__ == '__main__':
         for plan in pfDicom.Patient.PlanList.Plan:
             if planid == str(plan.PlanID) or planid == 'ALL':
                 print('Creating DICOM RD for Plan_%s ...' % plan.PlanID)
-                pfDicom.createDicomRD(plan.PlanID)
+                pfDicom.createDicomRD(plan.PlanID, args.jobs, args.rd_summation, args.rd_crop, rdbits)
                 print('Done for creating RD for Plan_%s!\n' % plan.PlanID)
 
     if dcmRP:
@@ -0,0 +1,60 @@
+import os
+import re
+import sys
+import time
+import shutil
+import logging
+import tempfile
+
+prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+sys.path.insert(0, prjpath)
+
+from pftools.PFBackup import PFBackup
+
+PLAN_FILES = ['plan.PatientSetup', 'plan.PlanInfo', 'plan.Points', 'plan.roi', 'plan.Trial']
+
+# The example patients have 2 plans each, so the benchmark runs on a copy of
+# Patient_4604 with Plan_0 repeated as Plan_0 ... Plan_<nplans-1>.
+def makeMultiPlanPatient(workdir, nplans, patient='Patient_4604'):
+    src = prjpath+'examples/'+patient
+    ptpath = os.path.join(workdir, patient)
+    os.makedirs(ptpath)
+    for fname in os.listdir(src):
+        if os.path.isfile(os.path.join(src, fname)):
+            shutil.copy(os.path.join(src, fname), ptpath)
+    for planid in range(nplans):
+        os.makedirs('%s/Plan_%s' % (ptpath, planid))
+        for fname in PLAN_FILES:
+            shutil.copy('%s/Plan_0/%s' % (src, fname), '%s/Plan_%s/' % (ptpath, planid))
+
+    # PlanList with one Plan block per plan, copied from the first one
+    with open(ptpath+'/Patient', 'r', encoding='latin1') as f:
+        text = f.read()
+    plan = re.search(r'\n  Plan =\{\n.*?\n  \};', text, re.S).group(0)
+    plans = ''.join([re.sub(r'PlanID = \d+;', 'PlanID = %s;' % i, plan) for i in range(nplans)])
+    text = re.sub(r'(\nPlanList =\{)(.*?)(\n\};)', lambda m: m.group(1)+plans+m.group(3), text, count=1, flags=re.S)
+    with open(ptpath+'/Patient', 'w', encoding='latin1') as f:
+        f.write(text)
+    return ptpath
+
+def bench(ptpath, workers, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        backup = PFBackup(ptpath)
+        backup.preload(workers=workers)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return (backup.NumberOfPlans, best)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    nplans = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+    print('%s CPUs' % os.cpu_count())
+    with tempfile.TemporaryDirectory() as workdir:
+        ptpath = makeMultiPlanPatient(workdir, nplans)
+        sys.stdout = open(os.devnull, 'w')  # the per plan messages of preload
+        results = [(workers, bench(ptpath, workers)) for workers in [1, 2, 4]]
+        sys.stdout = sys.__stdout__
+        for (workers, (nplans, dt)) in results:
+            print('workers %s: %s plans in %.3f s, x%.1f' % (workers, nplans, dt, results[0][1][1]/dt))
@@ -0,0 +1,44 @@
+import os
+import sys
+import time
+import logging
+
+prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+sys.path.insert(0, prjpath)
+
+from pftools.readPFile import readPFile
+from pftools.PFModel import buildModel
+from pftools.PFPlanTrial import PFPlanTrial
+from pftools.PFPlanMachine import PFMachine
+from pftools.PFPlanROI import PFPlanROI
+from pftools.PFImgInfo import PFImgInfo
+
+# Compare pydantic validation, Model(**pdict), with the trusted construct path
+# of buildModel() on the parser output of the example patients. Parsing is not
+# timed. The two are run in turns, best of repeat.
+FILES = [
+    ('Patient_4604/Plan_0/plan.Trial', 'plan.Trial', PFPlanTrial),
+    ('Patient_6204/Plan_0/plan.Trial', 'plan.Trial', PFPlanTrial),
+    ('Patient_4604/Plan_0/plan.Pinnacle.Machines', 'plan.Machine', PFMachine),
+    ('Patient_4604/Plan_0/plan.roi', 'plan.roi', PFPlanROI),
+    ('Patient_4604/ImageSet_0.ImageInfo', 'ImageSet.ImageInfo', PFImgInfo),
+]
+
+def timeboth(cls, pdict, repeat=20):
+    best = [None, None]
+    for _ in range(repeat):
+        for (i, validate) in enumerate([True, False]):
+            t0 = time.perf_counter()
+            buildModel(cls, pdict, validate)
+            dt = time.perf_counter() - t0
+            best[i] = dt if best[i] is None else min(best[i], dt)
+    return best
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    for (fname, ptype, cls) in FILES:
+        fpath = '%sexamples/%s' % (prjpath, fname)
+        pdict = readPFile(fpath, ptype)
+        (t_valid, t_fast) = timeboth(cls, pdict)
+        print('%-42s validate %7.2f ms  construct %7.2f ms  x%4.1f' % (
+            fname, t_valid*1000, t_fast*1000, t_valid/t_fast))
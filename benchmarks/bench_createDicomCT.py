@@ -0,0 +1,78 @@
+import os
+import re
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import numpy as np
+
+prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+sys.path.insert(0, prjpath)
+
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pftools.PFDicom import PFDicom
+
+# The example patients have no ImageSet_N.img, so the benchmark runs on a copy of
+# Patient_4604 with a synthetic volume of the size given in its header.
+def makeSyntheticPatient(workdir, patient='Patient_4604', imgsetid=0):
+    ptpath = os.path.join(workdir, patient)
+    shutil.copytree(prjpath+'examples/'+patient, ptpath)
+    with open('%s/ImageSet_%s.header' % (ptpath, imgsetid), 'r', encoding='latin1') as f:
+        header = f.read()
+    dims = [int(re.search(r'\b%s = (\d+);' % k, header).group(1)) for k in ['z_dim', 'y_dim', 'x_dim']]
+    data = np.random.default_rng(0).integers(0, 3000, size=dims, dtype=np.int16)
+    data.tofile('%s/ImageSet_%s.img' % (ptpath, imgsetid))
+    return ptpath
+
+# The way slices were built before the template: all modules set per slice.
+def createCTPerSlice(pfDicom):
+    for i in range(pfDicom.ImgSetInfo.NumberOfImages):
+        file_meta = FileMetaDataset()
+        file_meta.TransferSyntaxUID = pfDicom.TransferSyntaxUID
+        file_meta.MediaStorageSOPClassUID    = pfDicom.StorageSOPClassUID
+        file_meta.MediaStorageSOPInstanceUID = pfDicom.StorageSOPInstanceUID[i]
+        ofname = '%s/CT_%s.%s.dcm' % (pfDicom.OutPath, str(i+1).zfill(3), pfDicom.SOPInstanceUID[i])
+        ds = FileDataset(ofname, {}, file_meta=file_meta, preamble=pfDicom.Preamble)
+        pfDicom._setSOPCommon(ds)
+        pfDicom._setPatientModule(ds)
+        pfDicom._setFrameOfReference(ds)
+        pfDicom._setStudyModule(ds)
+        pfDicom._setSeriesModule(ds)
+        pfDicom._setEquipmentModule(ds)
+        pfDicom._setVOILUTModule(ds)
+        pfDicom._setGeneralCTImageModule(ds)
+        pfDicom._setImagePlanePixelModule(ds, i)
+        pfDicom._setInstanceUID(ds, pfDicom.CTSOPInstanceUID[i])
+        pydicom.dataset.validate_file_meta(ds.file_meta, enforce_standard=True)
+        ds.save_as(ofname, write_like_original=False)
+
+def createCTFromTemplate(pfDicom):
+    pfDicom._createCTfromData(pfDicom.ImageSetID)
+
+def createEnhancedCT(pfDicom):
+    pfDicom._createEnhancedCT(pfDicom.ImageSetID)
+
+def bench(ptpath, outpath, func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        pfDicom = PFDicom(ptpath, outpath)
+        pfDicom._initializeForDicom('CT', 0)
+        pfDicom._generateUIDs()
+        t0 = time.perf_counter()
+        func(pfDicom)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return (pfDicom.ImgSetInfo.NumberOfImages, best)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    with tempfile.TemporaryDirectory() as workdir:
+        ptpath = makeSyntheticPatient(workdir)
+        for (name, func) in [('per-slice', createCTPerSlice), ('template', createCTFromTemplate),
+                             ('multiframe', createEnhancedCT)]:
+            sys.stdout = open(os.devnull, 'w')  # the message of _createEnhancedCT
+            (nslices, dt) = bench(ptpath, os.path.join(workdir, name)+'/', func)
+            sys.stdout = sys.__stdout__
+            print('%-10s %4d slices in %.3f s, %6.1f slices/s' % (name, nslices, dt, nslices/dt))
@@ -0,0 +1,41 @@
+import os
+import sys
+import time
+import logging
+import tempfile
+
+prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+sys.path.insert(0, prjpath)
+
+from pftools.PFDicom import PFDicom
+
+# createDicomRD with 1, 2 and 4 workers on the plans of the example patients,
+# one RD per trial (PLAN) and one per beam (BEAM). Each run starts from a new
+# PFDicom, so the beam doses are read from disk.
+PLANS = [('Patient_4604', 0), ('Patient_4604', 1), ('Patient_6204', 0), ('Patient_6204', 1)]
+
+def bench(ptpath, planid, workers, summation='PLAN', repeat=3):
+    best = None
+    with tempfile.TemporaryDirectory() as outpath:
+        for _ in range(repeat):
+            pfDicom = PFDicom(ptpath, outpath+'/')
+            pfDicom._initializeForDicom('RD', planid)
+            t0 = time.perf_counter()
+            pfDicom.createDicomRD(planid, workers, summation)
+            dt = time.perf_counter() - t0
+            best = dt if best is None else min(best, dt)
+    nbeams = sum([len(trial.BeamList.Beam) for trial in pfDicom.PlanTrial.Trial])
+    return (nbeams, best)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    print('%s CPUs' % os.cpu_count())
+    for (patient, planid) in PLANS:
+        for summation in ['PLAN', 'BEAM']:
+            sys.stdout = open(os.devnull, 'w')  # the per beam messages of createDicomRD
+            results = [(workers, bench(prjpath+'examples/'+patient, planid, workers, summation))
+                       for workers in [1, 2, 4]]
+            sys.stdout = sys.__stdout__
+            for (workers, (nbeams, dt)) in results:
+                print('%s Plan_%s %s, workers %s: %2s beams in %.3f s, x%.1f' % (
+                    patient, planid, summation, workers, nbeams, dt, results[0][1][1]/dt))
@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+import logging
+
+prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+sys.path.insert(0, prjpath)
+
+import pftools.readPFile as rp
+from pftools.readPFile import readPFile
+
+# readPFile on plan.roi and plan.Trial with the numeric block pre-pass, and with
+# every block left to the parser (the text and float() path).
+FILES = [
+    ('Plan_0/plan.roi', 'plan.roi'),
+    ('Plan_1/plan.roi', 'plan.roi'),
+    ('Plan_0/plan.Trial', 'plan.Trial'),
+    ('Plan_1/plan.Trial', 'plan.Trial'),
+]
+
+# best of repeat runs; the two readers take turns so both see the same load
+def timepair(func1, func2, *args, repeat=50):
+    best = [None, None]
+    for _ in range(repeat):
+        for (i, func) in enumerate([func1, func2]):
+            t0 = time.perf_counter()
+            func(*args)
+            dt = time.perf_counter() - t0
+            best[i] = dt if best[i] is None else min(best[i], dt)
+    return best
+
+def readPFileNoBlocks(fname, ptype):
+    saved = rp._NUMERIC_BLOCKS
+    rp._NUMERIC_BLOCKS = {}
+    try:
+        return readPFile(fname, ptype)
+    finally:
+        rp._NUMERIC_BLOCKS = saved
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    tot = {'plan.roi': [0.0, 0.0], 'plan.Trial': [0.0, 0.0]}
+    for patient in ['Patient_4604', 'Patient_6204']:
+        for (fname, ptype) in FILES:
+            fpath = '%sexamples/%s/%s' % (prjpath, patient, fname)
+            if not os.path.isfile(fpath):
+                continue
+            (t_text, t_blocks) = timepair(readPFileNoBlocks, readPFile, fpath, ptype)
+            tot[ptype][0] += t_text
+            tot[ptype][1] += t_blocks
+            print('%-12s %-18s %8d B  text %6.1f ms  blocks %6.1f ms  x%4.2f' % (
+                patient, fname, os.path.getsize(fpath),
+                t_text*1000, t_blocks*1000, t_text/t_blocks))
+    for (ptype, (t_text, t_blocks)) in tot.items():
+        print('%-10s total text %.1f ms, blocks %.1f ms, speedup x%.2f' % (ptype, t_text*1000, t_blocks*1000, t_text/t_blocks))
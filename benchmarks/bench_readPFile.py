@@ -0,0 +1,51 @@
+import os
+import sys
+import time
+import logging
+import yaml
+
+prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+sys.path.insert(0, prjpath)
+
+from pftools.readPFile import readPFile
+
+# Compare the native parser with the old YAML round-trip (text rewrite + BaseLoader)
+# on the bundled example patients.
+FILES = [
+    ('Patient', 'Patient'),
+    ('ImageSet_0.ImageInfo', 'ImageSet.ImageInfo'),
+    ('Plan_0/plan.Points', 'plan.Points'),
+    ('Plan_0/plan.roi', 'plan.roi'),
+    ('Plan_0/plan.Trial', 'plan.Trial'),
+    ('Plan_1/plan.Trial', 'plan.Trial'),
+    ('Plan_0/plan.Pinnacle.Machines', 'plan.Machine'),
+]
+
+def readPFileYaml(fname, ptype):
+    return yaml.load(readPFile(fname, ptype, 'yaml'), Loader=yaml.BaseLoader)
+
+def timeit(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    tot_yaml = tot_native = 0.0
+    for patient in ['Patient_4604', 'Patient_6204']:
+        for (fname, ptype) in FILES:
+            fpath = '%sexamples/%s/%s' % (prjpath, patient, fname)
+            if not os.path.isfile(fpath):
+                continue
+            t_yaml = timeit(readPFileYaml, fpath, ptype)
+            t_native = timeit(readPFile, fpath, ptype)
+            tot_yaml += t_yaml
+            tot_native += t_native
+            print('%-12s %-30s %8d B  yaml %7.1f ms  native %6.1f ms  x%5.1f' % (
+                patient, fname, os.path.getsize(fpath),
+                t_yaml*1000, t_native*1000, t_yaml/t_native))
+    print('total yaml %.3f s, native %.3f s, speedup x%.1f' % (tot_yaml, tot_native, tot_yaml/tot_native))
@@ -0,0 +1,64 @@
+import os
+import re
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import numpy as np
+
+prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+sys.path.insert(0, prjpath)
+
+from pftools.PFDicom import PFDicom, TRANSFER_SYNTAXES
+
+# Size and speed of CT and RD output per transfer syntax on Patient_4604. The
+# example has no ImageSet_0.img, so the CT is a phantom of the header size: air
+# around an elliptic body of water with some noise and a denser core, which
+# compresses about like a real scan. Random pixels would not compress at all.
+def makePhantomPatient(workdir, patient='Patient_4604', imgsetid=0):
+    ptpath = os.path.join(workdir, patient)
+    shutil.copytree(prjpath+'examples/'+patient, ptpath)
+    with open('%s/ImageSet_%s.header' % (ptpath, imgsetid), 'r', encoding='latin1') as f:
+        header = f.read()
+    (nz, ny, nx) = [int(re.search(r'\b%s = (\d+);' % k, header).group(1)) for k in ['z_dim', 'y_dim', 'x_dim']]
+    (y, x) = np.mgrid[0:ny, 0:nx]
+    r = ((x - nx/2) / (0.4*nx))**2 + ((y - ny/2) / (0.3*ny))**2
+    body = np.where(r < 1, 1000, 0) + np.where(r < 0.1, 300, 0)
+    noise = np.random.default_rng(0).integers(-15, 16, size=(nz, ny, nx))
+    data = (body + np.where(r < 1, noise, 0)).astype(np.int16)
+    data.tofile('%s/ImageSet_%s.img' % (ptpath, imgsetid))
+    return ptpath
+
+def getSize(outpath, prefix):
+    return sum(os.path.getsize(os.path.join(outpath, f)) for f in os.listdir(outpath) if f.startswith(prefix))
+
+def bench(ptpath, outpath, syntax, modality):
+    pfDicom = PFDicom(ptpath, outpath, syntax)
+    t0 = time.perf_counter()
+    if modality == 'CT':
+        pfDicom.createDicomCT(0)
+        nbytes = pfDicom.ImageSlices.NumberOfSlices * pfDicom.ImageSlices.getSlice(0).nbytes
+    else:
+        nbytes = 0
+        for planid in pfDicom.PlanIDs:
+            pfDicom.createDicomRD(planid)
+            nbytes += sum([4 * trial.DoseGridDimensionX * trial.DoseGridDimensionY * trial.DoseGridDimensionZ
+                           for trial in pfDicom.PlanTrial.Trial])
+    dt = time.perf_counter() - t0
+    return (getSize(outpath, modality+'_'), nbytes, dt)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    with tempfile.TemporaryDirectory() as workdir:
+        ptpath = makePhantomPatient(workdir)
+        for modality in ['CT', 'RD']:
+            sizes = {}
+            for syntax in TRANSFER_SYNTAXES:
+                outpath = os.path.join(workdir, modality+'_'+syntax)+'/'
+                sys.stdout = open(os.devnull, 'w')  # the messages of createDicomRD
+                (size, nbytes, dt) = bench(ptpath, outpath, syntax, modality)
+                sys.stdout = sys.__stdout__
+                sizes[syntax] = size
+                print('%s %-8s %8.2f MB, ratio %5.2f, %6.3f s, %6.1f MB/s of pixels' % (
+                    modality, syntax, size/1e6, sizes['explicit']/size, dt, nbytes/1e6/dt))
@@ -1,11 +1,26 @@
+'''
+PFBackup
+
+All the files of one patient in a Pinnacle backup. Only the Patient file is
+read when the backup is opened; the files of an image set or a plan are read
+on first access to the attribute that holds them, and kept. preload() reads
+them all.
+
+preload(workers=N) parses the files in N processes. The parsed dicts come back
+to this process, which builds the models in the order of the files, so the
+result is the same as a serial load. A file that fails does not stop the
+others; the errors of all files are raised together as PFBackupError.
+'''
+
 import os
-from tests.test_pfread import PlanInfo, PlanPoints
 from typing import (Optional, List)
 import sys
 from datetime import datetime
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
 from pftools.readPFile import readPFile
+from pftools.PFModel import buildModel
 from pftools.PFImgInfo import PFImgInfo
 from pftools.PFImgSetHeader import PFImgSetHeader
 from pftools.PFPatient import PFPatient
@@ -15,95 +30,135 @@ from pftools.PFPlanPoints import PFPlanPoints
 from pftools.PFPlanROI import PFPlanROI
 from pftools.PFPlanTrial import PFPlanTrial
 
-class _ImageSet():
-    def __init__(self) -> None:
-        self.Header: Optional[PFImgSetHeader] = None
-        self.ImageInfoList: Optional[PFImgInfo] = None
-        self.ImageSetID: Optional[int] = 0
-
-class _PPlan():
-    def __init__(self) -> None:        
-        self.PlanPatientSetup: Optional[PFPlanPatientSetup] = None
-        self.PlanInfo: Optional[PFPlanInfo] = None
-        self.PlanPoints: Optional[PFPlanPoints] = None
-        self.PlanROI: Optional[PFPlanROI] = None
-        self.PlanTrial: Optional[PFPlanTrial] = None
-        self.PlanID: Optional[int] = 0
+class PFBackupError(Exception):
+    def __init__(self, errors) -> None:
+        self.errors = errors  # file name: exception
+        super().__init__('Failed to read %s file(s): %s' % (len(errors), ', '.join(errors)))
+
+# files read on first use, each at most once
+class _LazyFiles():
+    # attribute: (file name with %s for the id, ptype, model)
+    FILES = {}
+
+    def __init__(self, ptpath, id) -> None:
+        self.PTPath = ptpath
+        self._id = id
+        self._loaded = {}
+
+    def getFileName(self, attr):
+        return '%s/%s' % (self.PTPath, self.FILES[attr][0] % self._id)
+
+    def _build(self, attr, pdict):
+        model = self.FILES[attr][2]
+        self._loaded[attr] = None if pdict is None else buildModel(model, pdict)
+
+    def _load(self, attr):
+        if attr not in self._loaded:
+            fname = self.getFileName(attr)
+            logging.info('Reading file: %s' % fname)
+            self._build(attr, readPFile(fname, self.FILES[attr][1], 'dict'))
+        return self._loaded[attr]
+
+def _lazyFile(attr):
+    return property(lambda self: self._load(attr))
+
+class _ImageSet(_LazyFiles):
+    FILES = {
+        'Header': ('ImageSet_%s.header', 'ImageSet.header', PFImgSetHeader),
+        # info for all slices
+        'ImageInfoList': ('ImageSet_%s.ImageInfo', 'ImageSet.ImageInfo', PFImgInfo),
+    }
+    Header = _lazyFile('Header')
+    ImageInfoList = _lazyFile('ImageInfoList')
+
+    def __init__(self, ptpath, imgsetid=0) -> None:
+        super().__init__(ptpath, imgsetid)
+        self.ImageSetID: Optional[int] = imgsetid
+
+    def __str__(self) -> str:
+        return 'ImageSet_%s' % self.ImageSetID
+
+class _PPlan(_LazyFiles):
+    FILES = {
+        'PlanPatientSetup': ('Plan_%s/plan.PatientSetup', 'plan.PatientSetup', PFPlanPatientSetup),
+        'PlanInfo': ('Plan_%s/plan.PlanInfo', 'plan.PlanInfo', PFPlanInfo),
+        'PlanPoints': ('Plan_%s/plan.Points', 'plan.Points', PFPlanPoints),
+        'PlanROI': ('Plan_%s/plan.roi', 'plan.roi', PFPlanROI),
+        'PlanTrial': ('Plan_%s/plan.Trial', 'plan.Trial', PFPlanTrial),
+    }
+    PlanPatientSetup = _lazyFile('PlanPatientSetup')
+    PlanInfo = _lazyFile('PlanInfo')
+    PlanPoints = _lazyFile('PlanPoints')
+    PlanROI = _lazyFile('PlanROI')
+    PlanTrial = _lazyFile('PlanTrial')
+
+    def __init__(self, ptpath, planid=0) -> None:
+        super().__init__(ptpath, planid)
+        self.PlanID: Optional[int] = planid
+
+    def __str__(self) -> str:
+        return 'Plan_%s' % self.PlanID
 
 class PFBackup():
     def __init__(self, ptpath) -> None:
         fname = '%s/Patient' % ptpath
         logging.info('Reading file: %s' % fname)
         pfdict = readPFile(fname, 'Patient', 'dict')
-        self.Patient = PFPatient(**pfdict)
+        self.Patient = buildModel(PFPatient, pfdict)
 
         self.NumberOfImageSets = len(self.Patient.ImageSetList.ImageSet)
         self.NumberOfPlans = len(self.Patient.PlanList.Plan)
 
-        imgsetID = []
-        for iset in self.Patient.ImageSetList.ImageSet:
-            imgsetID.append(iset.ImageSetID)
-        planID = []
-        for plan in self.Patient.PlanList.Plan:
-            planID.append(plan.PlanID)
-
+        # nothing below is read until it is used
         self.ImageSet: List[_ImageSet] = []
-        for id in imgsetID:
-            imgset = _ImageSet()
-            imgset.ImageSetID = id
-
-            # obtain header
-            fname = '%s/ImageSet_%s.header' % (ptpath, id)
-            logging.info('Reading file: %s' % fname)
-            pfdict = readPFile(fname, 'ImageSet.header', 'dict')
-            imgset.Header = PFImgSetHeader(**pfdict)
-
-            # obtain info for all slices
-            fname = '%s/ImageSet_%s.ImageInfo' % (ptpath, id)
-            logging.info('Reading file: %s' % fname)
-            pfdict = readPFile(fname, 'ImageSet.ImageInfo', 'dict')
-            imgset.ImageInfoList = PFImgInfo(**pfdict)
-
-            self.ImageSet.append(imgset)
-            print('Reading ImageSet_%s done.'%id)
+        for iset in self.Patient.ImageSetList.ImageSet:
+            self.ImageSet.append(_ImageSet(ptpath, iset.ImageSetID))
 
         self.Plan: List[_PPlan] = []
-        for id in planID:
-            pplan = _PPlan()
-            pplan.PlanID = id
-
-            # PlanPatientSetup
-            fname = '%s/Plan_%s/plan.PatientSetup' % (ptpath, id)
-            logging.info('Reading file: %s' % fname)
-            pfdict = readPFile(fname, 'plan.PatientSetup', 'dict')
-            pplan.PlanPatientSetup = PFPlanPatientSetup(**pfdict)
-
-            # PlanInfo
-            fname = '%s/Plan_%s/plan.PlanInfo' % (ptpath, id)
-            logging.info('Reading file: %s' % fname)
-            pfdict = readPFile(fname, 'plan.PlanInfo', 'dict')
-            pplan.PlanInfo = PFPlanInfo(**pfdict)
-
-            # PlanPoints
-            fname = '%s/Plan_%s/plan.Points' % (ptpath, id)
-            logging.info('Reading file: %s' % fname)
-            pfdict = readPFile(fname, 'plan.Points', 'dict')
-            pplan.PlanPoints = PFPlanPoints(**pfdict)
-
-            # PlanROI
-            fname = '%s/Plan_%s/plan.roi' % (ptpath, id)
-            logging.info('Reading file: %s' % fname)
-            pfdict = readPFile(fname, 'plan.roi', 'dict')
-            pplan.PlanROI = PFPlanROI(**pfdict)
-
-            # PlanTrial
-            fname = '%s/Plan_%s/plan.Trial' % (ptpath, id)
-            logging.info('Reading file: %s' % fname)
-            pfdict = readPFile(fname, 'plan.Trial', 'dict')
-            pplan.PlanTrial = PFPlanTrial(**pfdict)
-
-            self.Plan.append(pplan)
-            print('Reading Plan_%s done.'%id)
+        for plan in self.Patient.PlanList.Plan:
+            self.Plan.append(_PPlan(ptpath, plan.PlanID))
+
+    # read all image sets and plans now, in worker processes if more than one
+    def preload(self, workers=1):
+        items = self.ImageSet + self.Plan
+        jobs = [(item, attr) for item in items for attr in item.FILES if attr not in item._loaded]
+        errors = {}
+        if workers is None or workers <= 1:
+            for (item, attr) in jobs:
+                try:
+                    item._load(attr)
+                except Exception as e:
+                    errors[item.getFileName(attr)] = e
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                # the big files first, so they do not end up last in a worker
+                order = sorted(jobs, key=lambda job: -_getFileSize(job[0].getFileName(job[1])))
+                futures = {}
+                for (item, attr) in order:
+                    fname = item.getFileName(attr)
+                    logging.info('Reading file: %s' % fname)
+                    futures[fname] = pool.submit(readPFile, fname, item.FILES[attr][1], 'dict')
+                # models are built in file order, whatever order the workers finish in
+                for (item, attr) in jobs:
+                    fname = item.getFileName(attr)
+                    try:
+                        item._build(attr, futures[fname].result())
+                    except Exception as e:
+                        errors[fname] = e
+
+        for item in items:
+            if all([item.getFileName(attr) not in errors for attr in item.FILES]):
+                print('Reading %s done.' % item)
+        for (fname, e) in errors.items():
+            logging.error('Failed to read %s: %s' % (fname, e))
+        if len(errors) > 0:
+            raise PFBackupError(errors)
+
+def _getFileSize(fname):
+    try:
+        return os.path.getsize(fname)
+    except OSError:
+        return 0
 
 
 if __name__ == '__main__':
@@ -120,7 +175,7 @@ if __name__ == '__main__':
     print(pfBackup.ImageSet[0].Header.z_dim)
     print(pfBackup.ImageSet[0].ImageSetID)
     print(pfBackup.ImageSet[0].ImageInfoList.ImageInfo[0].SliceNumber)
-    print(pfBackup.Plan[0].PlanTrial.Trial.Name)
+    print(pfBackup.Plan[0].PlanTrial.Trial[0].Name)
     print(pfBackup.Plan[0].PlanID)
-    print(pfBackup.Plan[1].PlanTrial.Trial.Name)
+    print(pfBackup.Plan[1].PlanTrial.Trial[0].Name)
     print(pfBackup.Plan[1].PlanID)    
\ No newline at end of file
@@ -0,0 +1,246 @@
+'''
+PFCache
+
+Opt-in on-disk cache for readPFile results.
+
+Each entry holds the post-processed dict of one Pinnacle file. Entries are keyed
+by the file path, size, mtime and content hash, together with the ptype and the
+parser version, so any change to the file or to the parser misses the cache.
+
+Entries are written with pickle protocol 5. Numpy arrays (roi points) and lists
+of floats (MLC leaf positions, curve painter points) are stored out of band as
+raw buffers; the lists are turned back into lists on load, so a cached dict
+holds the same values as a freshly parsed one. The arrays are loaded into
+writable memory. readPFile does not store the curve points of plan.roi, which
+are views into the roi points, and makes the views again after loading.
+
+The cache is bounded in size. When it grows over the limit, the least recently
+used entries are removed first (every hit touches the entry's mtime).
+'''
+
+import os
+import sys
+import time
+import struct
+import pickle
+import hashlib
+import tempfile
+import logging
+import numpy as np
+
+CACHE_SUFFIX = '.pfc'
+CACHE_MAGIC = b'PFC1'
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+# float lists shorter than this are kept in the pickle stream
+_MIN_OOB_POINTS = 8
+
+class _Points:
+    # stand-in for a list of floats, pickled as an out-of-band buffer
+    __slots__ = ('arr',)
+    def __init__(self, arr):
+        self.arr = arr
+    def __reduce_ex__(self, protocol):
+        return (_Points, (pickle.PickleBuffer(self.arr),))
+
+def _packPoints(obj):
+    if isinstance(obj, dict):
+        return {k: _packPoints(v) for (k, v) in obj.items()}
+    if isinstance(obj, list):
+        if len(obj) >= _MIN_OOB_POINTS and all(type(v) is float for v in obj):
+            return _Points(np.array(obj, dtype=np.float64))
+        return [_packPoints(v) for v in obj]
+    return obj
+
+def _unpackPoints(obj):
+    if isinstance(obj, dict):
+        for (k, v) in obj.items():
+            obj[k] = _unpackPoints(v)
+        return obj
+    if isinstance(obj, list):
+        for i in range(len(obj)):
+            obj[i] = _unpackPoints(obj[i])
+        return obj
+    if isinstance(obj, _Points):
+        return np.frombuffer(obj.arr, dtype=np.float64).tolist()
+    return obj
+
+def _fileDigest(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class PFParseCache:
+    def __init__(self, cachedir, maxsize=DEFAULT_CACHE_SIZE, version=''):
+        self.cachedir = cachedir
+        self.maxsize = int(maxsize)
+        self.version = str(version)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cachedir, exist_ok=True)
+
+    # data is the content of the file when it has been read already
+    def getKey(self, filename, ptype, data=None):
+        st = os.stat(filename)
+        digest = _fileDigest(filename) if data is None else hashlib.sha1(data).hexdigest()
+        ident = '\0'.join([os.path.abspath(filename), str(st.st_size), str(st.st_mtime_ns),
+                           digest, ptype, self.version])
+        return hashlib.sha1(ident.encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def _entryName(self, key):
+        return os.path.join(self.cachedir, key + CACHE_SUFFIX)
+
+    # key as from getKey(); made here if not given
+    def load(self, filename, ptype, key=None):
+        try:
+            entry = self._entryName(key if key is not None else self.getKey(filename, ptype))
+            # the arrays are built on this buffer, so it is writable
+            with open(entry, 'rb') as f:
+                data = bytearray(os.fstat(f.fileno()).st_size)
+                if f.readinto(data) != len(data):
+                    raise OSError('short read of %s' % entry)
+        except OSError:
+            self.misses += 1
+            return None
+
+        try:
+            obj = self._decode(data)
+        except Exception as e:
+            logging.warning('Broken cache entry %s removed: %s' % (entry, e))
+            self._remove(entry)
+            self.misses += 1
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        self.hits += 1
+        logging.info('%s (%s) loaded from cache' % (filename, ptype))
+        return obj
+
+    def store(self, filename, ptype, obj, key=None):
+        try:
+            entry = self._entryName(key if key is not None else self.getKey(filename, ptype))
+        except OSError:
+            return
+        data = self._encode(obj)
+        tmpname = '%s.%s.tmp' % (entry, os.getpid())
+        try:
+            with open(tmpname, 'wb') as f:
+                for chunk in data:
+                    f.write(chunk)
+            os.replace(tmpname, entry)
+        except OSError as e:
+            logging.warning('Failed to write cache entry %s: %s' % (entry, e))
+            self._remove(tmpname)
+            return
+        logging.info('%s (%s) stored in cache' % (filename, ptype))
+        self.evict()
+
+    # Layout: magic, number of buffers, pickle length, buffer lengths, pickle, buffers
+    def _encode(self, obj):
+        buffers = []
+        payload = pickle.dumps(_packPoints(obj), protocol=5, buffer_callback=buffers.append)
+        raws = [buf.raw() for buf in buffers]
+        header = CACHE_MAGIC + struct.pack('<IQ', len(raws), len(payload))
+        header += struct.pack('<%sQ' % len(raws), *[raw.nbytes for raw in raws])
+        return [header, payload] + raws
+
+    def _decode(self, data):
+        if data[:4] != CACHE_MAGIC:
+            raise ValueError('bad magic')
+        (nbuf, npayload) = struct.unpack_from('<IQ', data, 4)
+        offset = 16
+        sizes = struct.unpack_from('<%sQ' % nbuf, data, offset)
+        offset += 8 * nbuf
+        view = memoryview(data)
+        payload = view[offset:offset+npayload]
+        offset += npayload
+        buffers = []
+        for size in sizes:
+            buffers.append(view[offset:offset+size])
+            offset += size
+        if offset != len(data):
+            raise ValueError('truncated entry')
+        return _unpackPoints(pickle.loads(payload, buffers=buffers))
+
+    def _entries(self):
+        entries = []
+        try:
+            names = os.listdir(self.cachedir)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            fname = os.path.join(self.cachedir, name)
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, fname))
+        return entries
+
+    def size(self):
+        return sum([e[1] for e in self._entries()])
+
+    def evict(self):
+        entries = sorted(self._entries())
+        total = sum([e[1] for e in entries])
+        for (_, size, fname) in entries:
+            if total <= self.maxsize:
+                break
+            self._remove(fname)
+            total -= size
+            logging.info('cache entry %s evicted' % fname)
+
+    def clear(self):
+        for (_, _, fname) in self._entries():
+            self._remove(fname)
+
+    def _remove(self, fname):
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+
+# The cache readPFile consults. None means caching is off (the default).
+_cache = None
+
+def enableCache(cachedir, maxsize=DEFAULT_CACHE_SIZE):
+    global _cache
+    from pftools.readPFile import PARSER_VERSION
+    _cache = PFParseCache(cachedir, maxsize, PARSER_VERSION)
+    logging.info('readPFile cache enabled in %s, max %s bytes' % (cachedir, maxsize))
+    return _cache
+
+def disableCache():
+    global _cache
+    _cache = None
+
+def getCache():
+    return _cache
+
+
+if __name__ == '__main__':
+    prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+    sys.path.insert(0, prjpath)
+    from pftools.readPFile import readPFile
+    # use the module readPFile sees, not this __main__ copy
+    from pftools.PFCache import enableCache
+
+    FORMAT = "[%(asctime)s %(levelname)s - %(funcName)s] %(message)s"
+    logging.basicConfig(format=FORMAT, filename=prjpath+'logs/test.log', level=logging.INFO)
+
+    cache = enableCache(os.path.join(tempfile.gettempdir(), 'pfcache'))
+    cache.clear()
+    fname = prjpath+'examples/Patient_6204/Plan_0/plan.Trial'
+    for run in ['cold', 'warm']:
+        t0 = time.perf_counter()
+        PlanTrial = readPFile(fname, 'plan.Trial')
+        print('%s: %.1f ms' % (run, (time.perf_counter()-t0)*1000))
+    print('hits %s, misses %s, %s bytes in cache' % (cache.hits, cache.misses, cache.size()))
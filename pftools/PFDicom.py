@@ -1,6 +1,7 @@
 import os
 import struct
 import sys
+import time
 import logging
 import datetime
 from typing import List, Optional, Sequence
@@ -14,26 +15,50 @@ from pftools.PFPatient import readPatient
 from pftools.PFImgSetHeader import readImageSetHeader
 from pftools.PFImgInfo import readImageInfo
 from pftools.PFImgSetInfo import readImageSetInfo
-from pftools.PFPlanInfo import readPlanInfo
-from pftools.PFPlanPatientSetup import readPlanPatientSetup
-from pftools.PFPlanPoints import readPlanPoints
-from pftools.PFPlanROI import readPlanROI
-from pftools.PFPlanTrial import readPlanTrial, _Trial
-from pftools.PFPlanMachine import readMachine
+from pftools.PFPlanTrial import _Trial
+from pftools.PFTrialBinary import getTrialBinaryName, iterTrialBinaryFrames
+from pftools.PFImgSlices import openImageSlices
+from pftools.PFRLE import encodeRLEFrame
+from pftools.PFPlanSession import PFPlanSession, linkPrescriptionToBeam, splitTrialOnPrescription
 
 import pydicom.uid
 import pydicom.sequence
+import pydicom.encaps
 from pydicom.dataset import Dataset
 from pydicom.dataset import FileDataset
 from pydicom.dataset import FileMetaDataset
+from pydicom.dataelem import RawDataElement
+from pydicom.tag import Tag
 import pydicom._storage_sopclass_uids as ssopuids
 import pydicom._uid_dict as uid_dict
 
 import shutil
 import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# PFDicom object and CT template of a forked CT worker, see _createCTfromData
+_ctWorker = None
+
+def _initCTWorker(pfdicom, template):
+    global _ctWorker
+    _ctWorker = (pfdicom, template)
+
+def _saveCTSliceInWorker(i):
+    (pfdicom, template) = _ctWorker
+    pfdicom._saveCTSlice(template, i)
+
+# transfer syntaxes for CT and RD, by the names used in app.py
+TRANSFER_SYNTAXES = {
+    'explicit': pydicom.uid.ExplicitVRLittleEndian,
+    'deflated': pydicom.uid.DeflatedExplicitVRLittleEndian,
+    'rle':      pydicom.uid.RLELossless,
+}
 
 class PFDicom():
-    def __init__(self, pfpath, outpath='') -> None :
+    def __init__(self, pfpath, outpath='', transfer_syntax='explicit') -> None :
+        if transfer_syntax not in TRANSFER_SYNTAXES:
+            raise ValueError('Unknown transfer syntax: %s' % transfer_syntax)
         logging.info('Start reading in Patient files from folder %s\n' % pfpath)
         self.Patient = readPatient(pfpath)
 
@@ -58,6 +83,9 @@ class PFDicom():
         for planinfo in self.Patient.PlanList.Plan:
             self.PlanImageSetMap[planinfo.PlanID] = planinfo.PrimaryCTImageSetID
 
+        # transfer syntax of CT and RD files, see _generateUIDs
+        self.PixelTransferSyntaxUID = TRANSFER_SYNTAXES[transfer_syntax]
+
         # dicom preamble and prefix
         self.Preamble = b'\x00' * 128
         self.Prefix = 'DICM'
@@ -73,6 +101,9 @@ class PFDicom():
         # 'NONE', 'STEPSHOOT', 'SLIDINGWINDOW'
         self.DynamicMode = ''
 
+        # CT pixels, see PFImgSlices
+        self.ImageSlices = None
+
         # plan files to be read in to
         self.ImgSetHeader = None
         self.ImgSetInfo = None
@@ -83,6 +114,14 @@ class PFDicom():
         self.PlanROI = None
         self.PlanTrial = None
 
+        # one session per plan, shared by RS, RD and RP
+        self.PlanSessions = {}
+
+    def getPlanSession(self, planid) -> PFPlanSession:
+        if planid not in self.PlanSessions:
+            self.PlanSessions[planid] = PFPlanSession(self.PFPath, planid, self.PlanImageSetMap[planid])
+        return self.PlanSessions[planid]
+
     def _initializeForDicom(self, dst='CT', id=0):
         if dst not in ['CT', 'RS', 'RP', 'RD']:
             logging.error('Incorrect DICOM format: %s' % dst)
@@ -96,30 +135,27 @@ class PFDicom():
             self.ImgSetInfo = readImageSetInfo(self.PFPath, self.ImageSetID)
             self.ImageInfo = readImageInfo(self.PFPath, self.ImageSetID).ImageInfo
 
-            bitpix = self.ImgSetHeader.bitpix
-            if   bitpix == 16: dtype = np.int16
-            elif bitpix == 8:  dtype = np.int8
-            elif bitpix == 32: dtype = np.int32
-            else: dtype = np.short
-            datafile = '%s/ImageSet_%s.img' % (self.PFPath, id)
-            self.ImageData = np.fromfile(datafile, dtype) - 1000  # ***
+            # slices are read on demand from ImageSet_N.img or ImageSet_N.DICOM/
+            self.ImageSlices = openImageSlices(self.PFPath, id, self.ImgSetHeader, self.ImageInfo)
 
         if dst == 'RS' or dst == 'RD' or dst == 'RP':
+            session = self.getPlanSession(id)
             self.PlanID = id
-            self.ImageSetID = self.PlanImageSetMap[id]
-            self.ImgSetHeader = readImageSetHeader(self.PFPath, self.ImageSetID)
-            self.ImgSetInfo = readImageSetInfo(self.PFPath, self.ImageSetID)
-            self.ImageInfo = readImageInfo(self.PFPath, self.ImageSetID).ImageInfo
-            self.PlanPatientSetup = readPlanPatientSetup(self.PFPath, self.PlanID)
-            self.PlanInfo = readPlanInfo(self.PFPath, self.PlanID)
-            self.PlanPoints = readPlanPoints(self.PFPath, self.PlanID)
-            self.PlanROI = readPlanROI(self.PFPath, self.PlanID)
+            self.ImageSetID = session.ImageSetID
+            self.ImgSetHeader = session.ImgSetHeader
+            self.ImgSetInfo = session.ImgSetInfo
+            self.ImageInfo = session.ImageInfo
+            self.PlanPatientSetup = session.PlanPatientSetup
+            self.PlanInfo = session.PlanInfo
+            self.PlanPoints = session.PlanPoints
+            self.PlanROI = session.PlanROI
 
         if dst == 'RD' or dst == 'RP':
-            self.PlanTrial = readPlanTrial(self.PFPath, self.PlanID)
-            self.PlanMachine = readMachine(self.PFPath, self.PlanID)
-            self._linkPrescriptionToBeam()
-            self._splitTrialOnPrescription()
+            # already linked to prescriptions and split by the session. Read
+            # without control points: beam.CPManager is None here, RP gets
+            # them from session.iterBeams()
+            self.PlanTrial = session.PlanTrial
+            self.PlanMachine = session.PlanMachine
 
         # yyyy-mm-dd to yyyymmdd        
         self.ScanDate = self.ImgSetHeader.date.split()[0].replace('-','')
@@ -140,71 +176,18 @@ class PFDicom():
         self.Zshift = 0 # -(z0 + (nz-1)*dz/2.0)
 
     def _splitTrialOnPrescription(self):
-        # remove imaging trials        
-        for trial in self.PlanTrial.Trial:
-            if 'imaging' in trial.Name.lower() or 'image' in trial.Name.lower():
-                self.PlanTrial.Trial.remove(trial)
-        # remove imaging fields
-        for trial in self.PlanTrial.Trial:
-            for beam in trial.BeamList.Beam:
-                if 'image' in beam.Name:
-                    self.PlanTrial.Trial.remove(beam)
-
-        # split each trial based on prescription
-        ntrial = len(self.PlanTrial.Trial)
-        for itri in range(ntrial):
-            trials = self.PlanTrial.Trial
-        
-            # get all prescriptions in beams
-            presc_list = [trials[itri].BeamList.Beam[0].Prescription.Name]
-            for beam in trials[itri].BeamList.Beam:
-                if beam.Prescription.Name not in presc_list:
-                    presc_list.append(beam.Prescription.Name)
-            
-            if dcmcommon.debug:
-                print('-- Prescriptions in Trial ' + trials[itri].Name + ": " + str(presc_list))
-
-            if len(presc_list) == 1: continue
-
-            # For more than one presc, split the trial
-            for prsc_name in presc_list:
-                trial_copy = copy.deepcopy(trials[itri])
-                trial_copy.Name = trials[itri].Name + "_" + prsc_name
-                for beam in trial_copy.BeamList.Beam:
-                    if beam.Prescription.Name != prsc_name:
-                        beam.Removable = True
-                trials.append(trial_copy)
-            trials[itri].Removable = True  # flag the original trial for removal
-        # end of splitting trials
-
-        # remove the flagged trials
-        for trial in self.PlanTrial.Trial:
-            if trial.Removable:
-                self.PlanTrial.Trial.remove(trial)
-
-        # Set TrialID for easy reference later; and remove flagged beams
-        for itri in range(len(self.PlanTrial.Trial)):
-            self.PlanTrial.Trial[itri].TrialID = itri
-            beams = self.PlanTrial.Trial[itri].BeamList.Beam
-            # remove() not working for unknown reason. pop() is used here.
-            for ibeam in reversed(range(len(beams))):
-                if beams[ibeam].Removable:
-                    self.PlanTrial.Trial[itri].BeamList.Beam.pop(ibeam)
-
-        # if dcmcommon.debug:
-        #     for trial in self.PlanTrial.Trial:
-        #         print('Trial: %s with ID %s of Plan %s' % (trial.Name, trial.TrialID, self.PlanID))
-        #         for beam in trial.BeamList.Beam:
-        #             print('  Beam %12s -- prescription %s/%s of name %s. Removable = %s' % (beam.Name, 
-        #                 beam.Prescription.PrescriptionDose, beam.Prescription.NumberOfFractions,
-        #                 beam.Prescription.Name, beam.Removable))
+        splitTrialOnPrescription(self.PlanTrial)
 
     def _generateUIDs(self, trial:Optional[_Trial]=None):
         # default to Trial[0]
         if trial is None and self.DICOMFORMAT in ['RP', 'RD']:
             trial = self.PlanTrial.Trial[0]
 
-        self.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        # CT and RD in the transfer syntax asked for, RS and RP always uncompressed
+        if self.DICOMFORMAT in ['CT', 'RD']:
+            self.TransferSyntaxUID = self.PixelTransferSyntaxUID
+        else:
+            self.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
 
         # Entropy src based SOPInstanceUID for CT, RS, RP, and RD
         self.CTSOPInstanceUID = [] #pydicom.uid.generate_uid() # one for each image
@@ -214,6 +197,10 @@ class PFDicom():
             self.CTSOPInstanceUID.append(   # last 3 characters are the slice number
                 pydicom.uid.generate_uid(entropy_srcs=entropy_src)[:-3] + str(i+1).zfill(3)
                 )
+        self._buildSliceIndex()
+        # the image set as one Enhanced CT object, see _createEnhancedCT
+        entropy_src = [ self.Patient.MedicalRecordNumber, str(self.ImageSetID), 'EnhancedCT']
+        self.EnhancedCTSOPInstanceUID = pydicom.uid.generate_uid(entropy_srcs=entropy_src)[:-3] + '000'
         # Padding characters 7 for RS, 8 for RD, 9 for RP, plus planid, at the UID end.
         entropy_src = [ self.Patient.MedicalRecordNumber, str(self.ImageSetID), str(self.PlanID), 'RS']
         self.RSSOPInstanceUID = pydicom.uid.generate_uid(entropy_srcs=entropy_src)[:-3] + str(self.PlanID).rjust(3,'7')
@@ -257,33 +244,40 @@ class PFDicom():
 
 
     # always assume input/output coord list in the shape of [x,y,z,x,y,z...]
+    # An (N,3) array works too. The output is a flat list of DS strings,
+    # '%6.2f' in mm or '%6.1f' in cm.
     def transCoord(self, clist=[], out_unit='cm') -> List:
-        trans = []
-        for i in range(len(clist)):
-            if i%3 == 0: # x
-                xyz = clist[i]
-            elif i%3 == 1: # y
-                xyz = -(clist[i] - self.Yshift)
-            else: # i%3 == 2: # z
-                xyz = -clist[i]
-            if out_unit == 'mm':
-                trans.append('%6.2f' % (xyz*10.0))
-            else:
-                trans.append('%6.1f' % xyz)
-        return trans
+        pts = np.asarray(clist, dtype=float).ravel()
+        npts = pts.size
+        if npts == 0:
+            return []
+        if npts % 3 != 0:
+            pts = np.concatenate([pts, np.zeros(3 - npts % 3)])
+        # x' = x, y' = -(y - Yshift), z' = -z. Done per axis, not as a matrix
+        # product, so every value is rounded exactly as the scalar version did.
+        if out_unit == 'mm':
+            scale = np.array([10.0, -10.0, -10.0])
+            fmt = '%6.2f'
+        else:
+            scale = np.array([1.0, -1.0, -1.0])
+            fmt = '%6.1f'
+        xyz = (pts.reshape(-1, 3) - np.array([0.0, self.Yshift, 0.0])) * scale
+        # one %-format call for all values, then split
+        values = xyz.ravel()[:npts].tolist()
+        return ('\\'.join([fmt] * npts) % tuple(values)).split('\\')
+
+    # ContourData (in mm) as an already encoded DS element. pydicom writes it as is,
+    # instead of turning every value into a DSfloat first, which is the slow part
+    # for large structure sets. Values read back are the same as with a list.
+    def _getContourDataElement(self, clist):
+        value = '\\'.join(self.transCoord(clist, out_unit='mm')).encode('ascii')
+        if len(value) % 2 == 1:
+            value += b' '
+        return RawDataElement(Tag(0x3006, 0x0050), 'DS', len(value), value, 0, False, True)
 
     # make each beam contains the correct prescription info
     def _linkPrescriptionToBeam(self):
-        for trial in self.PlanTrial.Trial:
-            # remove trials with no beams
-            if trial.BeamList.Beam is None:
-                self.PlanTrial.Trial.remove(trial)
-                continue
-            for beam in trial.BeamList.Beam:
-                for presc in trial.PrescriptionList.Prescription:
-                    if beam.PrescriptionName == presc.Name:
-                        beam.Prescription = presc
-                        break                
+        linkPrescriptionToBeam(self.PlanTrial)
 
     def _setSOPCommon(self, ds):
         ds.SpecificCharacterSet = 'ISO_IR 100'
@@ -387,36 +381,63 @@ class PFDicom():
         # ds.RescaleType = ''
 
     def _setImagePlanePixelModule(self, ds, index):
-        ds.SliceThickness = self.ImgSetHeader.z_pixdim
+        self._setImagePlaneModule(ds)
+        self._setImageSlice(ds, index)
 
-        # ImgSetHeader.x_start == x_start (should be)
-        # ImgSetHeader.y_start <=??=> y_start??
-        ds.ImagePositionPatient = [ 
-            10.0 * self.ImgSetHeader.x_start,
-            #-10.0 * self.ImgSetHeader.x_start,
-            #-10.0 * (self.ImgSetHeader.x_start - self.ImgSetHeader.x_pixdim),
-            # -10.0*self.ImgSetHeader.x_dim*self.ImgSetHeader.x_pixdim/2.0,
-            -10.0*(self.ImgSetHeader.couch_height+self.ImgSetHeader.y_dim*self.ImgSetHeader.y_pixdim/2),
-            -10.0*self.ImageInfo[index].TablePosition
-            ]
+    # the part of Image Plane and Image Pixel modules shared by all slices
+    def _setImagePlaneModule(self, ds):
+        ds.SliceThickness = self.ImgSetHeader.z_pixdim
         if self.ImgSetHeader.patient_position in ['HFP', 'FFP']:
             ds.ImageOrientationPatient = [-1.0,0.0,0.0,0.0,-1.0,-0.0]
         else: # if ds.PatientPosition in ['HFS', 'FFS']:
             ds.ImageOrientationPatient = [1.0,0.0,0.0,0.0,1.0,-0.0]
-        # ds.SliceLocation = 10.0*self.ImageInfo[index].CouchPos
-        ds.SliceLocation = -10.0*self.ImageInfo[index].TablePosition
         ds.PixelSpacing = [ 10.0*self.ImgSetHeader.x_pixdim, 
                             10.0*self.ImgSetHeader.y_pixdim]
 
         ds.Rows = self.ImgSetHeader.x_dim
         ds.Columns = self.ImgSetHeader.y_dim
         ds.PixelAspectRatio = r"1\1"            
-        slicedata = self.ImageData[
-            index*ds.Rows*ds.Columns:(index+1)*ds.Rows*ds.Columns]
         ds.PixelRepresentation = 1
+
+    # slice position and pixels
+    def _setImageSlice(self, ds, index):
+        # ImgSetHeader.x_start == x_start (should be)
+        # ImgSetHeader.y_start <=??=> y_start??
+        # x: 10*x_start, y: -10*(couch_height + y_dim*y_pixdim/2), z: -10*TablePosition
+        ds.ImagePositionPatient = self.SlicePositions[index].tolist()
+        # ds.SliceLocation = 10.0*self.ImageInfo[index].CouchPos
+        ds.SliceLocation = float(self.SliceLocations[index])
+        slicedata = self.ImageSlices.getSlice(index)
         ds.SmallestImagePixelValue = int(np.amin(slicedata))
         ds.LargestImagePixelValue  = int(np.amax(slicedata))
-        ds.PixelData = slicedata.tobytes()
+        self._setPixelData(ds, [slicedata])
+
+    # Save ds with PixelData from 2D frames, nbytes in all. In Explicit VR Little
+    # Endian the frames are written to the file one by one after the rest of ds,
+    # PixelData being its last element; otherwise they go through _setPixelData,
+    # as the whole file is encoded or deflated by pydicom.
+    def _savePixelFrames(self, ds, ofname, frames, nbytes):
+        if self.TransferSyntaxUID != pydicom.uid.ExplicitVRLittleEndian:
+            self._setPixelData(ds, frames)
+            ds.save_as(ofname, write_like_original=False)
+            return
+        with open(ofname, 'wb') as f:
+            ds.save_as(f, write_like_original=False)
+            f.write(struct.pack('<HH2sHI', 0x7FE0, 0x0010, b'OW', 0, nbytes))
+            for frame in frames:
+                f.write(np.ascontiguousarray(frame).data)
+
+    # PixelData from 2D frames in the transfer syntax of the file: each frame
+    # RLE encoded and encapsulated for RLE Lossless, the plain bytes otherwise.
+    def _setPixelData(self, ds, frames):
+        if self.TransferSyntaxUID == pydicom.uid.RLELossless:
+            ds.PixelData = pydicom.encaps.encapsulate([encodeRLEFrame(frame) for frame in frames])
+            ds['PixelData'].VR = 'OB'
+            ds['PixelData'].is_undefined_length = True
+        elif isinstance(frames, np.ndarray):
+            ds.PixelData = frames.tobytes()
+        else:
+            ds.PixelData = b''.join([frame.tobytes() for frame in frames])
 
             
     def _setPatientModule(self, ds):
@@ -433,7 +454,9 @@ class PFDicom():
 
 
     # CT set will be created anyway, no matter if there are existing CT folder.
-    def createDicomCT(self, imgsetid) -> None:
+    # With multiframe=True, the image set is written as a single Enhanced CT object
+    # instead of one CT file per slice, see _createEnhancedCT.
+    def createDicomCT(self, imgsetid, workers=1, multiframe=False) -> None:
         # ctpath = '%s/ImageSet_%s.DICOM/' % (self.PFPath, imgsetid)
         # if os.path.exists(ctpath):
         #     logging.info('Existing DICOM ImageSet_%s. Copy to destination ...' % imgsetid)
@@ -449,42 +472,225 @@ class PFDicom():
         # Initialize for CT DICOM creation.
         self._initializeForDicom('CT', imgsetid)
         self._generateUIDs()
-        self._createCTfromData(imgsetid)
+        if multiframe:
+            self._createEnhancedCT(imgsetid)
+        else:
+            self._createCTfromData(imgsetid, workers)
         logging.info('DICOM ImageSet generated.')
 
-    def _createCTfromData(self, imgsetid) -> bool:
-        datafile = '%s/ImageSet_%s.img' % (self.PFPath, imgsetid)
-        if not os.path.isfile(datafile):
-            print('No CT data file found: %s' % datafile)
-            logging.error('No CT data file found: %s' % datafile)
+    # Everything in a CT slice but its position, pixels and SOPInstanceUID.
+    # Built and validated once per image set.
+    def _getCTTemplate(self):
+        file_meta = FileMetaDataset()
+        file_meta.TransferSyntaxUID = self.TransferSyntaxUID
+        file_meta.MediaStorageSOPClassUID    = self.StorageSOPClassUID
+        file_meta.MediaStorageSOPInstanceUID = self.StorageSOPInstanceUID[0]
+        pydicom.dataset.validate_file_meta(file_meta, enforce_standard=True)
+        del file_meta.MediaStorageSOPInstanceUID
+
+        ds = Dataset()
+        self._setSOPCommon(ds)
+        self._setPatientModule(ds)
+        self._setFrameOfReference(ds)
+        self._setStudyModule(ds)
+        self._setSeriesModule(ds)
+        self._setEquipmentModule(ds)
+        self._setVOILUTModule(ds)
+        self._setGeneralCTImageModule(ds)
+        self._setImagePlaneModule(ds)
+        self._setInstanceUID(ds, self.CTSOPInstanceUID[0])
+        del ds.SOPInstanceUID
+        return (ds, file_meta)
+
+    # Stamp out slice i from the template. The element dicts are copied, so the
+    # slice-specific elements added here are new and the template is left untouched.
+    def _getCTSlice(self, template, i) -> FileDataset:
+        (ds_tmpl, meta_tmpl) = template
+        file_meta = FileMetaDataset(dict(meta_tmpl._dict))
+        file_meta.MediaStorageSOPInstanceUID = self.StorageSOPInstanceUID[i] #self.ImageInfo[i].InstanceUID
+
+        ofname = '%s/CT_%s.%s.dcm' % (self.OutPath, str(i+1).zfill(3), self.SOPInstanceUID[i])
+        ds = FileDataset(ofname, dict(ds_tmpl._dict), file_meta=file_meta, preamble=self.Preamble,
+                         is_implicit_VR=ds_tmpl.is_implicit_VR, is_little_endian=ds_tmpl.is_little_endian)
+        ds.SOPInstanceUID = self.CTSOPInstanceUID[i]
+        self._setImageSlice(ds, i)
+        return ds
+
+    def _saveCTSlice(self, template, i):
+        ds = self._getCTSlice(template, i)
+        ds.save_as(ds.filename, write_like_original=False)
+        logging.info('CT DICOM file saved: %s' % ds.filename)
+
+    # With workers > 1, slices are encoded and written by a pool of forked processes.
+    # The workers inherit this object with its slice source, so only slice
+    # indices are sent to them. Names and UIDs are the same as in serial mode.
+    # Where fork is not available, a thread pool is used instead.
+    def _createCTfromData(self, imgsetid, workers=1) -> bool:
+        if self.ImageSlices is None:
+            print('No CT data found for ImageSet_%s in %s' % (imgsetid, self.PFPath))
+            logging.error('No CT data found for ImageSet_%s in %s' % (imgsetid, self.PFPath))
             return False
         
-        for i in range(self.ImgSetInfo.NumberOfImages):
-            file_meta = FileMetaDataset()
-            file_meta.TransferSyntaxUID = self.TransferSyntaxUID
-            file_meta.MediaStorageSOPClassUID    = self.StorageSOPClassUID
-            file_meta.MediaStorageSOPInstanceUID = self.StorageSOPInstanceUID[i] #self.ImageInfo[i].InstanceUID
-
-            ofname = '%s/CT_%s.%s.dcm' % (self.OutPath, str(i+1).zfill(3), self.SOPInstanceUID[i])
-            ds = FileDataset(ofname, {}, file_meta=file_meta, preamble=self.Preamble)
-
-            self._setSOPCommon(ds)
-            self._setPatientModule(ds)
-            self._setFrameOfReference(ds)
-            self._setStudyModule(ds)
-            self._setSeriesModule(ds)
-            self._setEquipmentModule(ds)
-            self._setVOILUTModule(ds)
-            self._setGeneralCTImageModule(ds)
-            self._setImagePlanePixelModule(ds, i)
-            self._setInstanceUID(ds, self.CTSOPInstanceUID[i])
+        template = self._getCTTemplate()
+        nslices = self.ImageSlices.NumberOfSlices
+        if workers is None or workers <= 1:
+            for i in range(nslices):
+                self._saveCTSlice(template, i)
+        elif 'fork' in multiprocessing.get_all_start_methods():
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                                     initializer=_initCTWorker, initargs=(self, template)) as pool:
+                # list() to re-raise the first error from the workers
+                list(pool.map(_saveCTSliceInWorker, range(nslices), chunksize=8))
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(lambda i: self._saveCTSlice(template, i), range(nslices)))
 
-            pydicom.dataset.validate_file_meta(ds.file_meta, enforce_standard=True)
-            ds.save_as(ofname, write_like_original=False)
-            logging.info('CT DICOM file saved: %s' % ofname)
+        return True
+
+    # The image set as one Enhanced CT Image Storage object, CT_<imgsetid>.<uid>.dcm.
+    # Frames are the slices in ImageInfo order, positioned per frame in the
+    # PerFrameFunctionalGroupsSequence; everything else is in the shared groups.
+    # The stored values of the slice source are written as they are, with its HU
+    # offset as RescaleIntercept, so the pixels go from the (memory-mapped) volume
+    # to the file without being converted. The frames are DERIVED, which leaves
+    # out the acquisition macros of ORIGINAL Enhanced CT frames.
+    def _createEnhancedCT(self, imgsetid) -> bool:
+        if self.ImageSlices is None:
+            print('No CT data found for ImageSet_%s in %s' % (imgsetid, self.PFPath))
+            logging.error('No CT data found for ImageSet_%s in %s' % (imgsetid, self.PFPath))
+            return False
+
+        nframes = self.ImageSlices.NumberOfSlices
+        inst_uid = self.EnhancedCTSOPInstanceUID
+        file_meta = FileMetaDataset()
+        file_meta.TransferSyntaxUID = self.TransferSyntaxUID
+        file_meta.MediaStorageSOPClassUID    = ssopuids.EnhancedCTImageStorage
+        file_meta.MediaStorageSOPInstanceUID = inst_uid
+        ofname = '%s/CT_%s.%s.dcm' % (self.OutPath, str(imgsetid).zfill(3), inst_uid)
+        ds = FileDataset(ofname, {}, file_meta=file_meta, preamble=self.Preamble)
 
+        self._setSOPCommon(ds)
+        ds.SOPClassUID = ssopuids.EnhancedCTImageStorage
+        self._setPatientModule(ds)
+        self._setFrameOfReference(ds)
+        self._setStudyModule(ds)
+        self._setSeriesModule(ds)
+        self._setEquipmentModule(ds)
+        self._setEnhancedCTImageModule(ds)
+        self._setMultiFrameModules(ds, nframes)
+        self._setInstanceUID(ds, inst_uid)
+        pydicom.dataset.validate_file_meta(ds.file_meta, enforce_standard=True)
+
+        frames = (self.ImageSlices.getStoredSlice(i).astype('<i2', copy=False) for i in range(nframes))
+        self._savePixelFrames(ds, ofname, frames, nframes * ds.Rows * ds.Columns * 2)
+        logging.info('Enhanced CT DICOM file saved: %s' % ofname)
+        print('Enhanced CT DICOM file saved: %s (%s frames)' % (ofname, nframes))
         return True
 
+    def _setEnhancedCTImageModule(self, ds):
+        # Enhanced General Equipment Module
+        ds.ManufacturerModelName = self.ImgSetHeader.model or 'UNKNOWN'
+        ds.DeviceSerialNumber = 'UNKNOWN'
+        ds.SoftwareVersions = 'P3TK'
+
+        # Enhanced CT Image Module
+        ds.ImageType = ['DERIVED', 'PRIMARY', 'AXIAL', 'NONE']
+        ds.AcquisitionNumber = ''
+        ds.ContentQualification = 'PRODUCT'
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.Rows = self.ImgSetHeader.y_dim
+        ds.Columns = self.ImgSetHeader.x_dim
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.PresentationLUTShape = 'IDENTITY'
+        ds.BurnedInAnnotation = 'NO'
+        ds.RecognizableVisualFeatures = 'NO'
+        ds.LossyImageCompression = '00'
+        ds.PixelPresentation = 'MONOCHROME'
+        ds.VolumetricProperties = 'VOLUME'
+        ds.VolumeBasedCalculationTechnique = 'NONE'
+        ds.AcquisitionContextSequence = pydicom.sequence.Sequence()
+
+    # Multi-frame Functional Groups and Multi-frame Dimension Modules. Frames are
+    # indexed by StackID and InStackPositionNumber; the positions of all frames
+    # come from SlicePositions, computed at once from the table positions.
+    def _setMultiFrameModules(self, ds, nframes):
+        ds.InstanceNumber = 1
+        ds.ContentDate = self.ScanDate
+        ds.ContentTime = '000000'
+        ds.NumberOfFrames = nframes
+
+        entropy_src = [ self.Patient.MedicalRecordNumber, str(self.ImageSetID), 'Dimension']
+        dim_uid = pydicom.uid.generate_uid(entropy_srcs=entropy_src)
+        ds_org = Dataset()
+        ds_org.DimensionOrganizationUID = dim_uid
+        ds.DimensionOrganizationSequence = pydicom.sequence.Sequence([ds_org])
+        ds.DimensionOrganizationType = '3D'
+        ds.DimensionIndexSequence = pydicom.sequence.Sequence()
+        for (keyword, label) in [('StackID', 'Stack ID'), ('InStackPositionNumber', 'In-Stack Position Number')]:
+            ds_dim = Dataset()
+            ds_dim.DimensionOrganizationUID = dim_uid
+            ds_dim.DimensionIndexPointer = Tag(keyword)
+            ds_dim.FunctionalGroupPointer = Tag('FrameContentSequence')
+            ds_dim.DimensionDescriptionLabel = label
+            ds.DimensionIndexSequence.append(ds_dim)
+
+        shared = Dataset()
+        ds_pixel = Dataset()
+        ds_pixel.PixelSpacing = [10.0*self.ImgSetHeader.x_pixdim, 10.0*self.ImgSetHeader.y_pixdim]
+        ds_pixel.SliceThickness = 10.0*self.ImgSetHeader.z_pixdim
+        shared.PixelMeasuresSequence = pydicom.sequence.Sequence([ds_pixel])
+        ds_orient = Dataset()
+        if self.ImgSetHeader.patient_position in ['HFP', 'FFP']:
+            ds_orient.ImageOrientationPatient = [-1.0,0.0,0.0,0.0,-1.0,-0.0]
+        else:
+            ds_orient.ImageOrientationPatient = [1.0,0.0,0.0,0.0,1.0,-0.0]
+        shared.PlaneOrientationSequence = pydicom.sequence.Sequence([ds_orient])
+        ds_type = Dataset()
+        ds_type.FrameType = ds.ImageType
+        ds_type.PixelPresentation = ds.PixelPresentation
+        ds_type.VolumetricProperties = ds.VolumetricProperties
+        ds_type.VolumeBasedCalculationTechnique = ds.VolumeBasedCalculationTechnique
+        shared.CTImageFrameTypeSequence = pydicom.sequence.Sequence([ds_type])
+        ds_rescale = Dataset()
+        ds_rescale.RescaleIntercept = self.ImageSlices.HUOffset
+        ds_rescale.RescaleSlope = 1
+        ds_rescale.RescaleType = 'HU'
+        shared.PixelValueTransformationSequence = pydicom.sequence.Sequence([ds_rescale])
+        ds_voi = Dataset()
+        ds_voi.WindowCenter = dcmcommon.WindowCenter
+        ds_voi.WindowWidth  = dcmcommon.WindowWidth
+        shared.FrameVOILUTSequence = pydicom.sequence.Sequence([ds_voi])
+        ds_anatomy = Dataset()
+        ds_region = Dataset()
+        ds_region.CodeValue = '38266002'
+        ds_region.CodingSchemeDesignator = 'SCT'
+        ds_region.CodeMeaning = 'Entire body'
+        ds_anatomy.AnatomicRegionSequence = pydicom.sequence.Sequence([ds_region])
+        ds_anatomy.FrameLaterality = 'U'
+        shared.FrameAnatomySequence = pydicom.sequence.Sequence([ds_anatomy])
+        ds_event = Dataset()
+        entropy_src = [ self.Patient.MedicalRecordNumber, str(self.ImageSetID), 'Irradiation']
+        ds_event.IrradiationEventUID = pydicom.uid.generate_uid(entropy_srcs=entropy_src)
+        shared.IrradiationEventIdentificationSequence = pydicom.sequence.Sequence([ds_event])
+        ds.SharedFunctionalGroupsSequence = pydicom.sequence.Sequence([shared])
+
+        ds.PerFrameFunctionalGroupsSequence = pydicom.sequence.Sequence()
+        for (i, position) in enumerate(self.SlicePositions[:nframes].tolist()):
+            ds_content = Dataset()
+            ds_content.StackID = '1'
+            ds_content.InStackPositionNumber = i+1
+            ds_content.DimensionIndexValues = [1, i+1]
+            ds_plane = Dataset()
+            ds_plane.ImagePositionPatient = position
+            frame = Dataset()
+            frame.FrameContentSequence = pydicom.sequence.Sequence([ds_content])
+            frame.PlanePositionSequence = pydicom.sequence.Sequence([ds_plane])
+            ds.PerFrameFunctionalGroupsSequence.append(frame)
+
     def _getContourImageSequence(self):
         seq = pydicom.sequence.Sequence()
         for i in range(self.ImgSetInfo.NumberOfImages):
@@ -566,14 +772,44 @@ class PFDicom():
         ds.StructureSetROISequence = self._getStructureSetROISequence()
 
     # the CT clice that is closest to "z"
+    # TablePositions sorted once per image set, with the CT UID of each slice.
+    # Equal positions keep their ImageInfo order.
+    def _buildSliceIndex(self):
+        tablepos = np.array([img_info.TablePosition for img_info in self.ImageInfo], dtype=float)
+        # ImagePositionPatient and SliceLocation of every slice in mm, see _setImageSlice
+        self.SlicePositions = np.empty((len(tablepos), 3))
+        self.SlicePositions[:, 0] = 10.0 * self.ImgSetHeader.x_start
+        self.SlicePositions[:, 1] = -10.0*(self.ImgSetHeader.couch_height+self.ImgSetHeader.y_dim*self.ImgSetHeader.y_pixdim/2)
+        self.SlicePositions[:, 2] = -10.0*tablepos
+        self.SliceLocations = self.SlicePositions[:, 2]
+        self.SliceOrder = np.argsort(tablepos, kind='stable')
+        self.SliceTablePositions = tablepos[self.SliceOrder]
+        self.SliceUIDs = [self.CTSOPInstanceUID[img_info.SliceNumber-1] for img_info in self.ImageInfo]
+
     def _getClosestImageInstanceUID(self, z): # in cm
-        uid = 'NO_CLOSEST_CT_IMAGE_LOCATED'
-        for img_info in self.ImageInfo:
-            if abs(z - img_info.TablePosition) < self.ImgSetHeader.z_pixdim/2.0:  # in cm
-                uid = self.CTSOPInstanceUID[img_info.SliceNumber-1]
-                # print('Slice #: %s,  TablePosition: %s, InstanceUID: %s' % (img_info.SliceNumber, img_info.TablePosition, uid))
-                return uid
-        return uid
+        return self._getClosestImageInstanceUIDs([z])[0]
+
+    # For each z, the first slice in ImageInfo within half a slice thickness, as in
+    # a linear scan. The sorted index narrows each search to the few slices around
+    # z, which are then checked with the same test as the scan.
+    def _getClosestImageInstanceUIDs(self, zlist): # in cm
+        tol = self.ImgSetHeader.z_pixdim/2.0
+        tablepos = self.SliceTablePositions
+        nslices = len(tablepos)
+        zs = np.asarray(zlist, dtype=float)
+        lo = np.clip(np.searchsorted(tablepos, zs - tol, 'left') - 1, 0, nslices)
+        hi = np.clip(np.searchsorted(tablepos, zs + tol, 'right') + 1, 0, nslices)
+        # plain lists from here on, indexing numpy arrays per element is slow
+        order = self.SliceOrder.tolist()
+        tablepos = tablepos.tolist()
+        uids = []
+        for (z, ilo, ihi) in zip(zlist, lo.tolist(), hi.tolist()):
+            found = [order[k] for k in range(ilo, ihi) if abs(z - tablepos[k]) < tol]
+            if len(found) > 0:
+                uids.append(self.SliceUIDs[min(found)])
+            else:
+                uids.append('NO_CLOSEST_CT_IMAGE_LOCATED')
+        return uids
 
     def _getContourSequence(self, roi, ctype='POINT'):
         seq = pydicom.sequence.Sequence()
@@ -581,9 +817,9 @@ class PFDicom():
             ds_point = Dataset()
             ds_point.ContourGeometricType = ctype
             ds_point.NumberOfContourPoints = 1
-            ds_point.ContourData = self.transCoord([
+            ds_point[0x30060050] = self._getContourDataElement([
                 roi.XCoord, roi.YCoord, roi.ZCoord
-            ], out_unit='mm')
+            ])
             ds_point.ContourImageSequence = pydicom.sequence.Sequence()
             ds_contourimage = Dataset()
             ds_contourimage.ReferencedSOPClassUID = self.CTSOPClassUID
@@ -591,15 +827,16 @@ class PFDicom():
             ds_point.ContourImageSequence.append(ds_contourimage)
             seq.append(ds_point)
         if ctype == 'CLOSED_PLANAR':
-            for curve in roi.curve:
+            curve_uids = self._getClosestImageInstanceUIDs(roi.getCurveZ())
+            for (curve, curve_uid) in zip(roi.curve, curve_uids):
                 ds_planar = Dataset()
                 ds_planar.ContourGeometricType = ctype
                 ds_planar.NumberOfContourPoints = curve.num_points
-                ds_planar.ContourData = self.transCoord(curve.points, out_unit='mm')
+                ds_planar[0x30060050] = self._getContourDataElement(curve.points) # ContourData
                 ds_planar.ContourImageSequence = pydicom.sequence.Sequence()
                 ds_contourimage = Dataset()
                 ds_contourimage.ReferencedSOPClassUID = self.CTSOPClassUID
-                ds_contourimage.ReferencedSOPInstanceUID = self._getClosestImageInstanceUID(curve.points[2])
+                ds_contourimage.ReferencedSOPInstanceUID = curve_uid
                 # print('--> ZCoord: %s' % curve.points[2])
                 # print('--> ROI: %s  ContourPoints: %s   DataLength: %s' % (roi.name, ds_planar.NumberOfContourPoints, len(ds_planar.ContourData)))
                 # for i in range(curve.num_points):
@@ -729,32 +966,74 @@ class PFDicom():
         # print('--> Dose/MU @calib: %s, beam_mu %s' % (calib_dose_per_mu, beam_mu))
         return beam_mu
 
-    def _getBeamDosePerFrac(self, beam) -> np.array:
-        import struct
-        data_block = []
-        
+    # binary file and scale of the beam dose
+    def _getBeamDoseSource(self, beam):
         binary_number = beam.DoseVolume.split(':')[1][:-1]
-        binary_file = 'plan.Trial.binary.%s' % str(binary_number).zfill(3)
-        file_size = os.path.getsize('%s/Plan_%s/%s' % (self.PFPath, self.PlanID, binary_file))
+        binary_file = getTrialBinaryName(self.PFPath, self.PlanID, binary_number)
+        file_size = os.path.getsize(binary_file)
         beam_frac_dose = beam.MonitorUnitInfo.PrescriptionDose
         beam_mu = self._getBeamMU(beam)
         print('%12s --> %s: plan.Trial.binary.%s has size %s' % (
-            beam.Name, beam.DoseVolume, binary_file, file_size 
+            beam.Name, beam.DoseVolume, str(binary_number).zfill(3), file_size 
         ))
         print('%12s --> frac_dose %8.3f, MU: %8.3f' % (
             beam.Name, beam_frac_dose, beam_mu))
-        binary_file = '%s/Plan_%s/plan.Trial.binary.%s' % (self.PFPath, self.PlanID, str(binary_number).zfill(3))
-        with open(binary_file, 'rb') as bfile:
-            data_element = bfile.read(4)
-            while data_element:
-                v_raw = struct.unpack(">f", data_element)[0]
-                v_cnv = v_raw * self._getBeamMU(beam) / 100
-                data_block.append(v_cnv)
-                data_element = bfile.read(4)
-
-        return np.array(data_block, dtype=float)
-
-    def _setDoseImageModule(self, ds, trial):
+        return (binary_file, beam_mu / 100)
+
+    # read-only, shared by all trials of the plan with the same beam dose and MU
+    def _getBeamDosePerFrac(self, beam, shape=None) -> np.array:
+        (binary_file, scale) = self._getBeamDoseSource(beam)
+        return self.getPlanSession(self.PlanID).DoseCache.getDose(binary_file, shape, scale)
+
+    # Per fraction dose of each beam, None for a beam whose binary does not
+    # match the dose grid. With workers > 1 the binaries are read by a thread
+    # pool; the messages are still printed in beam order.
+    def _getBeamDoses(self, beams, shape, workers=1):
+        sources = [self._getBeamDoseSource(beam) for beam in beams]
+        cache = self.getPlanSession(self.PlanID).DoseCache
+        def load(source):
+            try:
+                return cache.getDose(source[0], shape, source[1])
+            except ValueError:
+                return None
+
+        if workers is None or workers <= 1:
+            doses = [load(source) for source in sources]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                doses = list(pool.map(load, sources))
+        for (beam, dose) in zip(beams, doses):
+            if dose is None:
+                logging.error('Beam %s has mismatching dose grid!' % beam.Name)
+                print('Beam %s has mismatching dose grid' % beam.Name)
+        return doses
+
+    # Sum of dose*weight over the beams, beam by beam in the given order. With
+    # workers > 1 the volume is cut into slabs of frames summed by a thread pool.
+    # Each voxel still gets its terms added in the same order, so the result is
+    # bit-identical to the serial sum.
+    def _sumBeamDoses(self, doses, weights, shape, workers=1):
+        totaldose = np.zeros(shape, dtype=float)
+        def sumSlab(slab):
+            beamdose_frac = np.empty(totaldose[slab].shape, dtype=float)
+            for (dose, weight) in zip(doses, weights):
+                np.multiply(dose[slab], weight, out=beamdose_frac)
+                totaldose[slab] += beamdose_frac
+
+        nz = shape[0]
+        if workers is None or workers <= 1 or nz < 2:
+            sumSlab(slice(0, nz))
+        else:
+            nslabs = min(nz, 4 * workers)
+            bounds = [nz * i // nslabs for i in range(nslabs+1)]
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(sumSlab, [slice(k0, k1) for (k0, k1) in zip(bounds[:-1], bounds[1:])]))
+        return totaldose
+
+    # dose grid geometry of the trial; returns the grid shape (nz, ny, nx).
+    # With box, (k0, r0, c0, nz, ny, nx), the geometry of that part of the grid:
+    # frames from k0, rows from r0 and columns from c0.
+    def _setDoseGridModule(self, ds, trial, box=None):
         x_orig = trial.DoseGridOriginX
         y_orig = trial.DoseGridOriginY
         z_orig = trial.DoseGridOriginZ
@@ -765,7 +1044,13 @@ class PFDicom():
         ny = trial.DoseGridDimensionY
         nz = trial.DoseGridDimensionZ
         # Shift applied to y. Probably ref orig is at different side of the dose region for Y.
-        [x0, y0, z0] = self.transCoord([x_orig, y_orig+dy*(ny-1), z_orig], out_unit='mm')
+        if box is None:
+            [x0, y0, z0] = self.transCoord([x_orig, y_orig+dy*(ny-1), z_orig], out_unit='mm')
+        else:
+            # row r of the grid is at y_orig+dy*(ny-1-r), frame k at z_orig+dz*k
+            (k0, r0, c0) = box[:3]
+            [x0, y0, z0] = self.transCoord([x_orig+dx*c0, y_orig+dy*(ny-1-r0), z_orig+dz*k0], out_unit='mm')
+            (nz, ny, nx) = box[3:]
         dx = dx * 10  # cm --> mm
         dy = dy * 10
         dz = dz * 10 
@@ -786,22 +1071,63 @@ class PFDicom():
         else: # if ds.PatientPosition in ['HFS', 'FFS']:
             ds.ImageOrientationPatient = [1.0,0.0,0.0,0.0,1.0,-0.0]
         # self.SliceLocation = ''
-
-        totaldose = np.zeros(nx*ny*nz, dtype=float)
-        for beam in trial.BeamList.Beam:
-            beamdose = self._getBeamDosePerFrac(beam)
-            if len(beamdose) != nx*ny*nz:
-                logging.error('Beam %s has mismatching dose grid!' % beam.Name)
-                print('Beam %s has mismatching dose grid' % beam.Name)
-            else:
-                presc_frac = beam.Prescription.NumberOfFractions
-                totaldose = totaldose + beamdose * presc_frac
-
-        ds.DoseGridScaling = 1.0e-6
-        totaldose = totaldose/ds.DoseGridScaling
-        scaleddose = totaldose.astype(np.int32)
-        smallestImagePixelValue = np.amin(scaleddose)
-        largestImagePixelValue  = np.amax(scaleddose)
+        return (nz, ny, nx)
+
+    # Smallest box (k0, r0, c0, nz, ny, nx) holding all voxels above threshold*Dmax,
+    # None if there are none.
+    def _getDoseBoundingBox(self, dose, threshold):
+        dmax = dose.max() if dose.size > 0 else 0
+        if dmax <= 0:
+            return None
+        mask = dose > threshold * dmax
+        box = []
+        for axes in [(1, 2), (0, 2), (0, 1)]:
+            idx = np.flatnonzero(mask.any(axis=axes))
+            box.append((idx[0], idx[-1]+1))
+        return tuple([int(i0) for (i0, i1) in box] + [int(i1-i0) for (i0, i1) in box])
+
+    # 16 bit pixels are used for bits=None when the dose step is no coarser than this (Gy)
+    MAX_DOSE_STEP_UINT16 = 1.0e-3
+
+    # Pixels of dose in Gy: BitsAllocated and DoseGridScaling set in ds.
+    # 32 bits have a step of 1 uGy. 16 bits have Dmax at 65535, with the step
+    # rounded up to 6 digits to be written as is. bits=None picks 16 bits if the
+    # step is at most MAX_DOSE_STEP_UINT16, 32 bits otherwise.
+    def _setDosePixelFormat(self, ds, dose, bits=32):
+        dmax = float(dose.max()) if dose.size > 0 else 0.0
+        step16 = float('%.5e' % (dmax / 65535 * 1.00001)) if dmax > 0 else 1.0e-6
+        if bits is None:
+            bits = 16 if step16 <= self.MAX_DOSE_STEP_UINT16 else 32
+        ds.BitsAllocated = bits
+        ds.BitsStored = bits
+        ds.HighBit = bits - 1
+        ds.DoseGridScaling = 1.0e-6 if bits == 32 else step16
+
+    # With crop, a fraction of Dmax, the RD only covers the voxels above crop*Dmax.
+    # bits is 32, 16, or None to choose, see _setDosePixelFormat.
+    def _setDoseImageModule(self, ds, trial, workers=1, crop=None, bits=32):
+        (nz, ny, nx) = self._setDoseGridModule(ds, trial)
+        beams = trial.BeamList.Beam
+        doses = self._getBeamDoses(beams, (nz, ny, nx), workers)
+        summed = [(dose, float(beam.Prescription.NumberOfFractions))
+                  for (beam, dose) in zip(beams, doses) if dose is not None]
+        totaldose = self._sumBeamDoses([d for (d, w) in summed], [w for (d, w) in summed],
+                                       (nz, ny, nx), workers)
+        del doses, summed
+
+        if crop is not None:
+            box = self._getDoseBoundingBox(totaldose, crop)
+            if box is not None:
+                (k0, r0, c0, nz, ny, nx) = box
+                totaldose = totaldose[k0:k0+nz, r0:r0+ny, c0:c0+nx]
+                self._setDoseGridModule(ds, trial, box)
+                print('Dose grid cropped to %sx%sx%s from voxel (%s, %s, %s)' % (nx, ny, nz, c0, r0, k0))
+
+        self._setDosePixelFormat(ds, totaldose, bits)
+        totaldose /= ds.DoseGridScaling
+        [scaleddose, smallestImagePixelValue, largestImagePixelValue] = \
+            self._getDosePixels(totaldose, ds.BitsAllocated)
+        del totaldose
 
         beam = trial.BeamList.Beam[0]
         presc_frac = beam.Prescription.NumberOfFractions
@@ -809,27 +1135,43 @@ class PFDicom():
         print('Trial Prescription: %s/%s (%s)' % (presc_dose, presc_frac, trial.Name))
         print('Dose pixel range:  [%s, %s], resulting in Dmax: %6.2f%s' % (
             smallestImagePixelValue, largestImagePixelValue,
-            largestImagePixelValue*0.01/presc_dose, '%'))
-
-        length = nx*ny*nz
-        format = ''
-        if ds.BitsAllocated==32:
-            format = 'I'*length
-        elif ds.BitsAllocated==16:
-            format = 'H'*length
-        else:
-            logging.error('BitsAllocated: %s is not supported!' % ds.BitsAllocated)
-        ds.PixelData = struct.pack(format, *(scaleddose.tolist()))
-
-    def _getReferencedRTPlanSequence(self, ds):
+            largestImagePixelValue*ds.DoseGridScaling*1.0e4/presc_dose, '%'))
+
+        # pydicom only takes bytes for PixelData; this is the only copy made.
+        self._setPixelData(ds, scaleddose)
+
+    # Convert the scaled dose to little-endian unsigned pixels frame by frame,
+    # tracking min/max while each frame is still in cache.
+    def _getDosePixels(self, dose, bits=32):
+        dtype = np.dtype('<u4') if bits == 32 else np.dtype('<u2')
+        pixels = np.empty(dose.shape, dtype=dtype)
+        vmin = np.iinfo(dtype).max
+        vmax = 0
+        for k in range(dose.shape[0]):
+            np.copyto(pixels[k], dose[k], casting='unsafe')
+            vmin = min(vmin, int(pixels[k].min()))
+            vmax = max(vmax, int(pixels[k].max()))
+        if dose.shape[0] == 0:
+            vmin = 0
+        return [pixels, vmin, vmax]
+
+    # With beam_number, the dose of that beam in the fraction group of the RP.
+    def _getReferencedRTPlanSequence(self, ds, beam_number=None):
         seq = pydicom.sequence.Sequence()
         ds_refplan = Dataset()
         ds_refplan.ReferencedSOPClassUID = self.RPSOPClassUID
         ds_refplan.ReferencedSOPInstanceUID = self.RPSOPInstanceUID
+        if beam_number is not None:
+            ds_refbeam = Dataset()
+            ds_refbeam.ReferencedBeamNumber = beam_number
+            ds_reffrac = Dataset()
+            ds_reffrac.ReferencedFractionGroupNumber = self.PlanID
+            ds_reffrac.ReferencedBeamSequence = pydicom.sequence.Sequence([ds_refbeam])
+            ds_refplan.ReferencedFractionGroupSequence = pydicom.sequence.Sequence([ds_reffrac])
         seq.append(ds_refplan)
         return seq
 
-    def _setRTDoseModule(self, ds, trial):
+    def _setRTDoseModule(self, ds, trial, beam_number=None):
         ds.ContentDate = trial.ObjectVersion.WriteTimeStamp.split(' ')[0].replace('-','')
         ds.ContentTime = trial.ObjectVersion.WriteTimeStamp.split(' ')[1].replace(':','')
         ds.InstanceNumber = self.Patient.MedicalRecordNumber[-2:]+str(self.ImageSetID)+str(self.PlanID)
@@ -842,39 +1184,120 @@ class PFDicom():
         ds.DoseUnits = 'GY'
         ds.DoseType = 'PHYSICAL'
         # ds.SpatialTransformationOfDose = 'NONE'
-        ds.DoseSummationType = 'PLAN'
+        ds.DoseSummationType = 'PLAN' if beam_number is None else 'BEAM'
         # self.DoseGridScaling = 1
-        ds.ReferencedRTPlanSequence = self._getReferencedRTPlanSequence(ds)
+        ds.ReferencedRTPlanSequence = self._getReferencedRTPlanSequence(ds, beam_number)
 
-    def createDicomRD(self, planid=0):
+    # RD file of a trial without its pixels: all modules but the dose image.
+    def _getRDDataset(self, trial, ofname, inst_uid, beam_number=None) -> FileDataset:
+        file_meta = FileMetaDataset()
+        file_meta.TransferSyntaxUID = self.TransferSyntaxUID
+        file_meta.MediaStorageSOPClassUID    = self.StorageSOPClassUID
+        file_meta.MediaStorageSOPInstanceUID = inst_uid
+        ds = FileDataset(ofname, {}, file_meta=file_meta, preamble=self.Preamble)
+
+        self._setSOPCommon(ds)
+        self._setPatientModule(ds)
+        self._setFrameOfReference(ds)
+        self._setStudyModule(ds)
+        self._setSeriesModule(ds)
+        self._setEquipmentModule(ds)
+        self._setRTDoseModule(ds, trial, beam_number)
+        return ds
+
+    # With workers > 1, the beam doses of each trial are read and summed by a
+    # thread pool. The dose is the same as in serial mode, bit for bit.
+    # With summation='BEAM', one RD per beam is written instead of the trial sum,
+    # see _createBeamDoses. crop and bits apply to the trial sum only, see
+    # _setDoseImageModule.
+    def createDicomRD(self, planid=0, workers=1, summation='PLAN', crop=None, bits=32):
+        if summation not in ['PLAN', 'BEAM']:
+            raise ValueError('Unknown RD summation type: %s' % summation)
+        if bits not in [16, 32, None]:
+            raise ValueError('BitsAllocated: %s is not supported!' % bits)
         self._initializeForDicom('RD', planid)
 
         for trial in self.PlanTrial.Trial:
+            t0 = time.perf_counter()
             self._generateUIDs(trial)
-
-            file_meta = FileMetaDataset()
-            file_meta.TransferSyntaxUID = self.TransferSyntaxUID
-            file_meta.MediaStorageSOPClassUID    = self.StorageSOPClassUID
-            file_meta.MediaStorageSOPInstanceUID = self.StorageSOPInstanceUID
+            if summation == 'BEAM':
+                self._createBeamDoses(trial, workers)
+                dt = time.perf_counter() - t0
+                logging.info('RD DICOM files of %s beams saved (%.3f s)' % (len(trial.BeamList.Beam), dt))
+                print('Trial %s: %s beams in %.3f s with %s worker(s)' % (
+                    trial.Name, len(trial.BeamList.Beam), dt, max(workers or 1, 1)))
+                continue
 
             ofname = '%s/RD_%s_%s.%s.dcm' % (self.OutPath, str(planid).zfill(3), 
                 str(trial.TrialID).zfill(3), self.RDSOPInstanceUID)
-            ds = FileDataset(ofname, {}, file_meta=file_meta, preamble=self.Preamble)
-
-            self._setSOPCommon(ds)
-            self._setPatientModule(ds)
-            self._setFrameOfReference(ds)
-            self._setStudyModule(ds)
-            self._setSeriesModule(ds)
-            self._setEquipmentModule(ds)
-            self._setRTDoseModule(ds, trial)
-            self._setDoseImageModule(ds, trial)
+            ds = self._getRDDataset(trial, ofname, self.StorageSOPInstanceUID)
+            self._setDoseImageModule(ds, trial, workers, crop, bits)
             self._setInstanceUID(ds, self.RDSOPInstanceUID)
 
             pydicom.dataset.validate_file_meta(ds.file_meta, enforce_standard=True)
             ds.save_as(ofname, write_like_original=False)
-            logging.info('RD DICOM file saved: %s' % ofname)
+            dt = time.perf_counter() - t0
+            logging.info('RD DICOM file saved: %s (%.3f s)' % (ofname, dt))
             print('RD DICOM file saved: %s' % ofname)
+            print('Trial %s: %s beams in %.3f s with %s worker(s)' % (
+                trial.Name, len(trial.BeamList.Beam), dt, max(workers or 1, 1)))
+
+    # RD UID of one beam, numbered as in the RP: 8 and planid at the end as for the trial RD.
+    def _getBeamRDSOPInstanceUID(self, trial, beam_number):
+        entropy_src = [ self.Patient.MedicalRecordNumber, str(self.ImageSetID), str(self.PlanID),
+                        str(trial.TrialID), str(beam_number), 'RD']
+        return pydicom.uid.generate_uid(entropy_srcs=entropy_src)[:-3] + str(self.PlanID).rjust(3,'8')
+
+    # One RD per beam (DoseSummationType BEAM) with the dose of all fractions of the
+    # beam, so that the beam files add up to the trial RD. Each beam is streamed from
+    # its binary file to disk one frame at a time; the volume is never held in memory.
+    # With workers > 1 the beams are written by a thread pool.
+    def _createBeamDoses(self, trial, workers=1):
+        beams = trial.BeamList.Beam
+        sources = [self._getBeamDoseSource(beam) for beam in beams]
+        def save(beam_number):
+            beam = beams[beam_number-1]
+            try:
+                self._saveBeamDose(trial, beam, beam_number, sources[beam_number-1])
+            except ValueError:
+                logging.error('Beam %s has mismatching dose grid!' % beam.Name)
+                print('Beam %s has mismatching dose grid' % beam.Name)
+
+        if workers is None or workers <= 1:
+            for beam_number in range(1, len(beams)+1):
+                save(beam_number)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(save, range(1, len(beams)+1)))
+
+    def _saveBeamDose(self, trial, beam, beam_number, source):
+        inst_uid = self._getBeamRDSOPInstanceUID(trial, beam_number)
+        ofname = '%s/RD_%s_%s_B%s.%s.dcm' % (self.OutPath, str(self.PlanID).zfill(3),
+            str(trial.TrialID).zfill(3), str(beam_number).zfill(3), inst_uid)
+        ds = self._getRDDataset(trial, ofname, inst_uid, beam_number)
+        ds.InstanceNumber = str(ds.InstanceNumber) + str(beam_number)
+        shape = self._setDoseGridModule(ds, trial)
+        ds.DoseGridScaling = 1.0e-6
+        self._setInstanceUID(ds, inst_uid)
+        pydicom.dataset.validate_file_meta(ds.file_meta, enforce_standard=True)
+
+        (binary_file, scale) = source
+        frames = iterTrialBinaryFrames(binary_file, shape, scale)
+        weight = float(beam.Prescription.NumberOfFractions)
+        dtype = np.dtype('<u4') if ds.BitsAllocated == 32 else np.dtype('<u2')
+        dose = np.empty(shape[1:], dtype=float)
+        pixels = np.empty(shape[1:], dtype=dtype)
+        # Same arithmetic as the trial sum with a single beam.
+        def getPixels():
+            for frame in frames:
+                np.multiply(frame, weight, out=dose)
+                np.divide(dose, ds.DoseGridScaling, out=dose)
+                np.copyto(pixels, dose, casting='unsafe')
+                yield pixels
+
+        self._savePixelFrames(ds, ofname, getPixels(), int(np.prod(shape)) * dtype.itemsize)
+        logging.info('RD DICOM file saved: %s' % ofname)
+        print('RD DICOM file saved: %s' % ofname)
 
     def _getReferencedStructureSetSequence(self, ds):
         seq = pydicom.sequence.Sequence()
@@ -984,25 +1407,45 @@ class PFDicom():
         ds.FractionGroupSequence = self._getFractionGroupSequence(trial)
         pass
 
-    def _getBeamLimitingDevicePositionSequence(self, cp):
+    # jaw and MLC positions in mm, DICOM order, for all control points of a
+    # CPManagerObject at once: lists of [x1, x2], [y1, y2] and the MLC
+    # positions (None for control points without MLC)
+    def _getLeafJawPositions(self, cpm):
+        ctrl_points = cpm.ControlPointList.ControlPoint
+        jawx = np.stack([-cpm.LeftJawPosition*10, cpm.RightJawPosition*10], axis=1).tolist()
+        jawy = np.stack([-cpm.BottomJawPosition*10, cpm.TopJawPosition*10], axis=1).tolist()
+        if cpm.MLCLeafPositions is not None:
+            return (jawx, jawy, self._getMLCPositions(cpm.MLCLeafPositions))
+        # not the same leaves in all control points (or no MLC at all)
+        mlcpos = [None]*len(ctrl_points)
+        for (icp, cp) in enumerate(ctrl_points):
+            if cp.MLCLeafPositions is not None:
+                leaves = np.array(cp.MLCLeafPositions.RawData.Points).astype(float).reshape(1,60,2)
+                mlcpos[icp] = self._getMLCPositions(leaves)[0]
+        return (jawx, jawy, mlcpos)
+
+    # (ncp, nleaf, 2) leaf positions in cm to rows of DICOM LeafJawPositions:
+    # all leaves of bank A, then bank B, in reverse leaf order, in mm
+    def _getMLCPositions(self, mlc):
+        mlc_pos = np.flip(mlc, axis=1).transpose(0, 2, 1).copy()
+        mlc_pos[:, 0] = -10.0 * mlc_pos[:, 0]
+        mlc_pos[:, 1] =  10.0 * mlc_pos[:, 1]
+        return np.around(mlc_pos.reshape(len(mlc), -1), 1).tolist()
+
+    def _getBeamLimitingDevicePositionSequence(self, jawx, jawy, mlcpos=None):
         seq = pydicom.sequence.Sequence()
         ds_limdevx = Dataset()
         ds_limdevx.RTBeamLimitingDeviceType = 'ASYMX'
-        ds_limdevx.LeafJawPositions = [-cp.LeftJawPosition*10, cp.RightJawPosition*10]
+        ds_limdevx.LeafJawPositions = jawx
         seq.append(ds_limdevx)
         ds_limdevy = Dataset()
         ds_limdevy.RTBeamLimitingDeviceType = 'ASYMY'
-        ds_limdevy.LeafJawPositions = [-cp.BottomJawPosition*10, cp.TopJawPosition*10]
+        ds_limdevy.LeafJawPositions = jawy
         seq.append(ds_limdevy)
-        if cp.MLCLeafPositions is not None:
+        if mlcpos is not None:
             ds_mlc = Dataset()
             ds_mlc.RTBeamLimitingDeviceType = 'MLCX'
-            mlc_pos = np.array(cp.MLCLeafPositions.RawData.Points).astype(float)
-            mlc_pos = np.fliplr(mlc_pos.reshape(60,2).transpose())
-            mlc_pos[0] = -10.0 * mlc_pos[0]
-            mlc_pos[1] =  10.0 * mlc_pos[1]
-            #print(np.around(mlc_pos,1))
-            ds_mlc.LeafJawPositions = np.around(mlc_pos.flatten(),1).tolist()
+            ds_mlc.LeafJawPositions = mlcpos
             seq.append(ds_mlc)
         return seq
 
@@ -1069,7 +1512,10 @@ class PFDicom():
         seq = pydicom.sequence.Sequence()
         cp_idx = 0 #idx_beam * 100
         cp_wgt = 0.0
-        ctrl_points = beam.CPManager.CPManagerObject[0].ControlPointList.ControlPoint
+        cpm = beam.CPManager.CPManagerObject[0]
+        ctrl_points = cpm.ControlPointList.ControlPoint
+        # jaws and MLC converted once for the beam
+        (jawx, jawy, mlcpos) = self._getLeafJawPositions(cpm)
         # Wedge info if it exists
         wdg = ctrl_points[0].WedgeContext
         if wdg.WedgeName.upper() != 'NO WEDGE':
@@ -1085,7 +1531,7 @@ class PFDicom():
             elif wdg.Orientation == 'WedgeLeftToRight':
                 ds_wdg.WedgePosition = 'IN'
             wdgpos_seq.append(ds_wdg)
-        for cp in ctrl_points:
+        for (icp, cp) in enumerate(ctrl_points):
             ds_cp = Dataset()
             ds_cp.ControlPointIndex = cp_idx
             ds_cp.CumulativeMetersetWeight = str('%8.4f' % cp_wgt)
@@ -1095,7 +1541,7 @@ class PFDicom():
             if wdg.WedgeName.upper() != 'NO WEDGE':
                 ds_cp.WedgePositionSequence = wdgpos_seq
 
-            ds_cp.BeamLimitingDevicePositionSequence = self._getBeamLimitingDevicePositionSequence(cp)
+            ds_cp.BeamLimitingDevicePositionSequence = self._getBeamLimitingDevicePositionSequence(jawx[icp], jawy[icp], mlcpos[icp])
             ds_cp.GantryAngle = cp.Gantry
             ds_cp.GantryRotationDirection = 'NONE'
             ds_cp.BeamLimitingDeviceAngle = cp.Collimator
@@ -1145,10 +1591,13 @@ class PFDicom():
 
         return seq
 
-    def _setRTBeamsModule(self, ds, trial): # The most important module ?
-        ds.BeamSequence = pydicom.sequence.Sequence()
-        beam_idx = 0
-        for beam in trial.BeamList.Beam:
+    # beams (with their control points) are added to ds.BeamSequence, numbered
+    # on from the ones already there, as they are streamed by createDicomRP
+    def _setRTBeamsModule(self, ds, beams): # The most important module ?
+        if 'BeamSequence' not in ds:
+            ds.BeamSequence = pydicom.sequence.Sequence()
+        beam_idx = len(ds.BeamSequence)
+        for beam in beams:
             beam_idx += 1
             ds_bm = Dataset()
             ds_bm.Manufacturer = dcmcommon.TreatDeviceManufacturer
@@ -1222,40 +1671,55 @@ class PFDicom():
             ds_bm.ReferencedToleranceTableNumber = 0
             ds.BeamSequence.append(ds_bm)
 
-    def createDicomRP(self, planid=0):
-        self._initializeForDicom('RP', planid)
+    def _getRPDataset(self, trial):
+        self._generateUIDs(trial)
 
-        for trial in self.PlanTrial.Trial:
-            self._generateUIDs(trial)
+        file_meta = FileMetaDataset()
+        file_meta.TransferSyntaxUID = self.TransferSyntaxUID
+        file_meta.MediaStorageSOPClassUID    = self.StorageSOPClassUID
+        file_meta.MediaStorageSOPInstanceUID = self.StorageSOPInstanceUID
 
-            file_meta = FileMetaDataset()
-            file_meta.TransferSyntaxUID = self.TransferSyntaxUID
-            file_meta.MediaStorageSOPClassUID    = self.StorageSOPClassUID
-            file_meta.MediaStorageSOPInstanceUID = self.StorageSOPInstanceUID
+        ofname = '%s/RP_%s_%s.%s.dcm' % (self.OutPath, str(self.PlanID).zfill(3), 
+            str(trial.TrialID).zfill(3), self.RDSOPInstanceUID)
+        ds = FileDataset(ofname, {}, file_meta=file_meta, preamble=self.Preamble)
 
-            ofname = '%s/RP_%s_%s.%s.dcm' % (self.OutPath, str(planid).zfill(3), 
-                str(trial.TrialID).zfill(3), self.RDSOPInstanceUID)
-            ds = FileDataset(ofname, {}, file_meta=file_meta, preamble=self.Preamble)
-
-            self._setSOPCommon(ds)
-            self._setPatientModule(ds)
-            self._setFrameOfReference(ds)
-            self._setStudyModule(ds)
-            self._setSeriesModule(ds)
-            self._setEquipmentModule(ds)
-            self._setInstanceUID(ds, self.RPSOPInstanceUID)
-
-            self._setRTGeneralPlanModule(ds, trial)
-            self._setRTPrescriptionModule(ds, trial)
-            # self._setToleranceTablesModule(ds)
-            self._setRTPatientSetupModule(ds)
-            self._setRTFractionSchemeModule(ds, trial)
-            self._setRTBeamsModule(ds, trial)
+        self._setSOPCommon(ds)
+        self._setPatientModule(ds)
+        self._setFrameOfReference(ds)
+        self._setStudyModule(ds)
+        self._setSeriesModule(ds)
+        self._setEquipmentModule(ds)
+        self._setInstanceUID(ds, self.RPSOPInstanceUID)
 
-            pydicom.dataset.validate_file_meta(ds.file_meta, enforce_standard=True)
-            ds.save_as(ofname, write_like_original=False)
-            logging.info('RP DICOM file saved: %s' % ofname)
-            print('RP DICOM file saved: %s' % ofname)
+        self._setRTGeneralPlanModule(ds, trial)
+        self._setRTPrescriptionModule(ds, trial)
+        # self._setToleranceTablesModule(ds)
+        self._setRTPatientSetupModule(ds)
+        self._setRTFractionSchemeModule(ds, trial)
+        self._setRTBeamsModule(ds, [])
+        return ds
+
+    def _saveRP(self, ds):
+        pydicom.dataset.validate_file_meta(ds.file_meta, enforce_standard=True)
+        ds.save_as(ds.filename, write_like_original=False)
+        logging.info('RP DICOM file saved: %s' % ds.filename)
+        print('RP DICOM file saved: %s' % ds.filename)
+
+    # The beams of all trials come from one pass over plan.Trial, the beams of
+    # one trial there (and of its split copies) after each other. An RP is saved
+    # once the pass is past its trial, so only one trial's RPs are held at a time.
+    def createDicomRP(self, planid=0):
+        self._initializeForDicom('RP', planid)
+
+        plans = {}
+        for (trial, beam) in self.getPlanSession(planid).iterBeams():
+            for trialid in [k for (k, (t, ds)) in plans.items() if t.TrialIndex != trial.TrialIndex]:
+                self._saveRP(plans.pop(trialid)[1])
+            if trial.TrialID not in plans:
+                plans[trial.TrialID] = (trial, self._getRPDataset(trial))
+            self._setRTBeamsModule(plans[trial.TrialID][1], [beam])
+        for (trial, ds) in plans.values():
+            self._saveRP(ds)
 
 if __name__ == '__main__':
     prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
@@ -5,6 +5,7 @@ from typing import (List, Optional)
 from pydantic import BaseModel
 import logging
 from pftools.readPFile import readPFile
+from pftools.PFModel import buildModel
 
 class _ImageInfo(BaseModel):
     SliceNumber: int
@@ -24,7 +25,7 @@ class PFImgInfo(BaseModel):
 def readImageInfo(pfpath, imgsetid=0):
     fname = '%s/ImageSet_%s.ImageInfo' % (pfpath, imgsetid)
     pdict = readPFile(fname, 'ImageSet.ImageInfo', 'dict')
-    pfObj = PFImgInfo(**pdict)
+    pfObj = buildModel(PFImgInfo, pdict)
     return pfObj
 
 
@@ -5,6 +5,7 @@ from typing import (List, Optional)
 from pydantic import BaseModel
 import logging
 from pftools.readPFile import readPFile
+from pftools.PFModel import buildModel
 
 class PFImgSetHeader(BaseModel):
     x_dim: int
@@ -13,6 +14,7 @@ class PFImgSetHeader(BaseModel):
     datatype: Optional[int]
     bitpix: Optional[int]
     bytes_pix: Optional[int]
+    byte_order: Optional[int] = 0
     x_pixdim: float
     y_pixdim: float
     z_pixdim: float
@@ -38,7 +40,7 @@ class PFImgSetHeader(BaseModel):
 def readImageSetHeader(pfpath, imgsetid=0):
     fname = '%s/ImageSet_%s.header' % (pfpath, imgsetid)
     pdict = readPFile(fname, 'ImageSet.header', 'dict')
-    pfObj = PFImgSetHeader(**pdict)
+    pfObj = buildModel(PFImgSetHeader, pdict)
     return pfObj
 
 
@@ -5,6 +5,7 @@ from typing import (List, Optional)
 from pydantic import BaseModel
 import logging
 from pftools.readPFile import readPFile
+from pftools.PFModel import buildModel
 
 class PFImageSetInfo(BaseModel):
     ImageSetID: int
@@ -21,7 +22,7 @@ class PFImageSetInfo(BaseModel):
 def readImageSetInfo(pfpath, imgsetid):
     fname = '%s/ImageSet_%s.ImageSet' % (pfpath, imgsetid)
     pdict = readPFile(fname, 'plan.ImageSet', 'dict')
-    pfObj = PFImageSetInfo(**pdict)
+    pfObj = buildModel(PFImageSetInfo, pdict)
     return pfObj
 
 
@@ -0,0 +1,140 @@
+'''
+PFImgSlices
+
+CT pixels of an ImageSet, one slice at a time. Two layouts are found in backups:
+
+1. ImageSet_N.img --- all slices in one file, stored as HU+1000.
+   The file is memory-mapped as (nz, ny, nx) and -1000 is applied per slice.
+
+2. ImageSet_N.DICOM/<prefix>.<SliceNumber>.img --- one file per slice, each with
+   a leading header (a DICOM header in the examples) followed by the pixels,
+   stored as HU. The header size is taken from the file size minus
+   x_dim*y_dim*bytes_pix, so it is skipped without being parsed.
+
+Slices are indexed in ImageInfo order and read only when asked for, so a whole
+study is never held in memory.
+'''
+
+import os
+import re
+import sys
+import logging
+import numpy as np
+from abc import ABC, abstractmethod
+
+def _getPixelType(header):
+    bitpix = header.bitpix
+    if   bitpix == 16: dtype = np.int16
+    elif bitpix == 8:  dtype = np.int8
+    elif bitpix == 32: dtype = np.int32
+    else: dtype = np.short
+    # byte_order 0 is little endian
+    return np.dtype(dtype).newbyteorder('>' if header.byte_order == 1 else '<')
+
+# Base of the two layouts, which only differ in how a stored slice is read
+class PFSliceSource(ABC):
+    def __init__(self, nx, ny, dtype, hu_offset=0) -> None:
+        self.nx = nx
+        self.ny = ny
+        self.dtype = dtype
+        self.HUOffset = hu_offset
+        self.NumberOfSlices = 0
+
+    # slice index as stored, shaped (ny, nx), in the file byte order
+    @abstractmethod
+    def _readSlice(self, index) -> np.ndarray:
+        pass
+
+    # slice index in HU, shaped (ny, nx), in native byte order
+    def getSlice(self, index) -> np.ndarray:
+        if index < 0 or index >= self.NumberOfSlices:
+            raise IndexError('Slice %s out of range (%s slices)' % (index, self.NumberOfSlices))
+        data = self._readSlice(index)
+        if self.HUOffset != 0:
+            return data + self.HUOffset
+        return data.astype(data.dtype.newbyteorder('='), copy=False)
+
+    # slice index as stored, HU - HUOffset, in native byte order. For a native
+    # ImageSet_N.img this is a view of the memory-mapped volume, not a copy.
+    def getStoredSlice(self, index) -> np.ndarray:
+        if index < 0 or index >= self.NumberOfSlices:
+            raise IndexError('Slice %s out of range (%s slices)' % (index, self.NumberOfSlices))
+        data = self._readSlice(index)
+        return data.astype(data.dtype.newbyteorder('='), copy=False)
+
+# ImageSet_N.img
+class PFVolumeSliceSource(PFSliceSource):
+    def __init__(self, datafile, nx, ny, dtype, nimages) -> None:
+        super().__init__(nx, ny, dtype, -1000)
+        self.DataFile = datafile
+        nz = os.path.getsize(datafile) // (nx*ny*dtype.itemsize)
+        if nz != nimages:
+            logging.warning('%s has %s slices, but %s images are expected.' % (datafile, nz, nimages))
+        self.NumberOfSlices = min(nz, nimages)
+        self.Data = np.memmap(datafile, dtype, mode='r', shape=(nz, ny, nx))
+
+    def _readSlice(self, index) -> np.ndarray:
+        return self.Data[index]
+
+# ImageSet_N.DICOM/<prefix>.<SliceNumber>.img
+class PFDirSliceSource(PFSliceSource):
+    def __init__(self, slicedir, nx, ny, dtype, slicenumbers) -> None:
+        super().__init__(nx, ny, dtype, 0)
+        self.SliceDir = slicedir
+        files = {}
+        for fname in os.listdir(slicedir):
+            m = re.match(r'^.*\.([0-9]+)\.img$', fname)
+            if m:
+                files[int(m.group(1))] = fname
+        self.SliceFiles = []
+        for sn in slicenumbers:
+            if sn not in files:
+                logging.error('No file for slice %s in %s' % (sn, slicedir))
+                raise FileNotFoundError('No file for slice %s in %s' % (sn, slicedir))
+            self.SliceFiles.append(os.path.join(slicedir, files[sn]))
+        self.NumberOfSlices = len(self.SliceFiles)
+
+    def _readSlice(self, index) -> np.ndarray:
+        fname = self.SliceFiles[index]
+        npix = self.nx*self.ny
+        header_size = os.path.getsize(fname) - npix*self.dtype.itemsize
+        if header_size < 0:
+            logging.error('%s is too small for a %sx%s slice' % (fname, self.nx, self.ny))
+            raise ValueError('%s is too small for a %sx%s slice' % (fname, self.nx, self.ny))
+        data = np.fromfile(fname, self.dtype, count=npix, offset=header_size)
+        return data.reshape((self.ny, self.nx))
+
+# Returns None if the ImageSet has no pixel data in either layout.
+def openImageSlices(pfpath, imgsetid, header, imageinfo):
+    nx = header.x_dim
+    ny = header.y_dim
+    dtype = _getPixelType(header)
+
+    datafile = '%s/ImageSet_%s.img' % (pfpath, imgsetid)
+    if os.path.isfile(datafile):
+        return PFVolumeSliceSource(datafile, nx, ny, dtype, len(imageinfo))
+
+    slicedir = '%s/ImageSet_%s.DICOM' % (pfpath, imgsetid)
+    if os.path.isdir(slicedir):
+        return PFDirSliceSource(slicedir, nx, ny, dtype, [info.SliceNumber for info in imageinfo])
+
+    return None
+
+
+if __name__ == '__main__':
+    prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+    sys.path.insert(0, prjpath)
+    from pftools.PFImgSetHeader import readImageSetHeader
+    from pftools.PFImgInfo import readImageInfo
+
+    FORMAT = "[%(asctime)s %(levelname)s - %(funcName)s] %(message)s"
+    logging.basicConfig(format=FORMAT, filename=prjpath+'logs/test.log', level=logging.INFO)
+
+    pfpath = prjpath+'examples/Patient_6204'
+    header = readImageSetHeader(pfpath, 0)
+    imageinfo = readImageInfo(pfpath, 0).ImageInfo
+    slices = openImageSlices(pfpath, 0, header, imageinfo)
+    print(type(slices).__name__, slices.NumberOfSlices)
+    for i in [0, slices.NumberOfSlices-1]:
+        data = slices.getSlice(i)
+        print(i, imageinfo[i].SliceNumber, data.shape, data.dtype, data.min(), data.max())
@@ -0,0 +1,171 @@
+'''
+PFModel
+
+Builds the pydantic models from readPFile dicts without validating them.
+
+readPFile gives every value as a string, and Model(**pdict) has pydantic
+validate and coerce each of them, down through every control point and curve.
+buildModel() trusts the parser instead: each value is converted once by the
+type of its field (str, int, float, nested models and lists of them) and the
+models are made with construct(). The result is equal to the validated model.
+
+Fields with other types (np.ndarray, bool, Any ...) still go through their own
+pydantic field validation, and so do values the fast path cannot convert. If
+any of them fails, the whole dict is validated by pydantic to raise the usual
+ValidationError.
+
+Full validation can be turned on for debugging with enableValidation().
+
+Models holding np.ndarray values derive from PFArrayModel, which compares the
+arrays with np.array_equal and writes them to json as lists.
+'''
+
+import os
+import sys
+import time
+import logging
+import numpy as np
+from typing import Any
+from pydantic import BaseModel, Extra
+from pydantic.fields import SHAPE_SINGLETON, SHAPE_LIST
+
+class _Untrusted(Exception):
+    pass
+
+# (name, kind, field) per model class, kind being str, int, float, 'model',
+# 'models', 'list' or 'field' (pydantic field validation). None for classes
+# the fast path does not build: post root validators or extra keys not ignored.
+_plans = {}
+
+def _getFieldPlan(cls):
+    if cls in _plans:
+        return _plans[cls]
+    plan = []
+    for (name, field) in cls.__fields__.items():
+        kind = 'field'
+        if field.alias != name or field.class_validators or field.pre_validators or field.post_validators:
+            pass
+        elif field.shape == SHAPE_SINGLETON and field.type_ in (str, int, float):
+            kind = field.type_
+        elif field.shape == SHAPE_SINGLETON and isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+            kind = 'model'
+        elif field.shape == SHAPE_LIST and isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+            kind = 'models'
+        elif field.shape == SHAPE_LIST and field.type_ is Any:
+            kind = 'list'
+        plan.append((name, kind, field))
+    if len(cls.__post_root_validators__) > 0 or cls.__config__.extra != Extra.ignore:
+        plan = None
+    _plans[cls] = plan
+    return plan
+
+def _construct(cls, data):
+    plan = _getFieldPlan(cls)
+    if plan is None or not isinstance(data, dict):
+        raise _Untrusted()
+    try:
+        for validator in cls.__pre_root_validators__:
+            data = validator(cls, data)
+    except (ValueError, TypeError):
+        raise _Untrusted()
+
+    values = {}
+    for (name, kind, field) in plan:
+        if name not in data:
+            if field.required:
+                raise _Untrusted()
+            continue
+        value = data[name]
+        try:
+            if value is None:
+                if not field.allow_none:
+                    raise _Untrusted()
+            elif kind is str:
+                if type(value) is not str:
+                    raise _Untrusted()
+            elif kind is int or kind is float:
+                if type(value) is not str:
+                    raise _Untrusted()
+                value = kind(value)
+            elif kind == 'model':
+                value = _construct(field.type_, value)
+            elif kind == 'models':
+                if type(value) is not list:
+                    raise _Untrusted()
+                value = [_construct(field.type_, item) for item in value]
+            elif kind == 'list':
+                if type(value) is not list:
+                    raise _Untrusted()
+                value = list(value)
+            else:
+                raise _Untrusted()
+        except (_Untrusted, ValueError, TypeError):
+            (value, errors) = field.validate(data[name], values, loc=name, cls=cls)
+            if errors:
+                raise _Untrusted()
+        values[name] = value
+    return cls.construct(_fields_set=set(values), **values)
+
+# a == b for dicts, lists and arrays from model.dict(); NaN equals NaN in arrays
+def _isEqual(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        if a is None or b is None:
+            return a is b
+        try:
+            return np.array_equal(a, b, equal_nan=True)
+        except TypeError:
+            return np.array_equal(a, b)
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all([_isEqual(a[k], b[k]) for k in a])
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all([_isEqual(x, y) for (x, y) in zip(a, b)])
+    return a == b
+
+class PFArrayModel(BaseModel):
+    class Config:
+        arbitrary_types_allowed = True
+        json_encoders = {np.ndarray: lambda a: a.tolist()}
+
+    # as BaseModel.__eq__, with the arrays compared by value
+    def __eq__(self, other):
+        if isinstance(other, BaseModel):
+            return _isEqual(self.dict(), other.dict())
+        return _isEqual(self.dict(), other)
+
+# Validate every model, for debugging. Off by default.
+_validate = False
+
+def enableValidation():
+    global _validate
+    _validate = True
+    logging.info('pydantic validation of the Pinnacle models enabled')
+
+def disableValidation():
+    global _validate
+    _validate = False
+
+def buildModel(cls, pdict, validate=None):
+    if validate is None:
+        validate = _validate
+    if not validate:
+        try:
+            return _construct(cls, pdict)
+        except _Untrusted:
+            logging.warning('%s not built on the fast path, validating it instead.' % cls.__name__)
+    return cls(**pdict)
+
+
+if __name__ == '__main__':
+    prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+    sys.path.insert(0, prjpath)
+    from pftools.readPFile import readPFile
+    from pftools.PFPlanTrial import PFPlanTrial
+
+    FORMAT = "[%(asctime)s %(levelname)s - %(funcName)s] %(message)s"
+    logging.basicConfig(format=FORMAT, filename=prjpath+'logs/test.log', level=logging.INFO)
+
+    pdict = readPFile(prjpath+'examples/Patient_4604/Plan_0/plan.Trial', 'plan.Trial')
+    for validate in [True, False]:
+        t0 = time.perf_counter()
+        trial = buildModel(PFPlanTrial, pdict, validate)
+        print('validate=%s: %.1f ms' % (validate, (time.perf_counter()-t0)*1000))
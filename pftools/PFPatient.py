@@ -5,6 +5,7 @@ from typing import (List, Optional)
 from pydantic import BaseModel
 import logging
 from pftools.readPFile import readPFile
+from pftools.PFModel import buildModel
 from pftools.PFObjectVersion import _ObjectVersion
 
 class _ImageSet(BaseModel):
@@ -49,7 +50,7 @@ class PFPatient(BaseModel):
 def readPatient(pfpath):
     fname = '%s/Patient' % pfpath
     pdict = readPFile(fname, 'Patient', 'dict')
-    pfObj = PFPatient(**pdict)
+    pfObj = buildModel(PFPatient, pdict)
     return pfObj
 
 
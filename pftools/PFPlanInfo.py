@@ -5,6 +5,7 @@ from typing import (List, Optional)
 from pydantic import BaseModel
 import logging
 from pftools.readPFile import readPFile
+from pftools.PFModel import buildModel
 
 class PFPlanInfo(BaseModel):
     PatientName = ''
@@ -22,7 +23,7 @@ class PFPlanInfo(BaseModel):
 def readPlanInfo(pfpath, planid=0):
     fname = '%s/Plan_%s/plan.PlanInfo' % (pfpath, planid)
     pdict = readPFile(fname, 'plan.PlanInfo', 'dict')
-    pfObj = PFPlanInfo(**pdict)
+    pfObj = buildModel(PFPlanInfo, pdict)
     return pfObj
 
 
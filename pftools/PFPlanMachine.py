@@ -5,6 +5,7 @@ from typing import (List, Optional)
 from pydantic import BaseModel
 import logging
 from pftools.readPFile import readPFile
+from pftools.PFModel import buildModel
 
 # class _CouchAngle(BaseModel):
 #     Name = ''
@@ -127,10 +128,19 @@ class _Machine(BaseModel):
 class PFMachine(BaseModel):
     Machine: List[_Machine] = None
 
-def readMachine(pfpath, planid=0):
+# Only the keys PFMachine has, for readMachine(..., lightweight=True)
+MACHINE_LIGHTWEIGHT_INCLUDE = [
+    '#*/Name', '#*/MachineType', '#*/CommissionedFor*', '#*/SAD', '#*/SourceToBlockTrayDistance',
+    '#*/*EnergyList/MachineEnergy/Value', '#*/*EnergyList/MachineEnergy/Id',
+    '#*/*EnergyList/MachineEnergy/Name', '#*/*EnergyList/MachineEnergy/PhysicsData/OutputFactor'
+]
+
+# lightweight: read only what PFMachine holds; the result is the same
+def readMachine(pfpath, planid=0, lightweight=False):
     fname = '%s/Plan_%s/plan.Pinnacle.Machines' % (pfpath, planid)
-    pdict = readPFile(fname, 'plan.Machine', 'dict')
-    pfObj = PFMachine(**pdict)
+    include = MACHINE_LIGHTWEIGHT_INCLUDE if lightweight else None
+    pdict = readPFile(fname, 'plan.Machine', 'dict', include=include)
+    pfObj = buildModel(PFMachine, pdict)
     return pfObj
 
 
@@ -5,6 +5,7 @@ from typing import (List, Optional)
 from pydantic import BaseModel
 import logging
 from pftools.readPFile import readPFile
+from pftools.PFModel import buildModel
 from pftools.PFObjectVersion import _ObjectVersion
 
 class PFPlanPatientSetup(BaseModel):
@@ -17,7 +18,7 @@ class PFPlanPatientSetup(BaseModel):
 def readPlanPatientSetup(pfpath, planid=0):
     fname = '%s/Plan_%s/plan.PatientSetup' % (pfpath, planid)
     pdict = readPFile(fname, 'plan.PatientSetup', 'dict')
-    pfObj = PFPlanPatientSetup(**pdict)
+    pfObj = buildModel(PFPlanPatientSetup, pdict)
     return pfObj
 
 
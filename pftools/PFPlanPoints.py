@@ -5,6 +5,7 @@ from typing import (List, Optional)
 from pydantic import BaseModel
 import logging
 from pftools.readPFile import readPFile
+from pftools.PFModel import buildModel
 from pftools.PFObjectVersion import _ObjectVersion
 
 class _POI(BaseModel):
@@ -28,7 +29,7 @@ class PFPlanPoints(BaseModel):
 def readPlanPoints(pfpath, planid=0):
     fname = '%s/Plan_%s/plan.Points' % (pfpath, planid)
     pdict = readPFile(fname, 'plan.Points', 'dict')
-    pfObj = PFPlanPoints(**pdict)
+    pfObj = buildModel(PFPlanPoints, pdict)
     return pfObj
 
 
@@ -1,32 +1,61 @@
 import os
 import sys
 from datetime import datetime
-from typing import (List, Optional)
-from pydantic import BaseModel
+from typing import (Any, List, Optional)
+from pydantic import BaseModel, root_validator
 import logging
-from pftools.readPFile import readPFile
+import numpy as np
+from pftools.readPFile import readPFile, _setROIPoints
+from pftools.PFModel import buildModel, PFArrayModel
 
-class _Curve(BaseModel):
+class _Curve(PFArrayModel):
     blocksize: Optional[float]
     num_points: Optional[int]
-    points: Optional[List] = []
+    # flat [x,y,z,...] view into _ROI.points
+    points: Optional[Any] = []
 
-class _ROI(BaseModel):
+class _ROI(PFArrayModel):
     name: str
     density: Optional[float]
     density_units: Optional[str] = ''
     color = ''
     num_curve: Optional[int]
     curve: List[_Curve]
+    # all points of the ROI, (N,3); curve i is points[curve_offsets[i]:curve_offsets[i+1]]
+    points: Optional[np.ndarray] = None
+    curve_offsets: Optional[np.ndarray] = None
 
-class PFPlanROI(BaseModel):
+    # Make the curves views into one array, also when built from plain point lists.
+    @root_validator(pre=True)
+    def _packCurvePoints(cls, values):
+        curves = values.get('curve')
+        if not curves:
+            return values
+        curves = [dict(curve) if isinstance(curve, dict) else curve.dict() for curve in curves]
+        values = dict(values, curve=curves)
+        if isinstance(values.get('points'), np.ndarray) and values.get('curve_offsets') is not None:
+            coords = np.ascontiguousarray(values['points'], dtype=np.float64).ravel()
+            ncoords = np.diff(values['curve_offsets']) * 3
+        else:
+            pts = [np.asarray(curve.get('points') if curve.get('points') is not None else [],
+                              dtype=np.float64).ravel() for curve in curves]
+            coords = np.concatenate(pts) if len(pts) > 0 else np.zeros(0)
+            ncoords = [p.size for p in pts]
+        _setROIPoints(values, coords, ncoords)
+        return values
+
+    # z of the first point of each curve, in cm
+    def getCurveZ(self) -> np.ndarray:
+        return self.points[self.curve_offsets[:-1], 2]
+
+class PFPlanROI(PFArrayModel):
     roi: List[_ROI] = None
 
 def readPlanROI(pfpath, planid=0):
     fname = '%s/Plan_%s/plan.roi' % (pfpath, planid)
     pdict = readPFile(fname, 'plan.roi', 'dict')
     if pdict is None: return None
-    pfObj = PFPlanROI(**pdict)
+    pfObj = buildModel(PFPlanROI, pdict)
     return pfObj
 
 
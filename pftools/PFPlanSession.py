@@ -0,0 +1,196 @@
+'''
+PFPlanSession
+
+All the Pinnacle files needed to convert one plan (RS, RD and RP), each read
+once, plan.Trial twice (see below). Files are read on first use, so a session
+only used for RS never touches plan.Trial or plan.Pinnacle.Machines.
+
+plan.Trial is prepared for DICOM right after reading: prescriptions are linked
+to the beams and trials with more than one prescription are split. This is done
+once per session, and RD and RP work on the same split trials.
+
+The session's plan.Trial is read without the control points, the bulk of the
+file, so the beams in PlanTrial have CPManager None. RP gets them from
+iterBeams(), one more pass over plan.Trial for all trials, which streams the
+beams one at a time; only one beam's control points are held at a time.
+
+LoadCounts counts the reads per file, named relative to the patient folder,
+e.g. LoadCounts['Plan_0/plan.Trial'], the passes of iterBeams() included.
+
+DoseCache keeps the beam dose volumes of the plan, so a beam in several
+(split) trials is read and scaled once.
+'''
+
+import os
+import sys
+import copy
+import logging
+
+import pftools.common_dcm_settings as dcmcommon
+
+from pftools.PFImgSetHeader import readImageSetHeader
+from pftools.PFImgInfo import readImageInfo
+from pftools.PFImgSetInfo import readImageSetInfo
+from pftools.PFPlanInfo import readPlanInfo
+from pftools.PFPlanPatientSetup import readPlanPatientSetup
+from pftools.PFPlanPoints import readPlanPoints
+from pftools.PFPlanROI import readPlanROI
+from pftools.PFPlanTrial import readPlanTrial, iterBeams
+from pftools.PFPlanMachine import readMachine
+from pftools.PFTrialBinary import PFDoseCache
+
+# make each beam contains the correct prescription info
+def linkPrescriptionToBeam(plantrial):
+    for trial in plantrial.Trial:
+        # remove trials with no beams
+        if trial.BeamList.Beam is None:
+            plantrial.Trial.remove(trial)
+            continue
+        for beam in trial.BeamList.Beam:
+            for presc in trial.PrescriptionList.Prescription:
+                if beam.PrescriptionName == presc.Name:
+                    beam.Prescription = presc
+                    break
+
+def splitTrialOnPrescription(plantrial):
+    # remove imaging trials
+    for trial in plantrial.Trial:
+        if 'imaging' in trial.Name.lower() or 'image' in trial.Name.lower():
+            plantrial.Trial.remove(trial)
+    # remove imaging fields
+    for trial in plantrial.Trial:
+        for beam in trial.BeamList.Beam:
+            if 'image' in beam.Name:
+                plantrial.Trial.remove(beam)
+
+    # split each trial based on prescription
+    ntrial = len(plantrial.Trial)
+    for itri in range(ntrial):
+        trials = plantrial.Trial
+
+        # get all prescriptions in beams
+        presc_list = [trials[itri].BeamList.Beam[0].Prescription.Name]
+        for beam in trials[itri].BeamList.Beam:
+            if beam.Prescription.Name not in presc_list:
+                presc_list.append(beam.Prescription.Name)
+
+        if dcmcommon.debug:
+            print('-- Prescriptions in Trial ' + trials[itri].Name + ": " + str(presc_list))
+
+        if len(presc_list) == 1: continue
+
+        # For more than one presc, split the trial
+        for prsc_name in presc_list:
+            trial_copy = copy.deepcopy(trials[itri])
+            trial_copy.Name = trials[itri].Name + "_" + prsc_name
+            for beam in trial_copy.BeamList.Beam:
+                if beam.Prescription.Name != prsc_name:
+                    beam.Removable = True
+            trials.append(trial_copy)
+        trials[itri].Removable = True  # flag the original trial for removal
+    # end of splitting trials
+
+    # remove the flagged trials
+    for trial in plantrial.Trial:
+        if trial.Removable:
+            plantrial.Trial.remove(trial)
+
+    # Set TrialID for easy reference later; and remove flagged beams
+    for itri in range(len(plantrial.Trial)):
+        plantrial.Trial[itri].TrialID = itri
+        beams = plantrial.Trial[itri].BeamList.Beam
+        # remove() not working for unknown reason. pop() is used here.
+        for ibeam in reversed(range(len(beams))):
+            if beams[ibeam].Removable:
+                plantrial.Trial[itri].BeamList.Beam.pop(ibeam)
+
+class PFPlanSession():
+    def __init__(self, pfpath, planid=0, imgsetid=0) -> None:
+        self.PFPath = pfpath
+        self.PlanID = planid
+        self.ImageSetID = imgsetid
+        self.LoadCounts = {}
+        self._loaded = {}
+        self.DoseCache = PFDoseCache()
+
+    def _count(self, fname):
+        logging.info('Session for Plan_%s reading %s' % (self.PlanID, fname))
+        self.LoadCounts[fname] = self.LoadCounts.get(fname, 0) + 1
+
+    def _load(self, fname, reader, id):
+        if fname not in self._loaded:
+            self._count(fname)
+            self._loaded[fname] = reader(self.PFPath, id)
+        return self._loaded[fname]
+
+    @property
+    def ImgSetHeader(self):
+        return self._load('ImageSet_%s.header' % self.ImageSetID, readImageSetHeader, self.ImageSetID)
+
+    @property
+    def ImgSetInfo(self):
+        return self._load('ImageSet_%s.ImageSet' % self.ImageSetID, readImageSetInfo, self.ImageSetID)
+
+    @property
+    def ImageInfo(self):
+        return self._load('ImageSet_%s.ImageInfo' % self.ImageSetID, readImageInfo, self.ImageSetID).ImageInfo
+
+    @property
+    def PlanPatientSetup(self):
+        return self._load('Plan_%s/plan.PatientSetup' % self.PlanID, readPlanPatientSetup, self.PlanID)
+
+    @property
+    def PlanInfo(self):
+        return self._load('Plan_%s/plan.PlanInfo' % self.PlanID, readPlanInfo, self.PlanID)
+
+    @property
+    def PlanPoints(self):
+        return self._load('Plan_%s/plan.Points' % self.PlanID, readPlanPoints, self.PlanID)
+
+    @property
+    def PlanROI(self):
+        return self._load('Plan_%s/plan.roi' % self.PlanID, readPlanROI, self.PlanID)
+
+    # trials are linked to prescriptions and split right after reading
+    @property
+    def PlanTrial(self):
+        fname = 'Plan_%s/plan.Trial' % self.PlanID
+        if fname not in self._loaded:
+            plantrial = self._load(fname, lambda pfpath, id: readPlanTrial(pfpath, id, lightweight=True), self.PlanID)
+            linkPrescriptionToBeam(plantrial)
+            splitTrialOnPrescription(plantrial)
+        return self._loaded[fname]
+
+    # (trial, beam) for the beams of all trials in PlanTrial, each beam with its
+    # control points, from one pass over plan.Trial. A beam of a split trial
+    # comes once for each copy. The beams come in file order, so the beams of a
+    # trial in plan.Trial, split copies included, all come before the next one's.
+    def iterBeams(self):
+        fname = 'Plan_%s/plan.Trial' % self.PlanID
+        targets = {}
+        for trial in self.PlanTrial.Trial:
+            for beam in trial.BeamList.Beam:
+                targets.setdefault((trial.TrialIndex, beam.BeamIndex), []).append((trial, beam))
+        self._count(fname)
+        for (trialindex, full) in iterBeams(self.PFPath, self.PlanID):
+            for (trial, beam) in targets.get((trialindex, full.BeamIndex), []):
+                yield (trial, beam.copy(update={'CPManager': full.CPManager}))
+
+    @property
+    def PlanMachine(self):
+        return self._load('Plan_%s/plan.Pinnacle.Machines' % self.PlanID, readMachine, self.PlanID)
+
+
+if __name__ == '__main__':
+    prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+
+    FORMAT = "[%(asctime)s %(levelname)s - %(funcName)s] %(message)s"
+    logging.basicConfig(format=FORMAT, filename=prjpath+'logs/test.log', level=logging.INFO)
+
+    session = PFPlanSession(prjpath+'examples/Patient_4604', 0, 0)
+    for trial in session.PlanTrial.Trial:
+        print(trial.TrialID, trial.Name, [beam.Name for beam in trial.BeamList.Beam])
+    for (trial, beam) in session.iterBeams():
+        print(trial.TrialID, beam.Name, len(beam.CPManager.CPManagerObject[0].ControlPointList.ControlPoint))
+    print(session.PlanMachine.Machine[0].Name)
+    print(session.LoadCounts)
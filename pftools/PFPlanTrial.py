@@ -1,17 +1,20 @@
 import os
 import sys
 from datetime import datetime
-from typing import (Dict, List, Optional)
-from pydantic import BaseModel
+from typing import (Any, Dict, List, Optional)
+from pydantic import BaseModel, Field, root_validator
 import logging
+import numpy as np
 
-from pftools.readPFile import readPFile
+from pftools.readPFile import readPFile, iterPFBlocks
+from pftools.PFModel import buildModel, PFArrayModel
 from pftools.PFObjectVersion import _ObjectVersion
 
-class _RawData(BaseModel):
+class _RawData(PFArrayModel):
     NumberOfDimensions: Optional[int]
     NumberOfPoints: Optional[int]
-    Points: Optional[List] = []
+    # list of floats; for MLC leaf positions a flat view into _CPManagerObject.MLCLeafPositions
+    Points: Optional[Any] = []
 
 class _Curve(BaseModel):
     RawData: Optional[_RawData] = None
@@ -46,36 +49,144 @@ class _WedgeContext(BaseModel):
     MinDeliverableMU = 0
     MaxDeliverableMU = 1e+30
 
-class _MLCLeafPositions(BaseModel):
+class _MLCLeafPositions(PFArrayModel):
     RawData: Optional[_RawData] = None
 
-class _ControlPoint(BaseModel):
-    Gantry: Optional[float]
-    Couch: Optional[float]
-    Collimator: Optional[float]
-    LeftJawPosition: Optional[float]
-    RightJawPosition: Optional[float]
-    TopJawPosition: Optional[float]
-    BottomJawPosition: Optional[float]
-    Weight: Optional[float]
+# Gantry, Couch, Collimator, the jaws and Weight of a control point are not kept
+# in it: they are read from and written to the columns of its CPManagerObject,
+# None if unset. A control point made on its own gets columns of one row.
+_CP_COLUMNS = ['Gantry', 'Couch', 'Collimator', 'LeftJawPosition', 'RightJawPosition',
+               'TopJawPosition', 'BottomJawPosition', 'Weight']
+
+def _getCPValue(key):
+    def getValue(cp):
+        if cp.Columns is None:
+            return None
+        value = cp.Columns[key][cp.Index]
+        return None if np.isnan(value) else float(value)
+    return property(getValue)
+
+class _ControlPoint(PFArrayModel):
     WeightLocked: Optional[int]
     PercentOfArc: Optional[float]
     HasSharedModifierList: Optional[int]
     WedgeContext: Optional[_WedgeContext] = None
     ModifierList: Optional[_ModifierList] = None
     MLCLeafPositions: Optional[_MLCLeafPositions] = None
-
-class _ControlPointList(BaseModel):
+    # the columns of the CPManagerObject, by name, and the row of this point
+    Columns: Optional[Any] = Field(None, repr=False)
+    Index: Optional[int] = Field(None, repr=False)
+
+    Gantry = _getCPValue('Gantry')
+    Couch = _getCPValue('Couch')
+    Collimator = _getCPValue('Collimator')
+    LeftJawPosition = _getCPValue('LeftJawPosition')
+    RightJawPosition = _getCPValue('RightJawPosition')
+    TopJawPosition = _getCPValue('TopJawPosition')
+    BottomJawPosition = _getCPValue('BottomJawPosition')
+    Weight = _getCPValue('Weight')
+
+    @root_validator(pre=True)
+    def _setColumns(cls, values):
+        if values.get('Columns') is None and any([values.get(key) is not None for key in _CP_COLUMNS]):
+            values = dict(values, Columns=_getCPColumns([values]), Index=0)
+        return values
+
+    def __setattr__(self, name, value):
+        if name not in _CP_COLUMNS:
+            return super().__setattr__(name, value)
+        if self.Columns is None:
+            super().__setattr__('Columns', _getCPColumns([{}]))
+            super().__setattr__('Index', 0)
+        self.Columns[name][self.Index] = np.nan if value is None else float(value)
+
+    # dict() and json() give the column values in place of Columns and Index,
+    # as before they were columns
+    def _iter(self, to_dict=False, by_alias=False, include=None, exclude=None,
+              exclude_unset=False, exclude_defaults=False, exclude_none=False):
+        items = super()._iter(to_dict=to_dict, by_alias=by_alias, include=include, exclude=exclude,
+                              exclude_unset=exclude_unset, exclude_defaults=exclude_defaults,
+                              exclude_none=exclude_none)
+        if not to_dict:
+            yield from items
+            return
+        for (key, value) in items:
+            if key != 'Columns' and key != 'Index':
+                yield (key, value)
+        for key in _CP_COLUMNS:
+            if (include is not None and key not in include) or (exclude is not None and key in exclude):
+                continue
+            value = getattr(self, key)
+            if not (exclude_none and value is None):
+                yield (key, value)
+
+class _ControlPointList(PFArrayModel):
     ControlPoint: List[_ControlPoint]
 
-class _CPManagerObject(BaseModel):
+# one column of the control points, NaN where unset
+def _getCPColumn(cps, key):
+    return np.array([np.nan if cp.get(key) is None else float(cp[key]) for cp in cps], dtype=np.float64)
+
+def _getCPColumns(cps):
+    return dict([(key, _getCPColumn(cps, key)) for key in _CP_COLUMNS])
+
+# MLC leaf positions of all control points, (ncp, nleaf, 2), or None if not all have the same
+def _getCPLeafPositions(cps):
+    try:
+        points = [np.asarray(cp['MLCLeafPositions']['RawData']['Points'], dtype=np.float64) for cp in cps]
+    except (KeyError, TypeError, ValueError):
+        return None
+    if len(points) == 0 or any([p.ndim != 1 or p.size != points[0].size for p in points]) or points[0].size % 2 != 0:
+        return None
+    return np.stack(points).reshape(len(points), -1, 2)
+
+class _CPManagerObject(PFArrayModel):
     NumberOfControlPoints: Optional[int]
     ControlPointList: Optional[_ControlPointList] = None
     GantryIsCCW: Optional[int]
     MLCPushMethod = ''
     JawsConformance = ''
 
-class _CPManager(BaseModel):
+    # The control points in columns, one row per control point, in degrees/cm as
+    # in ControlPoint. Each ControlPoint reads its values from these arrays.
+    # MLCLeafPositions is (ncp, nleaf, 2); the MLC Points of each control point
+    # are a flat view into it.
+    Gantry: Optional[np.ndarray] = None
+    Couch: Optional[np.ndarray] = None
+    Collimator: Optional[np.ndarray] = None
+    LeftJawPosition: Optional[np.ndarray] = None
+    RightJawPosition: Optional[np.ndarray] = None
+    TopJawPosition: Optional[np.ndarray] = None
+    BottomJawPosition: Optional[np.ndarray] = None
+    Weight: Optional[np.ndarray] = None
+    MLCLeafPositions: Optional[np.ndarray] = None
+
+    @root_validator(pre=True)
+    def _packControlPoints(cls, values):
+        cplist = values.get('ControlPointList')
+        if isinstance(cplist, BaseModel):
+            cplist = cplist.dict()
+        if not isinstance(cplist, dict) or not cplist.get('ControlPoint'):
+            return values
+        cps = [dict(cp) if isinstance(cp, dict) else cp.dict() for cp in cplist['ControlPoint']]
+        values = dict(values, ControlPointList=dict(cplist, ControlPoint=cps))
+        columns = _getCPColumns(cps)
+        values.update(columns)
+        for (icp, cp) in enumerate(cps):
+            for key in _CP_COLUMNS:
+                cp.pop(key, None)
+            cp['Columns'] = columns
+            cp['Index'] = icp
+
+        mlc = _getCPLeafPositions(cps)
+        values['MLCLeafPositions'] = mlc
+        if mlc is not None:
+            for (icp, cp) in enumerate(cps):
+                leaves = cp['MLCLeafPositions']
+                cp['MLCLeafPositions'] = dict(leaves, RawData=dict(leaves['RawData'], Points=mlc[icp].reshape(-1)))
+        return values
+
+class _CPManager(PFArrayModel):
     CPManagerObject: List[_CPManagerObject] = None
 
 class _MonitorUnitInfo(BaseModel):
@@ -143,7 +254,7 @@ class _Prescription(BaseModel):
 class _PrescriptionList(BaseModel):
     Prescription: List[_Prescription] = None
 
-class _Beam(BaseModel):
+class _Beam(PFArrayModel):
       Name: str
       IsocenterName = ''
       PrescriptionName = ''
@@ -194,12 +305,27 @@ class _Beam(BaseModel):
       Prescription: Optional[_Prescription] = None
       # flag to be used for removing extra beams
       Removable = False
+      # position in BeamList of plan.Trial, kept when trials are split
+      BeamIndex: Optional[int]
+
 
+# the position of each dict in items as key, unless it has one already
+def _setItemIndex(items, key):
+    if not isinstance(items, list):
+        return items
+    return [dict(item, **{key: i}) if isinstance(item, dict) and key not in item else item
+            for (i, item) in enumerate(items)]
 
-class _BeamList(BaseModel):
+class _BeamList(PFArrayModel):
     Beam: List[_Beam] = None
 
-class _Trial(BaseModel):
+    @root_validator(pre=True)
+    def _setBeamIndex(cls, values):
+        if values.get('Beam') is None:
+            return values
+        return dict(values, Beam=_setItemIndex(values['Beam'], 'BeamIndex'))
+
+class _Trial(PFArrayModel):
     Name: str
     CtToDensityName = ''
     CtToDensityVersion = ''
@@ -221,16 +347,49 @@ class _Trial(BaseModel):
     # added in items
     Removable = False
     TrialID: Optional[int]
+    # position in plan.Trial, kept when trials are split
+    TrialIndex: Optional[int]
 
-class PFPlanTrial(BaseModel):
+class PFPlanTrial(PFArrayModel):
     Trial: List[_Trial] = None
 
-def readPlanTrial(pfpath, planid=0):
+    @root_validator(pre=True)
+    def _setTrialIndex(cls, values):
+        if values.get('Trial') is None:
+            return values
+        return dict(values, Trial=_setItemIndex(values['Trial'], 'TrialIndex'))
+
+# Blocks left out by readPlanTrial(..., lightweight=True): the control points
+# (with the MLC leaf positions) and the display, film, dose engine and brachy
+# data. Trial, prescription, beam, bolus and MU info are all still there.
+TRIAL_LIGHTWEIGHT_EXCLUDE = [
+    'Trial/BeamList/Beam/CPManager', 'Trial/BeamList/Beam/DisplayList',
+    'Trial/BeamList/Beam/FilmImageList', 'Trial/BeamList/Beam/TarTable',
+    'Trial/BeamList/Beam/DoseEngine', 'Trial/BeamList/Beam/ODM', 'Trial/BrachyManager'
+]
+
+def readPlanTrial(pfpath, planid=0, lightweight=False):
     fname = '%s/Plan_%s/plan.Trial' % (pfpath, planid)
-    pdict = readPFile(fname, 'plan.Trial', 'dict')
-    pfObj = PFPlanTrial(**pdict)
+    exclude = TRIAL_LIGHTWEIGHT_EXCLUDE if lightweight else None
+    pdict = readPFile(fname, 'plan.Trial', 'dict', exclude=exclude)
+    pfObj = buildModel(PFPlanTrial, pdict)
     return pfObj
 
+# Trials one at a time, without their beams
+def iterTrials(pfpath, planid=0):
+    fname = '%s/Plan_%s/plan.Trial' % (pfpath, planid)
+    for (indices, tdict) in iterPFBlocks(fname, 'plan.Trial', 'Trial', exclude=['Trial/BeamList']):
+        yield buildModel(_Trial, dict(tdict, TrialIndex=indices[0]))
+
+# Beams one at a time, control points included, as (TrialIndex, beam). Only the
+# beams of one trial with trialindex given. Memory is bounded by the largest
+# beam, not by plan.Trial.
+def iterBeams(pfpath, planid=0, trialindex=None):
+    fname = '%s/Plan_%s/plan.Trial' % (pfpath, planid)
+    where = None if trialindex is None else (lambda indices: indices[0] == trialindex)
+    for (indices, bdict) in iterPFBlocks(fname, 'plan.Trial', 'Trial/BeamList/Beam', where=where):
+        yield (indices[0], buildModel(_Beam, dict(bdict, BeamIndex=indices[2])))
+
 
 if __name__ == '__main__':
     prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
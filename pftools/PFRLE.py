@@ -0,0 +1,110 @@
+'''
+PFRLE
+
+RLE Lossless (1.2.840.10008.1.2.5) encoding of pixel frames with NumPy only.
+
+A frame is split into one segment per byte of the pixel, most significant byte
+first, and each segment is PackBits encoded row by row (DICOM PS3.5 G.3):
+runs of 3 to 128 equal bytes become a count byte and the value, everything
+else goes out in literal packets of up to 128 bytes. Runs are found for the
+whole segment at once and the packets are picked out with a mask, so there
+is no loop over the pixels.
+
+The encoded frames are encapsulated with pydicom.encaps.encapsulate().
+'''
+
+import os
+import sys
+import struct
+import logging
+import numpy as np
+
+# Split segments (start, length) into chunks of at most n
+def _chunks(starts, lengths, n=128):
+    nchunks = (lengths + n - 1) // n
+    first = np.repeat(np.cumsum(nchunks) - nchunks, nchunks)
+    j = np.arange(int(nchunks.sum())) - first
+    cstarts = np.repeat(starts, nchunks) + n*j
+    clengths = np.minimum(n, np.repeat(lengths, nchunks) - n*j)
+    return (cstarts, clengths)
+
+# PackBits of a 2D uint8 array, each row on its own. Runs of 3 or more are
+# replicate packets; a run of 2 costs as much in a literal packet and saves a
+# header between two literals. Every input byte gives at most two output bytes,
+# a packet header if a packet starts there and the byte itself if it is in a
+# literal packet or the value of a replicate packet, so the output is the
+# (header, byte) pairs with the unused ones masked out.
+def _packBits(plane) -> bytes:
+    (nrows, ncols) = plane.shape
+    a = np.ascontiguousarray(plane).ravel()
+    n = a.size
+    if n == 0:
+        return b''
+
+    # rowstart and newrun have one more item for the end of the last row
+    rowstart = np.zeros(n+1, dtype=bool)
+    rowstart[::ncols] = True
+    rowstart[n] = True
+    newrun = rowstart.copy()
+    newrun[1:n] |= a[1:] != a[:-1]
+    # third byte of a run and on, then the whole of runs of 3 or more
+    third = np.zeros(n+2, dtype=bool)
+    third[2:n] = ~(newrun[2:n] | newrun[1:n-1])
+    rep = third[:n] | third[1:n+1] | third[2:]
+    lit = ~rep
+
+    rstarts = np.flatnonzero(rep & newrun[:n])
+    rends = np.flatnonzero(rep & newrun[1:])
+    litprev = np.insert(lit[:-1], 0, False)
+    litnext = np.append(lit[1:], False)
+    lstarts = np.flatnonzero(lit & (rowstart[:n] | ~litprev))
+    lends = np.flatnonzero(lit & (rowstart[1:] | ~litnext))
+
+    (rs, rl) = _chunks(rstarts, rends - rstarts + 1)
+    (ls, ll) = _chunks(lstarts, lends - lstarts + 1)
+    pairs = np.empty((n, 2), dtype=np.uint8)
+    pairs[rs, 0] = 257 - rl
+    pairs[ls, 0] = ll - 1
+    pairs[:, 1] = a
+    keep = np.zeros((n, 2), dtype=bool)
+    keep[rs, 0] = True
+    keep[ls, 0] = True
+    keep[rs, 1] = True
+    keep[:, 1] |= lit
+    return pairs.ravel()[keep.ravel()].tobytes()
+
+# One RLE frame: the 64 byte header and a segment per byte of the pixel
+def encodeRLEFrame(frame) -> bytes:
+    frame = np.asarray(frame)
+    if frame.ndim != 2:
+        raise ValueError('RLE frames are 2D, got shape %s' % (frame.shape,))
+    nbytes = frame.dtype.itemsize
+    planes = frame.astype(frame.dtype.newbyteorder('<'), copy=False).view(np.uint8).reshape(
+        frame.shape[0], frame.shape[1], nbytes)
+
+    segments = []
+    for i in range(nbytes-1, -1, -1):
+        segment = _packBits(planes[:, :, i])
+        if len(segment) % 2:
+            segment += b'\x00'
+        segments.append(segment)
+    offsets = [64]
+    for segment in segments[:-1]:
+        offsets.append(offsets[-1] + len(segment))
+    header = struct.pack('<16L', len(segments), *(offsets + [0]*(15-len(offsets))))
+    return header + b''.join(segments)
+
+
+if __name__ == '__main__':
+    prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+    sys.path.insert(0, prjpath)
+    from pydicom.pixel_data_handlers.rle_handler import _rle_decode_frame
+
+    FORMAT = "[%(asctime)s %(levelname)s - %(funcName)s] %(message)s"
+    logging.basicConfig(format=FORMAT, filename=prjpath+'logs/test.log', level=logging.INFO)
+
+    frame = np.zeros((512, 512), dtype=np.int16)
+    frame[100:400, 150:350] = 1000 + np.random.default_rng(0).integers(-20, 20, size=(300, 200))
+    data = encodeRLEFrame(frame)
+    decoded = np.frombuffer(_rle_decode_frame(data, 512, 512, 1, 16), dtype='<i2').reshape(512, 512)
+    print(len(data), frame.nbytes, np.array_equal(decoded, frame))
@@ -0,0 +1,150 @@
+import os
+import sys
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+
+# Dose volumes in plan.Trial.binary.NNN are stored as big-endian float32,
+# x running fastest, then y, then z.
+TRIAL_BINARY_DTYPE = np.dtype('>f4')
+
+def getTrialBinaryName(pfpath, planid=0, binid=0):
+    return '%s/Plan_%s/plan.Trial.binary.%s' % (pfpath, planid, str(binid).zfill(3))
+
+# Number of voxels in fname, checked against shape if one is given
+def _getTrialBinarySize(fname, shape=None) -> int:
+    nvox = os.path.getsize(fname) // TRIAL_BINARY_DTYPE.itemsize
+    if shape is not None and int(np.prod(shape)) != nvox:
+        logging.error('%s has %s voxels, but %s is expected.' % (fname, nvox, shape))
+        raise ValueError('Dose grid mismatch in %s: %s voxels for shape %s' % (fname, nvox, shape))
+    return nvox
+
+# byte swap and scaling in one pass; scale is applied in double precision
+def _scaleDose(raw, scale, out=None) -> np.ndarray:
+    if out is None:
+        out = np.empty(raw.shape, dtype=np.float32)
+    np.multiply(raw, np.float64(scale), out=out, casting='same_kind')
+    return out
+
+# Read the whole dose volume in one call. The result is a native float32 array
+# shaped (nz, ny, nx) if shape is given, flat otherwise. With mmap=True the file
+# is memory-mapped and a PFTrialBinaryVolume is returned instead, which scales
+# only the frames that are indexed, so nothing the size of the volume is held.
+def readTrialBinary(fname, shape=None, scale=1.0, mmap=False):
+    nvox = _getTrialBinarySize(fname, shape)
+    if shape is None:
+        shape = (nvox,)
+    if nvox == 0:
+        return np.zeros(shape, dtype=np.float32)
+    if mmap:
+        return PFTrialBinaryVolume(fname, shape, scale)
+    return _scaleDose(np.fromfile(fname, dtype=TRIAL_BINARY_DTYPE).reshape(shape), scale)
+
+# A dose volume left in its memory-mapped file. volume[k] is the scaled float32
+# frame k (any numpy index works the same way), iterFrames() goes through the
+# frames reusing one buffer and np.asarray(volume) decodes the whole volume,
+# equal to readTrialBinary(fname, shape, scale).
+class PFTrialBinaryVolume():
+    def __init__(self, fname, shape, scale=1.0) -> None:
+        self.FileName = fname
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(np.float32)
+        self.scale = float(scale)
+        self._raw = np.memmap(fname, dtype=TRIAL_BINARY_DTYPE, mode='r', shape=self.shape)
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, index) -> np.ndarray:
+        return _scaleDose(self._raw[index], self.scale)
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        dose = _scaleDose(self._raw, self.scale)
+        return dose if dtype is None else dose.astype(dtype, copy=False)
+
+    def iterFrames(self):
+        frame = np.empty(self.shape[1:], dtype=np.float32)
+        for k in range(self.shape[0]):
+            yield _scaleDose(self._raw[k], self.scale, out=frame)
+
+# The dose volume one z frame at a time, from the memory-mapped file. The frames
+# are the same as those of readTrialBinary(fname, shape, scale); the one frame
+# buffer is reused. A mismatching grid raises ValueError right away.
+def iterTrialBinaryFrames(fname, shape, scale=1.0):
+    if _getTrialBinarySize(fname, shape) == 0:
+        return iter([])
+    return PFTrialBinaryVolume(fname, shape, scale).iterFrames()
+
+def readPlanTrialBinary(pfpath, planid=0, binid=0, shape=None, scale=1.0, mmap=False):
+    fname = getTrialBinaryName(pfpath, planid, binid)
+    return readTrialBinary(fname, shape, scale, mmap)
+
+DEFAULT_DOSE_CACHE_SIZE = 512 * 1024 * 1024
+
+# Dose volumes of one plan, each decoded once per (binary file, scale) from a
+# memory-mapped file. Trials split on prescription, or trials that share a
+# binary file, then get the same volume. The volumes are read-only. When the
+# total size goes over maxsize, the least recently used ones are dropped; a
+# volume bigger than maxsize is not kept at all. The cache can be shared by
+# threads; files are read outside of the lock.
+class PFDoseCache():
+    def __init__(self, maxsize=DEFAULT_DOSE_CACHE_SIZE) -> None:
+        self.maxsize = int(maxsize)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._volumes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def getDose(self, fname, shape=None, scale=1.0) -> np.ndarray:
+        key = (os.path.abspath(fname), None if shape is None else tuple(shape), float(scale))
+        with self._lock:
+            dose = self._volumes.get(key)
+            if dose is not None:
+                self._volumes.move_to_end(key)
+                self.hits += 1
+                return dose
+            self.misses += 1
+
+        dose = np.asarray(readTrialBinary(fname, shape, scale, mmap=True))
+        dose.flags.writeable = False
+        with self._lock:
+            if key in self._volumes:  # read by another thread meanwhile
+                return self._volumes[key]
+            if dose.nbytes <= self.maxsize:
+                self._volumes[key] = dose
+                self.size += dose.nbytes
+                self.evict()
+        return dose
+
+    # with the lock held
+    def evict(self):
+        while self.size > self.maxsize:
+            (key, dose) = self._volumes.popitem(last=False)
+            self.size -= dose.nbytes
+            logging.info('dose of %s (scale %s) evicted' % (key[0], key[2]))
+
+    def clear(self):
+        with self._lock:
+            self._volumes.clear()
+            self.size = 0
+
+
+if __name__ == '__main__':
+    prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+
+    FORMAT = "[%(asctime)s %(levelname)s - %(funcName)s] %(message)s"
+    logging.basicConfig(format=FORMAT, filename=prjpath+'logs/test.log',
+                        level=logging.INFO)
+
+    logging.info('Project foler is %s' % os.path.abspath(prjpath))
+
+    dose = readPlanTrialBinary(prjpath+'examples/Patient_4604/', 0, 4, shape=(87, 68, 81))
+    print(dose.shape, dose.dtype, dose.max())
+    dose = readPlanTrialBinary(prjpath+'examples/Patient_4604/', 0, 4, shape=(87, 68, 81), mmap=True)
+    print(dose.shape, dose.dtype, max(frame.max() for frame in dose.iterFrames()))
@@ -21,60 +21,97 @@ import os
 import sys
 import logging
 import re
+import io
+import fnmatch
 import json
+import warnings
 from numpy import append
+import numpy as np
 import yaml
 from yaml.loader import FullLoader, BaseLoader
 from copy import deepcopy
+from pftools.PFCache import getCache
 
-# we don't need most parts in plan.Pinnacle.Machines, hence are not reading them in.
-def _processPFMachine(text):
-    rm_start = False
-    rm_end = True
-    new_text = []
-    for line in text:
-        if 'MultiLeaf ={' in line:
-            rm_start = True
-            rm_end = False
-        if 'PhotonEnergyList ={' in line:
-            rm_end = True
-            rm_start = False
-        if 'MeasureGeometryList ={' in line:
-            rm_start = True
-            rm_end = False
-        if 'ComputationVersion = ' in line:
-            rm_end = True
-            rm_start = False
-        if 'PhotonModelList ={' in line:
-            rm_start = True
-            rm_end = False
-        if 'StereoPhysicsData ={' in line:
-            rm_end = True
-            rm_start = False
-        if 'ConeList ={' in line:
-            rm_start = True
-            rm_end = False
-        if 'FileChecksum = ' in line:
-            rm_end = True
-            rm_start = False
-        if 'CouchAngle ={' in line:
-            rm_start = True
-            rm_end = False
-        if 'PhotonEnergyList ={' in line:
-            rm_end = True
-            rm_start = False
-        if not(rm_start==True and rm_end==False):
-            new_text.append(line)
-
-    # for line in new_text:
-    #     print(line)
-    return new_text
-        
-def readPFile(filename, ptype, outfmt=''):
-    text = open(filename, 'r', encoding='latin1')
-    # text = open(filename, 'r', encoding='iso-8859-1', errors='surrogateescape')
+# Bump whenever the dict produced by readPFile changes, so cached results are dropped.
+PARSER_VERSION = '6'
 
-    # the part that will be converted to list
+# we don't need most parts in plan.Pinnacle.Machines, hence are not reading them in.
+_MACHINE_EXCLUDE = ['#*/CouchAngle', '#*/GantryAngle', '#*/CollimatorAngle', '#*/MultiLeaf',
+                    '#*/ConfigRV', '#*/CircularCollimatorList', '#*/ElectronApplicatorList',
+                    '#*/WedgeList', '**/ConeList', '**/MeasureGeometryList', '**/PhotonModelList',
+                    '**/PhotonModelOptimizer']
+
+# Include/exclude by key path. A path names the keys from the top of the file
+# down, "/" separated, e.g. 'Trial/BeamList/Beam/CPManager'; "#N" entries are
+# written as they are in the file ('#0', or '#*' for all). Each part may have
+# fnmatch wildcards, and a '**' part stands for any number of keys.
+#
+# An excluded key is dropped together with its { ... } block. With include
+# given, only the included keys and their blocks are read, plus the blocks on
+# the way to them. Dropped blocks are skipped by counting braces, nothing in
+# them is parsed.
+class _PFKeyFilter():
+    def __init__(self, include=None, exclude=None) -> None:
+        self.include = [self._compile(p) for p in include] if include else None
+        self.exclude = [self._compile(p) for p in exclude] if exclude else []
+        # last keys of the exclude paths, for a quick check before the full match
+        self.exclnames = set([p[-1] for p in self.exclude])
+        if not all([isinstance(name, str) and name != '**' for name in self.exclnames]):
+            self.exclnames = None
+        self.checked = {}
+
+    # path parts as plain keys, '**', or compiled patterns for the ones with wildcards
+    @staticmethod
+    def _compile(path):
+        parts = []
+        for part in path.split('/'):
+            if part != '**' and re.search(r'[*?\[]', part):
+                part = re.compile(fnmatch.translate(part))
+            parts.append(part)
+        return parts
+
+    # 2: keys are at or below pattern, 1: keys are above something pattern may
+    # match, 0: no match
+    @staticmethod
+    def _match(keys, pattern):
+        for (i, part) in enumerate(pattern):
+            if i == len(keys):
+                return 1
+            if part == '**':
+                return max([_PFKeyFilter._match(keys[j:], pattern[i+1:]) for j in range(i, len(keys)+1)])
+            if not (keys[i] == part if isinstance(part, str) else part.match(keys[i]) is not None):
+                return 0
+        return 2
+
+    def _check(self, keys):
+        for pattern in self.exclude:
+            # blocks below an excluded one are never seen, so only the key
+            # itself can be the match
+            if isinstance(pattern[-1], str) and pattern[-1] != '**' and pattern[-1] != keys[-1]:
+                continue
+            if self._match(keys, pattern) == 2:
+                return -1
+        if self.include is None:
+            return 2
+        return max([self._match(keys, pattern) for pattern in self.include])
+
+    # include state of key under the blocks in path (2, 1 or 0), or -1 if excluded
+    def check(self, path, key):
+        if len(path) > 0 and path[-1][1] == 2 and \
+           self.exclnames is not None and key not in self.exclnames:
+            return 2
+        # the same paths come again in every list item
+        keys = tuple([p[0] for p in path]) + (key,)
+        state = self.checked.get(keys)
+        if state is None:
+            state = self._check(keys)
+            if len(path) > 0 and path[-1][1] == 2 and state >= 0:
+                state = 2
+            self.checked[keys] = state
+        return state
+
+# the part that will be converted to list
+def _getListKeys(ptype):
     strlist = ['% A string will never appear. %']
     if ptype == 'plan.Points':
         strlist = ['Poi ={']
@@ -89,23 +126,36 @@ def readPFile(filename, ptype, outfmt=''):
                     'FilmImage ={', 'BeamModifier ={', 'CurvePainter ={']
     elif ptype == 'plan.Machine':
         strlist = ['MachineEnergy ={']
-    ystr = ''
-
-    logging.info('reading in %s with type %s done.' % (filename, ptype))
-
-    ################################################
-    ## remove comments and apply correct indent
-    newtext = []
+    return strlist
+
+def _removeComment(line):
+    if '//' in line:
+        line = line.split('//',2)[0]+'\n'
+    if '/*' in line:
+        line = line.split('/*',2)[0]+'\n'
+    if '*/' in line:
+        line = line.split('*/',2)[1]+'\n'
+    return line
+
+# remove comments and apply the in-line rewrites of the yaml text; yield
+# (level, line) with the indent level the line is at. Keys dropped by keyfilter
+# are not yielded.
+def _iterPFLines(text, keyfilter=None):
     level = 0
-    indent = ''    
+    skip = 0        # depth inside a dropped block
+    path = []       # (key, include state) of the open blocks
     for line in text:
+        if skip > 0:
+            if '/' in line:
+                line = _removeComment(line)
+            if '{' in line:
+                skip += 1
+            if '}' in line:
+                skip -= 1
+            continue
         # remove comment
-        if '//' in line:
-            line = line.split('//',2)[0]+'\n'
-        if '/*' in line:
-            line = line.split('/*',2)[0]+'\n'
-        if '*/' in line:
-            line = line.split('*/',2)[1]+'\n'
+        if '/' in line:
+            line = _removeComment(line)
         if 'date' in line:
             line = line.replace('-', '')
         if ' .' in line:  # in Trial
@@ -114,24 +164,47 @@ def readPFile(filename, ptype, outfmt=''):
             line = line.replace('[]', '')
         if '#' in line:  # in Trial
             line = line.replace('#', '_')
-        if len(line.strip())==0:   # remove blank lines
+        line = line.strip()
+        if len(line)==0:   # remove blank lines
             continue
 
-        # indent the line
-        indent = '    ' * level
-        line = indent + line.strip() + '\n'
+        if keyfilter is not None:
+            ikey = line.find('=')
+            if ikey > 0:
+                key = line[:ikey].strip()
+                if key[0] == '_' and key[1:].isdigit():
+                    key = '#'+key[1:]
+                state = keyfilter.check(path, key)
+                isblock = '{' in line and '}' not in line
+                if state <= 0 or (state == 1 and not isblock):
+                    if isblock:
+                        skip = 1
+                    continue
+            else:
+                key = ''
+                state = path[-1][1] if len(path) > 0 else 1
+            if '{' in line:
+                path.append((key, state))
+            if '}' in line and len(path) > 0:
+                path.pop()
+
+        yield (level, line)
         level = level+1 if '{' in line else level
         level = level-1 if '}' in line else level
-    #for line in newtext:
-    #    print(line[:-1])
-        newtext.append(line)
-    text.close()
-    logging.info('comments removed and indent corrected')
+
+_RE_LIST_ITEM = re.compile(r'^_[0-9]{1,3}\s={$')
+
+def _readPFYaml(text, ptype, keyfilter=None):
+    strlist = _getListKeys(ptype)
+    ystr = ''
+
     ################################################
-    # process for plan.Machine
-    if ptype == 'plan.Machine':
-        newtext = _processPFMachine(newtext)
-    #print(newtext)    
+    ## remove comments and apply correct indent
+    lines = _iterPFLines(text, keyfilter)
+    newtext = []
+    for (level, line) in lines:
+        newtext.append('    ' * level + line + '\n')
+    logging.info('comments removed and indent corrected')
 
     ################################################
     ## add '-' for lists    
@@ -167,11 +240,11 @@ def readPFile(filename, ptype, outfmt=''):
             line = '    '*mylevel + 'RowLabel :\n' + '    '*mylevel + '  - \n'
         if ptype == 'plan.Trial' and 'LabelFormatList ={' in preline and '_0 ={' in line:
             line = '    '*mylevel + 'LabelFormat :\n' + '    '*mylevel + '  - \n'
-        if ptype == 'plan.Trial' and re.search(r'^_[0-9]{1,3}\s={$',line.strip()) is not None:
+        if ptype == 'plan.Trial' and _RE_LIST_ITEM.search(line.strip()) is not None:
             line = '    '*mylevel + '  - \n'
         if ptype == 'plan.Machine' and mylevel == 0 and '_0 ={' in line:
             line = '    '*mylevel + 'Machine :\n' + '    '*mylevel + '  - \n'
-        if ptype == 'plan.Machine' and mylevel == 0 and re.search(r'^_[0-9]{1,3}\s={$',line.strip()) is not None:
+        if ptype == 'plan.Machine' and mylevel == 0 and _RE_LIST_ITEM.search(line.strip()) is not None:
             line = '    '*mylevel + '  - \n'
         if ptype == 'plan.Machine' and 'LabelList ={' in preline and '_0 ={' in line:
             line = '    '*mylevel + 'Label :\n' + '    '*mylevel + '  - \n'
@@ -179,7 +252,7 @@ def readPFile(filename, ptype, outfmt=''):
             line = '    '*mylevel + 'LabelFormat :\n' + '    '*mylevel + '  - \n'
         if ptype == 'plan.Machine' and 'VendorDataList ={' in preline and '_0 ={' in line:
             line = '    '*mylevel + 'VendorData :\n' + '    '*mylevel + '  - \n'
-        if ptype == 'plan.Machine' and re.search(r'^_[0-9]{1,3}\s={$',line.strip()) is not None:
+        if ptype == 'plan.Machine' and _RE_LIST_ITEM.search(line.strip()) is not None:
             line = '    '*mylevel + '  - \n'
         preline = line
 
@@ -196,30 +269,545 @@ def readPFile(filename, ptype, outfmt=''):
         if len(line.strip()) == 0:
             continue                
         ystr += line
-    #print(ystr)
-    logging.info(filename + ' conversion to yaml compatible format done')
-    ################################################
+    return ystr
+
+# "#N ={" entries that become a named list: the list name for the block they
+# are the first entry of.
+_LIST_WRAPPERS = {
+    'plan.Trial': {'ControlPointList': 'ControlPoint',
+                   'RowLabelList': 'RowLabel',
+                   'LabelFormatList': 'LabelFormat'},
+    'plan.Machine': {'LabelList': 'Label',
+                     'LabelFormatList': 'LabelFormat',
+                     'VendorDataList': 'VendorData'}
+}
+
+# Value on the right hand side of "key = value;" or "key : value", with the
+# same result as the yaml BaseLoader gave: all strings, quotes removed.
+def _getPFValue(value):
+    if len(value) == 0:
+        return None
+    if value[0] == '"':
+        end = value.find('"', 1)
+        while end > 0 and value[end-1] == '\\':
+            end = value.find('"', end+1)
+        if end < 0:
+            end = len(value)
+        value = value[1:end]
+        if '\\' in value:
+            value = value.replace('\\"', '"').replace('\\\\', '\\')
+        return value
+    if value[0] == "'":
+        end = value.find("'", 1)
+        while end > 0 and value[end+1:end+2] == "'":
+            end = value.find("'", end+2)
+        if end < 0:
+            end = len(value)
+        return value[1:end].replace("''", "'")
+    return value
+
+# Tokens of the Pinnacle text: "key = value;", "key ={", "};", the
+# "key : value" lines of ImageSet.header and the data lines of point blocks.
+# Quoted strings are kept whole, so "=", ";", "{", "}", "#" or "//" in them
+# are not read as structure.
+_RE_QUOTED = re.compile(r'"(?:[^"\\\n]|\\.)*"?')
+_RE_COMMENT = re.compile(r'"(?:[^"\\\n]|\\.)*"?|//|/\*')
+_RE_DELIMS = re.compile(r'[{};]')
+
+# line without its comments, and whether a /* comment is still open at its end
+def _removeComments(line, incomment):
+    parts = []
+    start = 0
+    if incomment:
+        end = line.find('*/')
+        if end < 0:
+            return ('', True)
+        start = end+2
+    pos = start
+    while True:
+        m = _RE_COMMENT.search(line, pos)
+        if m is None:
+            break
+        if m.group() == '//':
+            parts.append(line[start:m.start()])
+            return (''.join(parts), False)
+        if m.group() == '/*':
+            parts.append(line[start:m.start()])
+            end = line.find('*/', m.end())
+            if end < 0:
+                return (''.join(parts), True)
+            start = end+2
+            pos = start
+        else:
+            pos = m.end()
+    parts.append(line[start:])
+    return (''.join(parts), False)
+
+def _getPFKey(key):
+    key = key.strip()
+    if ' .' in key:  # in Trial
+        key = key.replace(' .', '')
+    if key.endswith('[]'):  # Points[] in Trial
+        key = key[:-2].rstrip()
+    return key
+
+# "key = value", "key : value" or a data line; masked is the statement with
+# its quoted strings blanked out
+def _getPFStatement(statement, masked):
+    statement = statement.strip()
+    masked = masked.strip()
+    i = masked.find('=')
+    if i < 0:
+        i = masked.find(': ')
+        if i < 0 and masked.endswith(':'):
+            i = len(masked)-1
+    if i < 0:
+        return ('d', statement)
+    value = statement[i+1:].strip()
+    if 'date' in statement:
+        value = value.replace('-', '')
+    return ('=', _getPFKey(statement[:i]), value)
+
+# The common lines in one match: "key = value;", "key ={" and "};". Anything
+# else, comments included, goes through the statement split below.
+_RE_LINE = re.compile(r'\s*(?:([^\s=;{}":/][^=;{}":/]*?)\s*=\s*(?:(\{)|("(?:[^"\\\n]|\\.)*"|[^;{}"/\n]*?)\s*;)|(\};))\s*$')
+
+def _getPFTokens(line):
+    m = _RE_LINE.match(line)
+    if m is not None:
+        if m.group(4) is not None:
+            return [('}',)]
+        key = m.group(1)
+        if ' .' in key or key[-1] == ']':
+            key = _getPFKey(key)
+        if m.group(2) is not None:
+            return [('{', key)]
+        value = m.group(3)
+        if 'date' in line:
+            value = value.replace('-', '')
+        return [('=', key, value)]
+
+    masked = _RE_QUOTED.sub(lambda m: '_'*len(m.group()), line) if '"' in line else line
+    tokens = []
+    start = 0
+    for m in _RE_DELIMS.finditer(masked):
+        end = m.start()
+        delim = masked[end]
+        if delim == '{':
+            i = masked.find('=', start, end)
+            tokens.append(('{', _getPFKey(line[start:i if i >= 0 else end])))
+        elif start < end and not masked[start:end].isspace():
+            tokens.append(_getPFStatement(line[start:end], masked[start:end]))
+        if delim == '}':
+            tokens.append(('}',))
+        start = m.end()
+    if start < len(line) and not masked[start:].isspace():
+        tokens.append(_getPFStatement(line[start:], masked[start:]))
+    return tokens
+
+# Split the lines into ('=', key, value), ('{', key), ('}',) and ('d', data)
+# tokens. List items keep their "#N" key. Keys dropped by keyfilter are not
+# yielded; in their blocks, lines without comments are skipped by counting
+# braces, nothing in them is parsed.
+def _iterPFTokens(text, keyfilter=None):
+    incomment = False
+    skip = 0        # depth inside a dropped block
+    path = []       # (key, include state) of the open blocks
+    for line in text:
+        if skip > 0 and not incomment and '/' not in line:
+            if '{' not in line and '}' not in line:
+                continue
+            if '"' not in line:
+                depth = skip + line.count('{') - line.count('}')
+                if depth > 0:
+                    skip = depth
+                    continue
+        if incomment or '/' in line:
+            (line, incomment) = _removeComments(line, incomment)
+        tokens = _getPFTokens(line)
+
+        if keyfilter is None:
+            yield from tokens
+            continue
+        for token in tokens:
+            kind = token[0]
+            if skip > 0:
+                if kind == '{':
+                    skip += 1
+                elif kind == '}':
+                    skip -= 1
+                continue
+            if kind == '{':
+                key = token[1]
+                if len(key) > 0:
+                    state = keyfilter.check(path, key)
+                else:
+                    state = path[-1][1] if len(path) > 0 else 1
+                if state <= 0:
+                    skip = 1
+                    continue
+                path.append((key, state))
+            elif kind == '}':
+                if len(path) > 0:
+                    path.pop()
+            elif kind == '=':
+                state = keyfilter.check(path, token[1])
+                if state <= 1:
+                    continue
+            yield token
+
+# Parse the Pinnacle "key = value;" / "key ={ ... };" text into a dict in a
+# single pass. All values are strings, as the yaml BaseLoader gave them.
+def _readPFDict(text, ptype, keyfilter=None):
+    return _buildPFDict(_iterPFTokens(text, keyfilter), ptype)
+
+# A block being built: its key in the parent, the dict, list of items or data
+# lines it holds, and the lists started in it
+class _PFBlock():
+    __slots__ = ('key', 'kind', 'value', 'lists', 'items')
+    def __init__(self, key, kind=None, value=None) -> None:
+        self.key = key
+        self.kind = kind      # None while empty, then 'map', 'seq' or 'text'
+        self.value = value
+        self.lists = None     # list key: the list of its blocks
+        self.items = None     # list the "#N" entries go in
+
+    def result(self):
+        if self.kind is None:
+            return ''
+        if self.kind == 'text':
+            return ' '.join(self.value)
+        return self.value
+
+    def map(self):
+        if self.kind is None:
+            self.kind = 'map'
+            self.value = {}
+        return self.value if self.kind == 'map' else None
+
+# The dict from the tokens of _iterPFTokens. Blocks named in _getListKeys
+# become lists of all the blocks of that name, and "#N" entries of plan.Trial
+# and plan.Machine list items.
+def _buildPFDict(tokens, ptype):
+    listkeys = set([s.split('=')[0].strip() for s in _getListKeys(ptype)])
+    wrappers = _LIST_WRAPPERS.get(ptype, {})
+    hasitems = ptype in ['plan.Trial', 'plan.Machine']
+
+    root = _PFBlock(None, 'map', {})
+    stack = [root]
+    for token in tokens:
+        kind = token[0]
+        block = stack[-1]
+        if kind == '=':
+            node = block.map()
+            if node is None:
+                logging.warning('Unexpected key %s ignored.' % token[1])
+                continue
+            value = _getPFValue(token[2])
+            node[token[1].replace('#', '_')] = '' if value is None else value
+        elif kind == '{':
+            key = token[1]
+            child = _PFBlock(key)
+            stack.append(child)
+            if hasitems and key[:1] == '#' and key[1:].isdigit():
+                if block.items is None:
+                    wrapper = None
+                    if ptype == 'plan.Machine' and len(stack) == 2:
+                        wrapper = 'Machine'
+                    elif block.kind is None:
+                        wrapper = wrappers.get(block.key)
+                    if wrapper is not None:
+                        block.items = []
+                        block.map()[wrapper] = block.items
+                    elif block.kind is None:
+                        block.kind = 'seq'
+                        block.value = block.items = []
+                if block.items is not None:
+                    block.items.append(child)
+                    continue
+            node = block.map()
+            if node is None:
+                logging.warning('Unexpected block %s ignored.' % key)
+            elif key in listkeys:
+                if block.lists is None:
+                    block.lists = {}
+                if key not in block.lists:
+                    block.lists[key] = node[key] = []
+                block.lists[key].append(child)
+            else:
+                node[key.replace('#', '_')] = child
+        elif kind == '}':
+            if len(stack) > 1:
+                stack.pop()
+        else:
+            if block.kind is None:
+                block.kind = 'text'
+                block.value = []
+            if block.kind != 'text':
+                logging.warning('Unexpected data line ignored: %s' % token[1])
+                continue
+            block.value.append(token[1])
+
+    return _resolve(root.value) if len(root.value) > 0 else None
+
+# replace the _PFBlock entries with what they hold
+def _resolve(obj):
+    if isinstance(obj, dict):
+        items = obj.items()
+    else:
+        items = enumerate(obj)
+    for (k, v) in list(items):
+        if isinstance(v, _PFBlock):
+            v = v.result()
+            obj[k] = v
+        if isinstance(v, (dict, list)):
+            _resolve(v)
+    return obj
+
+# Numeric blocks decoded before the structural parse: roi points and the RawData
+# Points of MLCLeafPositions and CurvePainter curves in plan.Trial. Each block is
+# replaced by "key = @PFBLOCK<n>;", so the parser only sees one short line for it.
+# Blocks with anything but numbers in them are left to the parser.
+_BLOCK_REF = '@PFBLOCK'
+# ptype: (block, blocks the RawData holding it may be in, separator)
+_NUMERIC_BLOCKS = {
+    'plan.roi': (re.compile(r'(points)=\{([-+0-9.eE \t\n]*)\};'), None, ' '),
+    'plan.Trial': (re.compile(r'(Points)\[\] =\{([-+0-9.eE, \t\n]*)\};'),
+                   ('MLCLeafPositions ={', 'Curve ={'), ','),
+}
+# "RawData ={" followed by plain "key = value;" lines up to the block
+_RE_RAWDATA = re.compile(r'RawData =\{\s*(?:\w+ = [^;{}\n]*;\s*)*$')
+# how far back "RawData ={" is looked for
+_BLOCK_CONTEXT = 512
+
+class _PFNumericBlocks():
+    def __init__(self, ptype) -> None:
+        (self.pattern, self.parents, self.sep) = _NUMERIC_BLOCKS.get(ptype, (None, None, ' '))
+        self.listed = ptype == 'plan.roi'  # "points={" is a list key in plan.roi
+        self.values = []
+        self.bodies = []
+        self.used = set()
+
+    def _decode(self, body):
+        if len(body.strip()) == 0 or ' .' in body:
+            return None
+        try:
+            values = np.fromstring(body, dtype=np.float64, sep=self.sep)
+        except (ValueError, DeprecationWarning):
+            return None
+        # same number of values as the text split gives
+        ntokens = body.count(',')+1 if self.sep == ',' else len(body.split())
+        return values if values.size == ntokens else None
+
+    def _inParent(self, text, start):
+        raw = text.rfind('RawData ={', max(0, start-_BLOCK_CONTEXT), start)
+        if raw < 0 or _RE_RAWDATA.match(text, raw, start) is None:
+            return False
+        # the line before "RawData ={"
+        end = text.rfind('\n', 0, raw)
+        return text[text.rfind('\n', 0, end)+1:end].strip() in self.parents
+
+    def _replace(self, m):
+        if self.parents is not None and not self._inParent(m.string, m.start()):
+            return m.group(0)
+        values = self._decode(m.group(2))
+        if values is None:
+            return m.group(0)
+        self.values.append(values)
+        self.bodies.append(m.group(2))
+        return '%s = %s%s;' % (m.group(1), _BLOCK_REF, len(self.values)-1)
+
+    def extract(self, text):
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            return self.pattern.sub(self._replace, text)
+
+    # values of a "@PFBLOCK<n>" reference, None for anything else
+    def get(self, value):
+        if not isinstance(value, str) or not value.startswith(_BLOCK_REF):
+            return None
+        n = int(value[len(_BLOCK_REF):])
+        self.used.add(n)
+        return self.values[n]
+
+    # the block as the parser would have left it
+    def _text(self, n):
+        text = ' '.join([line.strip() for line in self.bodies[n].split('\n') if len(line.strip()) > 0])
+        return [text] if self.listed else text
+
+    # put back the parser's text for references not turned into points
+    def restore(self, obj):
+        if len(self.values) == 0:
+            return
+        if isinstance(obj, dict):
+            items = obj.items()
+        elif isinstance(obj, list):
+            items = enumerate(obj)
+        else:
+            return
+        for (k, v) in list(items):
+            if isinstance(v, str) and v.startswith(_BLOCK_REF):
+                n = int(v[len(_BLOCK_REF):])
+                self.used.add(n)
+                obj[k] = self._text(n)
+            else:
+                self.restore(v)
+
+def _setROIPoints(roi, coords, ncoords, filename=''):
+    offsets = np.zeros(len(ncoords)+1, dtype=np.int64)
+    np.cumsum(ncoords, out=offsets[1:])
+    if coords.size % 3 != 0 or np.any(offsets % 3 != 0):
+        logging.error('%s: points of ROI %s are not x,y,z triplets' % (filename, roi['name']))
+        raise ValueError('%s: points of ROI %s are not x,y,z triplets' % (filename, roi['name']))
+    roi['points'] = coords.reshape(-1, 3)
+    roi['curve_offsets'] = offsets // 3
+    for (icurve, curve) in enumerate(roi['curve']):
+        curve['points'] = coords[offsets[icurve]:offsets[icurve+1]]
+
+# plan.roi as it is cached: the curve points are views into roi['points'], so
+# they are not stored again but made from it after loading
+def _dropROICurvePoints(yobj):
+    if yobj is None:
+        return yobj
+    return dict(yobj, roi=[dict(roi, curve=[dict([(k, v) for (k, v) in curve.items() if k != 'points'])
+                                            for curve in roi['curve']]) for roi in yobj['roi']])
+
+def _setROICurvePoints(yobj, filename=''):
+    for roi in yobj['roi']:
+        _setROIPoints(roi, roi['points'].reshape(-1), np.diff(roi['curve_offsets'])*3, filename)
+
+# Points of one beam in plan.Trial not fully done yet. Convert to list here
+def _processTrialBeam(beam, blocks):
+    # not read in with a filter
+    if 'CPManager' in beam:
+        if 'CPManagerObject' not in beam['CPManager']:
+            cpmObject = beam['CPManager']
+            cpmCopy = deepcopy(cpmObject)
+            # only the copy gets the points; the original keeps the text
+            blocks.restore(cpmObject)
+            beam['CPManager']['CPManagerObject'] = [ cpmCopy ]
+        cpmObject = beam['CPManager']['CPManagerObject']
+        ncpmObject = len(cpmObject)
+
+        for icpm in range(ncpmObject):
+            cpts = cpmObject[icpm]['ControlPointList']['ControlPoint']
+            ncpts = len(cpts)
+            for icpts in range(ncpts):
+                if 'MLCLeafPositions' in cpts[icpts]:
+                    leafpos = blocks.get(cpts[icpts]['MLCLeafPositions']['RawData']['Points'])
+                    if leafpos is not None:
+                        leafpos = leafpos.tolist()
+                    else:
+                        leafpos = [float(pt) for pt in cpts[icpts]['MLCLeafPositions']['RawData']['Points'].split(',')]
+                    cpts[icpts]['MLCLeafPositions']['RawData']['Points']=leafpos
+                if 'ModifierList' not in cpts[icpts]:
+                    continue  # not read in with a filter
+                # adding in missing part in some plan.Trial
+                if cpts[icpts]['ModifierList'] is None or cpts[icpts]['ModifierList'] == '':
+                    cpts[icpts]['ModifierList'] = {'BeamModifier':[{'Name':'', 'ContourList': None}]}
+                modifier = cpts[icpts]['ModifierList']['BeamModifier']
+                nmodifier = len(modifier)
+                for imodifier in range(nmodifier):
+                    if modifier[imodifier]['ContourList'] is None or modifier[imodifier]['ContourList']=='':
+                        continue # electron cases (or some other cases too?)
+                    curvepainter = modifier[imodifier]['ContourList']['CurvePainter']
+                    ncurvepainter = len(curvepainter)
+                    for icurve in range(ncurvepainter):
+                        if curvepainter[icurve]['Curve']['RawData']['NumberOfPoints'] == '0':
+                            pts = None
+                        else:
+                            pts = blocks.get(curvepainter[icurve]['Curve']['RawData']['Points'])
+                            if pts is not None:
+                                pts = pts.tolist()
+                            else:
+                                pts = [float(pt) for pt in curvepainter[icurve]['Curve']['RawData']['Points'].split(',')]
+                        curvepainter[icurve]['Curve']['RawData']['Points']=pts
+
+    # In some rare cases, SSD, AvgSSD, are not numbers, make them blank to avoid datatype conversion issue
+    if 'SSD' in beam and not beam['SSD'].isnumeric():
+        beam['SSD'] = '0'
+    if 'AvgSSD' in beam and not beam['AvgSSD'].isnumeric():
+        beam['AvgSSD'] = '0'
+
+def _processTrial(trial, blocks):
+    try:
+        beams = trial['BeamList']['Beam']
+    except:
+        print("*** Fatal Error: No beam in trial %s" % trial['Name'])
+        return
+    for beam in beams:
+        _processTrialBeam(beam, blocks)
+
+def _getKeyFilter(ptype, include=None, exclude=None):
+    if ptype == 'plan.Machine':
+        exclude = _MACHINE_EXCLUDE + (exclude if exclude else [])
+    return _PFKeyFilter(include, exclude) if include or exclude else None
+
+# include/exclude are lists of key paths, see _PFKeyFilter. Excluded blocks are
+# skipped without being parsed.
+def readPFile(filename, ptype, outfmt='', include=None, exclude=None):
+    keyfilter = _getKeyFilter(ptype, include, exclude)
+
+    # a filtered read is cached apart from the full one
+    cachetype = ptype
+    if include or exclude:
+        cachetype = '%s include=%s exclude=%s' % (ptype, include, exclude)
+    cache = getCache() if outfmt != 'yaml' else None
+    if cache is not None:
+        # the key is made once, from the bytes that are parsed
+        with open(filename, 'rb') as f:
+            raw = f.read()
+        key = cache.getKey(filename, cachetype, raw)
+        yobj = cache.load(filename, cachetype, key)
+        if yobj is not None:
+            if ptype == 'plan.roi':
+                _setROICurvePoints(yobj, filename)
+            return yobj
+        text = io.TextIOWrapper(io.BytesIO(raw), encoding='latin1')
+    else:
+        text = open(filename, 'r', encoding='latin1')
+    # text = open(filename, 'r', encoding='iso-8859-1', errors='surrogateescape')
+
+    logging.info('reading in %s with type %s done.' % (filename, ptype))
 
+    # yaml text, the way it was built before the native parser. For debugging.
     if outfmt == 'yaml':
+        ystr = _readPFYaml(text, ptype, keyfilter)
+        text.close()
+        logging.info(filename + ' conversion to yaml compatible format done')
         return ystr
-    # print(ystr)
 
+    ################################################
+    # numbers in the big point blocks are decoded in bulk first
+    blocks = _PFNumericBlocks(ptype)
+    if blocks.pattern is not None:
+        data = blocks.extract(text.read())
+        text.close()
+        text = io.StringIO(data)
+        logging.info('%s numeric blocks decoded in %s' % (len(blocks.values), filename))
 
     ################################################
-    # convert to python dict from yaml. All values are string for BaseLoader
-    yobj = yaml.load(ystr, Loader=BaseLoader)
-    # yobj = yaml.load(ystr, Loader=FullLoader)
-    logging.info('yaml loaded as dict, with values all been string.')
+    # convert to python dict. All values are string, as for yaml BaseLoader
+    yobj = _readPFDict(text, ptype, keyfilter)
+    text.close()
+    logging.info('%s parsed as dict, with values all been string.' % filename)
 
     ################################################
     # Points in plan.rio are not fully done. Convert to list here
+    # All points of an ROI go in one (N,3) array, roi['points'], with the first
+    # point of each curve in roi['curve_offsets']. curve['points'] is a flat
+    # [x,y,z,...] view into it.
     if ptype == 'plan.roi' and yobj is not None:
         for iroi in reversed(range(len(yobj['roi']))):
             roi = yobj['roi'][iroi]
             if int(roi['num_curve']) > 0:
+                coords = []
                 for curve in roi['curve']:
-                    pts = [float(pt) for pt in curve['points'][0].split()]
-                    curve['points'] = pts
+                    pts = blocks.get(curve['points'])
+                    if pts is None:
+                        pts = np.array(curve['points'][0].split(), dtype=np.float64)
+                    coords.append(pts)
+                _setROIPoints(roi, np.concatenate(coords), [len(pts) for pts in coords], filename)
             else:
                 yobj['roi'].pop(iroi)
         
@@ -228,59 +816,66 @@ def readPFile(filename, ptype, outfmt=''):
     ################################################
     # Points in plan.Trial not fully done yet. Convert to list here
     if ptype == 'plan.Trial':
-        for itr in range(len(yobj['Trial'])):
-            try:
-                beam = yobj['Trial'][itr]['BeamList']['Beam']
-            except:
-                print("*** Fatal Error: No beam in trial %s" % yobj['Trial'][itr]['Name'])
-                continue
-            nbeams = len(beam)
-            for ibeam in range(nbeams):
-                if 'CPManagerObject' not in beam[ibeam]['CPManager']:
-                    cpmObject = beam[ibeam]['CPManager']
-                    yobj['Trial'][itr]['BeamList']['Beam'][ibeam]['CPManager']['CPManagerObject'] = [ deepcopy(cpmObject) ]
-                cpmObject = beam[ibeam]['CPManager']['CPManagerObject']
-                ncpmObject = len(cpmObject)
-
-                for icpm in range(ncpmObject):
-                    cpts = cpmObject[icpm]['ControlPointList']['ControlPoint']
-                    cpts = cpmObject[icpm]['ControlPointList']['ControlPoint']
-                    ncpts = len(cpts)
-                    for icpts in range(ncpts):
-                        leafpos = [float(pt) for pt in cpts[icpts]['MLCLeafPositions']['RawData']['Points'].split(',')]
-                        cpts[icpts]['MLCLeafPositions']['RawData']['Points']=leafpos
-                        # adding in missing part in some plan.Trial
-                        if cpts[icpts]['ModifierList'] is None or cpts[icpts]['ModifierList'] == '':                        
-                            cpts[icpts]['ModifierList'] = {'BeamModifier':[{'Name':'', 'ContourList': None}]}
-                        modifier = cpts[icpts]['ModifierList']['BeamModifier']
-                        nmodifier = len(modifier)
-                        for imodifier in range(nmodifier):
-                            if modifier[imodifier]['ContourList'] is None or modifier[imodifier]['ContourList']=='':
-                                continue # electron cases (or some other cases too?)
-                            # print('modifier %s --> %s' % (imodifier, modifier[imodifier]))
-                            # print('contourlist --> %s' % modifier[imodifier]['ContourList'])
-                            # print('curvepainter--> %s' % modifier[imodifier]['ContourList']['CurvePainter'])
-                            curvepainter = modifier[imodifier]['ContourList']['CurvePainter']
-                            ncurvepainter = len(curvepainter)
-                            for icurve in range(ncurvepainter):
-                                if curvepainter[icurve]['Curve']['RawData']['NumberOfPoints'] == '0':
-                                    pts = None
-                                else:
-                                    pts = [float(pt) for pt in curvepainter[icurve]['Curve']['RawData']['Points'].split(',')]
-                                curvepainter[icurve]['Curve']['RawData']['Points']=pts
-            logging.info('post-processing dict for Points in plan.Trial done')
-
-        # In some rare cases, SSD, AvgSSD, are not numbers, make them blank to avoid datatype conversion issue
-            beams = yobj['Trial'][itr]['BeamList']['Beam']
-            for bm in beams:
-                if not bm['SSD'].isnumeric():
-                    bm['SSD'] = '0'
-                if not bm['AvgSSD'].isnumeric():
-                    bm['AvgSSD'] = '0'
+        for trial in yobj['Trial']:
+            _processTrial(trial, blocks)
+        logging.info('post-processing dict for Points in plan.Trial done')
+
+    # blocks the post-processing above did not use go back to text
+    if len(blocks.used) < len(blocks.values):
+        blocks.restore(yobj)
+
+    if cache is not None:
+        cache.store(filename, cachetype, _dropROICurvePoints(yobj) if ptype == 'plan.roi' else yobj, key)
 
     # outfmt == 'dict'
     return yobj
 
+# Stream the blocks at path, e.g. 'Trial' or 'Trial/BeamList/Beam', one dict at
+# a time. The file is read line by line and only the lines of the current block
+# are held, so memory is bounded by the largest block, not the file. Yields
+# (indices, dict), with the position of the block among same-named siblings at
+# each level of path, e.g. (itrial, 0, ibeam).
+# Blocks are parsed as in readPFile, but without the bulk decoding of numbers
+# and without the cache. Trial and Beam blocks of plan.Trial get the same
+# post-processing as in readPFile. With where given, only the blocks whose
+# indices where(indices) is true for are parsed.
+def iterPFBlocks(filename, ptype, path, include=None, exclude=None, where=None):
+    parts = path.split('/')
+    keyfilter = _getKeyFilter(ptype, include, exclude)
+    blocks = _PFNumericBlocks(None)  # no references, points come from the text
+
+    names = []      # names of the open blocks, '#N' for list items
+    indices = []    # position of each open block among its siblings
+    counts = [{}]   # children seen so far in each open block
+    block = None    # tokens of the block being collected
+    with open(filename, 'r', encoding='latin1') as text:
+        for token in _iterPFTokens(text, keyfilter):
+            if block is not None:
+                block.append(token)
+            if token[0] == '{':
+                key = token[1]
+                n = counts[-1].get(key, 0)
+                counts[-1][key] = n+1
+                names.append(key)
+                indices.append(n)
+                counts.append({})
+                if block is None and names == parts and (where is None or where(tuple(indices))):
+                    block = [token]
+            elif token[0] == '}' and len(names) > 0:
+                if block is not None and len(names) == len(parts):
+                    obj = _buildPFDict(block, ptype)[parts[-1]]
+                    if isinstance(obj, list):
+                        obj = obj[0]
+                    if ptype == 'plan.Trial' and parts[-1] == 'Trial' and 'BeamList' in obj:
+                        _processTrial(obj, blocks)
+                    elif ptype == 'plan.Trial' and parts[-1] == 'Beam':
+                        _processTrialBeam(obj, blocks)
+                    yield (tuple(indices), obj)
+                    block = None
+                names.pop()
+                indices.pop()
+                counts.pop()
+
 if __name__ == '__main__':
     prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
 
@@ -1,7 +1,8 @@
 import os
 import pytest
+import shutil
 import logging
-from pftools.PFBackup import PFBackup
+from pftools.PFBackup import PFBackup, PFBackupError
 
 prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
 FORMAT = "[%(asctime)s %(levelname)s - %(funcName)s] %(message)s"
@@ -32,3 +33,33 @@ def test1_PFBackup():
         'Direct Electron',
         1
     )
+
+def test2_PFBackup_lazy():
+    backup = PFBackup(prjpath+'examples/Patient_6204')
+    before = (len(backup.ImageSet[0]._loaded), len(backup.Plan[0]._loaded), len(backup.Plan[1]._loaded))
+    trial = backup.Plan[1].PlanTrial
+    after = (sorted(backup.Plan[1]._loaded), len(backup.Plan[0]._loaded), backup.Plan[1].PlanTrial is trial)
+    backup.preload()
+    assert(before, after, [len(imgset._loaded) for imgset in backup.ImageSet], [len(pplan._loaded) for pplan in backup.Plan]) == (
+        (0, 0, 0), (['PlanTrial'], 0, True), [2], [5, 5])
+
+def test3_PFBackup_workers(tmp_path):
+    serial = PFBackup(prjpath+'examples/Patient_6204')
+    serial.preload()
+    parallel = PFBackup(prjpath+'examples/Patient_6204')
+    parallel.preload(workers=2)
+    same = [serial.Plan[i].PlanTrial == parallel.Plan[i].PlanTrial and
+            serial.Plan[i].PlanROI == parallel.Plan[i].PlanROI and
+            serial.Plan[i].PlanPoints == parallel.Plan[i].PlanPoints for i in range(2)]
+
+    # a missing file is reported, the others are still read
+    ptpath = str(tmp_path / 'Patient_6204')
+    shutil.copytree(prjpath+'examples/Patient_6204', ptpath)
+    os.remove(ptpath+'/Plan_1/plan.Points')
+    broken = PFBackup(ptpath)
+    with pytest.raises(PFBackupError) as e:
+        broken.preload(workers=2)
+    assert(same, list(e.value.errors), type(e.value.errors[ptpath+'/Plan_1/plan.Points']).__name__,
+           sorted(broken.Plan[1]._loaded), len(broken.Plan[0]._loaded)) == (
+           [True, True], [ptpath+'/Plan_1/plan.Points'], 'FileNotFoundError',
+           ['PlanInfo', 'PlanPatientSetup', 'PlanROI', 'PlanTrial'], 5)
@@ -0,0 +1,54 @@
+import os
+import pytest
+import numpy as np
+from pftools.readPFile import readPFile
+from pftools.PFCache import enableCache, disableCache, CACHE_SUFFIX
+from pftools.PFModel import _isEqual
+
+prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+
+def test0_PFCache_roundtrip(tmp_path):
+    roifile   = prjpath+'examples/Patient_6204/Plan_0/plan.roi'
+    trialfile = prjpath+'examples/Patient_6204/Plan_0/plan.Trial'
+    ROIList    = readPFile(roifile, 'plan.roi')
+    PlanTrial  = readPFile(trialfile, 'plan.Trial')
+    try:
+        cache = enableCache(str(tmp_path))
+        cold = [readPFile(roifile, 'plan.roi'), readPFile(trialfile, 'plan.Trial')]
+        warm = [readPFile(roifile, 'plan.roi'), readPFile(trialfile, 'plan.Trial')]
+        # same file, different ptype, is a separate entry
+        readPFile(trialfile, 'plan.PlanInfo')
+        nentries = len([f for f in os.listdir(tmp_path) if f.endswith(CACHE_SUFFIX)])
+    finally:
+        disableCache()
+    assert(_isEqual(cold, [ROIList, PlanTrial]), _isEqual(warm, [ROIList, PlanTrial]),
+           cache.misses, cache.hits, nentries) == (True, True, 3, 2, 3)
+
+def test1_PFCache_evict(tmp_path):
+    files = ['Patient', 'Plan_0/plan.Points', 'Plan_0/plan.roi']
+    try:
+        cache = enableCache(str(tmp_path), maxsize=1)
+        for f in files:
+            readPFile(prjpath+'examples/Patient_6204/'+f, f.split('/')[-1])
+        nleft = len(os.listdir(tmp_path))
+        cache.maxsize = 1 << 30
+        readPFile(prjpath+'examples/Patient_6204/Patient', 'Patient')
+        cache.clear()
+        ncleared = len(os.listdir(tmp_path))
+    finally:
+        disableCache()
+    assert(nleft, ncleared) == (0, 0)
+
+def test2_PFCache_roi_arrays(tmp_path):
+    roifile = prjpath+'examples/Patient_6204/Plan_0/plan.roi'
+    try:
+        cache = enableCache(str(tmp_path))
+        cold = readPFile(roifile, 'plan.roi')
+        warm = readPFile(roifile, 'plan.roi')
+    finally:
+        disableCache()
+    # a hit gives the same layout as a miss: writable points, curves as views into them
+    rois = [cold['roi'][0], warm['roi'][0]]
+    assert(cache.hits, [roi['points'].flags.writeable for roi in rois],
+           [all([np.shares_memory(curve['points'], roi['points']) for curve in roi['curve']]) for roi in rois],
+           _isEqual(cold, warm)) == (1, [True, True], [True, True], True)
@@ -0,0 +1,384 @@
+import os
+import re
+import shutil
+import builtins
+import pytest
+import logging
+import numpy as np
+import pydicom
+from pftools.PFDicom import PFDicom
+
+prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+FORMAT = "[%(asctime)s %(levelname)s - %(funcName)s] %(message)s"
+logging.basicConfig(format=FORMAT, filename=prjpath+'logs/pytest.log', level=logging.WARNING)
+
+def _readRD(outpath):
+    rdfiles = sorted(f for f in os.listdir(outpath) if f.startswith('RD_'))
+    return [pydicom.dcmread(os.path.join(outpath, f)) for f in rdfiles]
+
+def test0_PFDicom_RD(tmp_path):
+    pfDicom = PFDicom(prjpath+'examples/Patient_4604', str(tmp_path)+'/')
+    pfDicom.createDicomRD(1)
+    [ds] = _readRD(tmp_path)
+
+    # expected pixels from the per-beam dose files
+    trial = pfDicom.PlanTrial.Trial[0]
+    shape = (trial.DoseGridDimensionZ, trial.DoseGridDimensionY, trial.DoseGridDimensionX)
+    totaldose = np.zeros(shape, dtype=float)
+    for beam in trial.BeamList.Beam:
+        totaldose += pfDicom._getBeamDosePerFrac(beam, shape=shape) * float(beam.Prescription.NumberOfFractions)
+    expected = (totaldose / 1.0e-6).astype(np.uint32)
+
+    pixels = np.frombuffer(ds.PixelData, dtype='<u4').reshape(shape)
+    assert(ds.NumberOfFrames,
+            ds.Rows,
+            ds.Columns,
+            ds.BitsAllocated,
+            np.array_equal(pixels, expected)
+        ) == (
+            shape[0],
+            shape[1],
+            shape[2],
+            32,
+            True
+        )
+
+def test1_PFDicom_DosePixels(tmp_path):
+    pfDicom = PFDicom(prjpath+'examples/Patient_4604', str(tmp_path)+'/')
+    dose = np.array([[[0.9, 7.2], [65535.7, 3.0]], [[12.0, 1.5], [2.0, 8.0]]])
+    [pixels, vmin, vmax] = pfDicom._getDosePixels(dose, 16)
+    assert(pixels.dtype,
+            pixels.ravel().tolist(),
+            vmin,
+            vmax
+        ) == (
+            np.dtype('<u2'),
+            [0, 7, 65535, 3, 12, 1, 2, 8],
+            0,
+            65535
+        )
+
+# names of the files opened while the test runs
+def _recordOpens(monkeypatch):
+    opened = []
+    _open = builtins.open
+    def _recordingOpen(file, *args, **kwargs):
+        opened.append(os.path.basename(str(file)))
+        return _open(file, *args, **kwargs)
+    monkeypatch.setattr(builtins, 'open', _recordingOpen)
+    return opened
+
+# plan.Trial is read once without the control points and once more by RP for
+# the control points of all trials
+def test2_PFDicom_PlanSession(tmp_path, monkeypatch):
+    opened = _recordOpens(monkeypatch)
+    pfDicom = PFDicom(prjpath+'examples/Patient_4604', str(tmp_path)+'/')
+    pfDicom.createDicomRS(0)
+    pfDicom.createDicomRD(0)
+    pfDicom.createDicomRP(0)
+    pfDicom.createDicomRD(0)
+    counts = pfDicom.getPlanSession(0).LoadCounts
+    assert(sorted(counts.keys()), {k: v for (k, v) in counts.items() if v != 1},
+           opened.count('plan.Trial'), len(pfDicom.PlanTrial.Trial)) == (
+        ['ImageSet_0.ImageInfo', 'ImageSet_0.ImageSet', 'ImageSet_0.header',
+         'Plan_0/plan.PatientSetup', 'Plan_0/plan.Pinnacle.Machines', 'Plan_0/plan.PlanInfo',
+         'Plan_0/plan.Points', 'Plan_0/plan.Trial', 'Plan_0/plan.roi'],
+        {'Plan_0/plan.Trial': 2}, 2, 1)
+
+# Two trials in plan.Trial: still one pass for the control points, and each RP
+# gets the beams of its own trial
+def test2_PFDicom_PlanSession_trials(tmp_path, monkeypatch):
+    ptpath = str(tmp_path)+'/Patient_4604'
+    shutil.copytree(prjpath+'examples/Patient_4604', ptpath)
+    with open(ptpath+'/Plan_0/plan.Trial', 'r', encoding='latin1') as f:
+        trial = f.read()
+    second = trial.replace('Trial ={\n  Name = "Rt Breast";', 'Trial ={\n  Name = "Rt Breast 2";', 1)
+    with open(ptpath+'/Plan_0/plan.Trial', 'w', encoding='latin1') as f:
+        f.write(trial + second)
+    outpath = str(tmp_path)+'/out'
+    os.mkdir(outpath)
+
+    opened = _recordOpens(monkeypatch)
+    pfDicom = PFDicom(ptpath, outpath+'/')
+    pfDicom.createDicomRP(0)
+    rps = [pydicom.dcmread(os.path.join(outpath, f)) for f in sorted(os.listdir(outpath))]
+    beams = [[bm.BeamName for bm in rp.BeamSequence] for rp in rps]
+    assert(pfDicom.getPlanSession(0).LoadCounts['Plan_0/plan.Trial'], opened.count('plan.Trial'),
+           [rp.RTPlanName for rp in rps], len(beams[0]), beams[0] == beams[1]) == (
+           2, 2, ['RT BREAST Rt Breast', 'RT BREAST Rt Breast 2'], 4, True)
+
+# Patient_4604 with a small synthetic ImageSet_0.img (121 slices of 16x16)
+def _makeSyntheticCT(tmp_path, nx=16, ny=16):
+    ptpath = str(tmp_path)+'/Patient_4604'
+    shutil.copytree(prjpath+'examples/Patient_4604', ptpath)
+    with open(ptpath+'/ImageSet_0.header', 'r', encoding='latin1') as f:
+        header = f.read()
+    header = re.sub(r'\bx_dim = \d+;', 'x_dim = %s;' % nx, header)
+    header = re.sub(r'\by_dim = \d+;', 'y_dim = %s;' % ny, header)
+    with open(ptpath+'/ImageSet_0.header', 'w', encoding='latin1') as f:
+        f.write(header)
+    data = np.random.default_rng(0).integers(0, 3000, size=(121, ny, nx), dtype=np.int16)
+    data.tofile(ptpath+'/ImageSet_0.img')
+    return (ptpath, data)
+
+def _readCT(outpath):
+    ctfiles = sorted(f for f in os.listdir(outpath) if f.startswith('CT_'))
+    return [pydicom.dcmread(os.path.join(outpath, f)) for f in ctfiles]
+
+def test3_PFDicom_CT(tmp_path):
+    (ptpath, data) = _makeSyntheticCT(tmp_path)
+    outpath = str(tmp_path)+'/out/'
+    pfDicom = PFDicom(ptpath, outpath)
+    pfDicom.createDicomCT(0)
+    cts = _readCT(outpath)
+    assert(len(cts),
+           isinstance(pfDicom.ImageSlices.Data, np.memmap),
+           all(np.array_equal(ds.pixel_array, data[i] - 1000) for (i, ds) in enumerate(cts)),
+           cts[5].SmallestImagePixelValue, cts[5].LargestImagePixelValue
+        ) == (
+            121, True, True, int(data[5].min()) - 1000, int(data[5].max()) - 1000
+        )
+
+def test4_PFDicom_CTTemplate(tmp_path):
+    (ptpath, data) = _makeSyntheticCT(tmp_path)
+    pfDicom = PFDicom(ptpath, str(tmp_path)+'/out/')
+    pfDicom._initializeForDicom('CT', 0)
+    pfDicom._generateUIDs()
+    template = pfDicom._getCTTemplate()
+    ds0 = pfDicom._getCTSlice(template, 0)
+    ds1 = pfDicom._getCTSlice(template, 1)
+    assert('PixelData' in template[0], 'SOPInstanceUID' in template[0],
+           ds0.SOPInstanceUID == ds1.SOPInstanceUID,
+           ds0.file_meta.MediaStorageSOPInstanceUID, ds1.SliceLocation, ds1.Modality
+        ) == (
+            False, False, False, pfDicom.CTSOPInstanceUID[0],
+            -10.0*pfDicom.ImageInfo[1].TablePosition, 'CT'
+        )
+
+def test5_PFDicom_CTWorkers(tmp_path):
+    (ptpath, data) = _makeSyntheticCT(tmp_path)
+    PFDicom(ptpath, str(tmp_path)+'/serial/').createDicomCT(0)
+    PFDicom(ptpath, str(tmp_path)+'/pool/').createDicomCT(0, workers=3)
+    serial = sorted(os.listdir(str(tmp_path)+'/serial/'))
+    pool = sorted(os.listdir(str(tmp_path)+'/pool/'))
+    cts = _readCT(str(tmp_path)+'/pool/')
+    assert(pool == serial, len(pool),
+           all(np.array_equal(ds.pixel_array, data[i] - 1000) for (i, ds) in enumerate(cts))
+        ) == (True, 121, True)
+
+def test6_PFDicom_CTSliceFiles(tmp_path):
+    # Patient_6204 keeps its CT as ImageSet_0.DICOM/837.<SliceNumber>.img
+    pfDicom = PFDicom(prjpath+'examples/Patient_6204', str(tmp_path)+'/')
+    pfDicom.createDicomCT(0)
+    cts = _readCT(tmp_path)
+    slicedir = prjpath+'examples/Patient_6204/ImageSet_0.DICOM/'
+    same = []
+    for i in [0, 1, 50, 97]:
+        src = pydicom.dcmread(slicedir+'837.%s.img' % pfDicom.ImageInfo[i].SliceNumber)
+        same.append(np.array_equal(cts[i].pixel_array, src.pixel_array))
+    assert(len(cts), type(pfDicom.ImageSlices).__name__, same) == \
+        (98, 'PFDirSliceSource', [True, True, True, True])
+
+def test7_PFDicom_ClosestImage(tmp_path):
+    def linearScan(pfDicom, z):
+        for img_info in pfDicom.ImageInfo:
+            if abs(z - img_info.TablePosition) < pfDicom.ImgSetHeader.z_pixdim/2.0:
+                return pfDicom.CTSOPInstanceUID[img_info.SliceNumber-1]
+        return 'NO_CLOSEST_CT_IMAGE_LOCATED'
+
+    same = []
+    for patient in ['Patient_4604', 'Patient_6204']:
+        pfDicom = PFDicom(prjpath+'examples/'+patient, str(tmp_path)+'/')
+        pfDicom._initializeForDicom('RS', 0)
+        pfDicom._generateUIDs()
+        tol = pfDicom.ImgSetHeader.z_pixdim/2.0
+        zs = [curve.points[2] for roi in pfDicom.PlanROI.roi for curve in roi.curve]
+        for img_info in pfDicom.ImageInfo[:5] + pfDicom.ImageInfo[-5:]:
+            tp = img_info.TablePosition
+            zs += [tp, tp - tol, tp + tol, np.nextafter(tp - tol, tp), np.nextafter(tp + tol, tp)]
+        zs += [-1000.0, 1000.0]
+        same.append(pfDicom._getClosestImageInstanceUIDs(zs) == [linearScan(pfDicom, z) for z in zs])
+    assert(same) == ([True, True])
+
+def test8_PFDicom_transCoord(tmp_path):
+    pfDicom = PFDicom(prjpath+'examples/Patient_6204', str(tmp_path)+'/')
+    pfDicom._initializeForDicom('RS', 0)
+    def scalarTrans(clist, out_unit):
+        trans = []
+        for i in range(len(clist)):
+            xyz = [clist[i], -(clist[i] - pfDicom.Yshift), -clist[i]][i%3]
+            trans.append('%6.2f' % (xyz*10.0) if out_unit == 'mm' else '%6.1f' % xyz)
+        return trans
+    pts = (np.random.default_rng(0).standard_normal(3000)*20).tolist()
+    pts[:6] = [0.0, -0.0, 0.0025, -0.0025, 0.125, -0.125]
+    ds = pydicom.Dataset()
+    ds[0x30060050] = pfDicom._getContourDataElement(pts)
+    ds.file_meta = pydicom.dataset.FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.save_as(str(tmp_path)+'/contour.dcm', write_like_original=True)
+    contour = pydicom.dcmread(str(tmp_path)+'/contour.dcm', force=True).ContourData
+    assert(pfDicom.transCoord(pts, 'mm') == scalarTrans(pts, 'mm'),
+           pfDicom.transCoord(pts, 'cm') == scalarTrans(pts, 'cm'),
+           pfDicom.transCoord(np.reshape(pts, (-1, 3)), 'mm') == scalarTrans(pts, 'mm'),
+           pfDicom.transCoord(pts[:4]) == scalarTrans(pts[:4], 'cm'),
+           [str(v) for v in contour] == [v.strip() for v in scalarTrans(pts, 'mm')]
+        ) == (True, True, True, True, True)
+
+def test9_PFDicom_DoseCache(tmp_path):
+    pfDicom = PFDicom(prjpath+'examples/Patient_4604', str(tmp_path)+'/')
+    pfDicom.createDicomRD(0)
+    pfDicom.createDicomRD(0)
+    nbeams = sum([len(trial.BeamList.Beam) for trial in pfDicom.PlanTrial.Trial])
+    cache = pfDicom.getPlanSession(0).DoseCache
+    assert(cache.misses, cache.hits) == (nbeams, nbeams)
+
+def test10_PFDicom_RDWorkers(tmp_path):
+    pfDicom = PFDicom(prjpath+'examples/Patient_4604', str(tmp_path)+'/')
+    doses = [np.random.default_rng(i).random((9, 5, 4)).astype(np.float32) for i in range(7)]
+    weights = [3.0, 25.0, 1.0, 0.3, 7.0, 2.0, 11.0]
+    serial = pfDicom._sumBeamDoses(doses, weights, (9, 5, 4))
+    parallel = pfDicom._sumBeamDoses(doses, weights, (9, 5, 4), workers=3)
+
+    pfDicom.createDicomRD(1)
+    [ds_serial] = _readRD(tmp_path)
+    os.remove(ds_serial.filename)
+    pfDicom.createDicomRD(1, workers=3)
+    [ds_parallel] = _readRD(tmp_path)
+    assert(serial.tobytes() == parallel.tobytes(), ds_serial.PixelData == ds_parallel.PixelData) == (True, True)
+
+def test11_PFDicom_RDBeams(tmp_path):
+    pfDicom = PFDicom(prjpath+'examples/Patient_4604', str(tmp_path)+'/')
+    pfDicom.createDicomRD(0, summation='BEAM')
+    rds = _readRD(tmp_path)
+    trial = pfDicom.PlanTrial.Trial[0]
+    shape = (trial.DoseGridDimensionZ, trial.DoseGridDimensionY, trial.DoseGridDimensionX)
+    expected = [((pfDicom._getBeamDosePerFrac(beam, shape=shape) * float(beam.Prescription.NumberOfFractions)
+                 ).astype(float) / 1.0e-6).astype(np.uint32) for beam in trial.BeamList.Beam]
+    refs = [ds.ReferencedRTPlanSequence[0].ReferencedFractionGroupSequence[0] for ds in rds]
+
+    for ds in rds:
+        os.remove(ds.filename)
+    pfDicom.createDicomRD(0, workers=3, summation='BEAM')
+    parallel = _readRD(tmp_path)
+    assert(len(rds), set(ds.DoseSummationType for ds in rds), len(set(ds.SOPInstanceUID for ds in rds)),
+           [ref.ReferencedBeamSequence[0].ReferencedBeamNumber for ref in refs],
+           [np.array_equal(np.frombuffer(ds.PixelData, dtype='<u4').reshape(shape), dose)
+            for (ds, dose) in zip(rds, expected)],
+           [ds.PixelData == dsp.PixelData for (ds, dsp) in zip(rds, parallel)]) == (
+           4, {'BEAM'}, 4, [1, 2, 3, 4], [True]*4, [True]*4)
+
+def test12_PFDicom_RDBeamsSum(tmp_path):
+    # a single beam trial: the beam RD has the pixels of the trial RD
+    pfDicom = PFDicom(prjpath+'examples/Patient_4604', str(tmp_path)+'/')
+    pfDicom.createDicomRD(1)
+    pfDicom.createDicomRD(1, summation='BEAM')
+    [ds_beam, ds_plan] = sorted(_readRD(tmp_path), key=lambda ds: ds.DoseSummationType)
+    with pytest.raises(ValueError):
+        pfDicom.createDicomRD(1, summation='FRACTION')
+    assert(ds_plan.DoseSummationType, ds_beam.PixelData == ds_plan.PixelData,
+           ds_beam.NumberOfFrames, ds_beam.DoseGridScaling) == (
+           'PLAN', True, ds_plan.NumberOfFrames, ds_plan.DoseGridScaling)
+
+def test13_PFDicom_RDCrop(tmp_path):
+    pfDicom = PFDicom(prjpath+'examples/Patient_4604', str(tmp_path)+'/')
+    pfDicom.createDicomRD(1)
+    [ds_full] = _readRD(tmp_path)
+    os.remove(ds_full.filename)
+    pfDicom.createDicomRD(1, crop=0.01)
+    [ds] = _readRD(tmp_path)
+
+    full = np.frombuffer(ds_full.PixelData, dtype='<u4').reshape(
+        ds_full.NumberOfFrames, ds_full.Rows, ds_full.Columns)
+    (k0, r0, c0, nz, ny, nx) = pfDicom._getDoseBoundingBox(full, 0.01)
+    outside = full.copy()
+    outside[k0:k0+nz, r0:r0+ny, c0:c0+nx] = 0
+    (dx, dy) = [float(v) for v in ds_full.PixelSpacing]
+    dz = -float(ds_full.GridFrameOffsetVector[1])
+    position = np.array(ds_full.ImagePositionPatient, dtype=float) + [c0*dx, r0*dy, -k0*dz]
+    assert((ds.NumberOfFrames, ds.Rows, ds.Columns) == (nz, ny, nx), nz*ny*nx < full.size,
+           np.array_equal(np.frombuffer(ds.PixelData, dtype='<u4').reshape(nz, ny, nx),
+                          full[k0:k0+nz, r0:r0+ny, c0:c0+nx]),
+           int(outside.max()) <= 0.01*int(full.max()),
+           np.allclose(np.array(ds.ImagePositionPatient, dtype=float), position, atol=0.011),
+           len(ds.GridFrameOffsetVector)) == (
+           True, True, True, True, True, nz)
+
+def test14_PFDicom_RDBits(tmp_path):
+    pfDicom = PFDicom(prjpath+'examples/Patient_4604', str(tmp_path)+'/')
+    pfDicom.createDicomRD(1)
+    [ds32] = _readRD(tmp_path)
+    os.remove(ds32.filename)
+    pfDicom.createDicomRD(1, bits=16)
+    [ds16] = _readRD(tmp_path)
+    # rejected before any dose is read, no RD is written
+    with pytest.raises(ValueError):
+        pfDicom.createDicomRD(1, bits=8)
+    nrd = len(_readRD(tmp_path))
+    dose32 = ds32.pixel_array * float(ds32.DoseGridScaling)
+    dose16 = ds16.pixel_array * float(ds16.DoseGridScaling)
+
+    # 50 Gy fits into 65535 steps of 1 mGy, 80 Gy does not
+    dose = np.zeros((1, 1, 2))
+    choice = []
+    for dmax in [50.0, 80.0]:
+        dose[0, 0, 1] = dmax
+        pfDicom._setDosePixelFormat(ds32, dose, bits=None)
+        choice.append(ds32.BitsAllocated)
+    assert(ds16.BitsAllocated, ds16.HighBit, ds16.pixel_array.dtype, int(ds16.pixel_array.max()) <= 65535,
+           float(np.abs(dose16 - dose32).max()) <= float(ds16.DoseGridScaling), choice, nrd) == (
+           16, 15, np.uint16, True, True, [16, 32], 1)
+
+def _getRDSize(outpath):
+    return sum(os.path.getsize(os.path.join(outpath, f)) for f in os.listdir(outpath) if f.startswith('RD_'))
+
+@pytest.mark.parametrize('syntax', ['rle', 'deflated'])
+def test15_PFDicom_TransferSyntax(tmp_path, syntax):
+    (ptpath, data) = _makeSyntheticCT(tmp_path)
+    outpath = str(tmp_path)+'/out/'
+    pfDicom = PFDicom(ptpath, outpath, transfer_syntax=syntax)
+    pfDicom.createDicomCT(0)
+    pfDicom.createDicomRD(0)
+    pfDicom.createDicomRD(0, summation='BEAM')
+    pfDicom.createDicomRS(0)
+    cts = _readCT(outpath)
+    rds = _readRD(outpath)
+    rs = pydicom.dcmread([os.path.join(outpath, f) for f in os.listdir(outpath) if f.startswith('RS_')][0])
+
+    explicit = str(tmp_path)+'/explicit/'
+    PFDicom(ptpath, explicit).createDicomRD(0)
+    PFDicom(ptpath, explicit).createDicomRD(0, summation='BEAM')
+    expected = _readRD(explicit)
+    assert(set(ds.file_meta.TransferSyntaxUID for ds in cts+rds) == {pfDicom.PixelTransferSyntaxUID},
+           rs.file_meta.TransferSyntaxUID,
+           all(np.array_equal(ds.pixel_array, data[i] - 1000) for (i, ds) in enumerate(cts)),
+           [np.array_equal(ds.pixel_array, dse.pixel_array) for (ds, dse) in zip(rds, expected)],
+           _getRDSize(outpath) < _getRDSize(explicit)) == (
+           True, pydicom.uid.ExplicitVRLittleEndian, True, [True]*5, True)
+
+def test16_PFDicom_TransferSyntaxName(tmp_path):
+    with pytest.raises(ValueError):
+        PFDicom(prjpath+'examples/Patient_4604', str(tmp_path)+'/', transfer_syntax='jpeg')
+
+@pytest.mark.parametrize('syntax', ['explicit', 'rle'])
+def test17_PFDicom_EnhancedCT(tmp_path, syntax):
+    (ptpath, data) = _makeSyntheticCT(tmp_path)
+    outpath = str(tmp_path)+'/out/'
+    pfDicom = PFDicom(ptpath, outpath, transfer_syntax=syntax)
+    pfDicom.createDicomCT(0, multiframe=True)
+    [ds] = _readCT(outpath)
+
+    shared = ds.SharedFunctionalGroupsSequence[0]
+    rescale = shared.PixelValueTransformationSequence[0]
+    positions = [frame.PlanePositionSequence[0].ImagePositionPatient for frame in ds.PerFrameFunctionalGroupsSequence]
+    tablepos = np.array([info.TablePosition for info in pfDicom.ImageInfo])
+    # the classic slice 5 for its position
+    classic = pfDicom._getCTSlice(pfDicom._getCTTemplate(), 5)
+    assert(ds.SOPClassUID, ds.NumberOfFrames, len(ds.PerFrameFunctionalGroupsSequence),
+           np.array_equal(ds.pixel_array.astype(int) + int(rescale.RescaleIntercept), data - 1000),
+           np.allclose(np.array(positions, dtype=float)[:, 2], -10.0*tablepos),
+           [float(v) for v in positions[5]] == [float(v) for v in classic.ImagePositionPatient],
+           [frame.FrameContentSequence[0].InStackPositionNumber for frame in ds.PerFrameFunctionalGroupsSequence[:3]],
+           len(ds.DimensionIndexSequence)) == (
+           pydicom.uid.UID('1.2.840.10008.5.1.4.1.1.2.1'), 121, 121, True, True, True, [1, 2, 3], 2)
@@ -0,0 +1,41 @@
+import os
+import pytest
+import numpy as np
+from pydantic import ValidationError
+from pftools.readPFile import readPFile
+from pftools.PFModel import buildModel, enableValidation, disableValidation
+from pftools.PFPlanTrial import PFPlanTrial, _RawData
+from pftools.PFPlanROI import PFPlanROI
+
+prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+
+PlanTrial = readPFile(prjpath+'examples/Patient_4604/Plan_0/plan.Trial', 'plan.Trial')
+ROIList = readPFile(prjpath+'examples/Patient_4604/Plan_0/plan.roi', 'plan.roi')
+
+def test0_PFModel_trusted():
+    fast = buildModel(PFPlanTrial, PlanTrial)
+    valid = buildModel(PFPlanTrial, PlanTrial, validate=True)
+    cp0 = fast.Trial[0].BeamList.Beam[0].CPManager.CPManagerObject[0].ControlPointList.ControlPoint[0]
+    assert(fast == valid, fast.Trial[0].__fields_set__ == valid.Trial[0].__fields_set__,
+           type(fast.Trial[0].DoseGridDimensionX), type(cp0.Gantry), cp0.MLCLeafPositions.RawData.Points.dtype) == (
+           True, True, int, float, np.float64)
+
+def test1_PFModel_roi():
+    fast = buildModel(PFPlanROI, ROIList)
+    valid = buildModel(PFPlanROI, ROIList, validate=True)
+    roi = fast.roi[0]
+    assert(np.array_equal(roi.points, valid.roi[0].points),
+           np.shares_memory(roi.curve[0].points, roi.points),
+           [curve.num_points for curve in roi.curve] == [curve.num_points for curve in valid.roi[0].curve]) == (
+           True, True, True)
+
+def test2_PFModel_fallback():
+    # values the fast path can not convert are left to pydantic
+    with pytest.raises(ValidationError):
+        buildModel(_RawData, {'NumberOfPoints': 'many', 'Points': []})
+    try:
+        enableValidation()
+        raw = buildModel(_RawData, {'NumberOfPoints': '2', 'Points': ['1.5', '2']})
+    finally:
+        disableValidation()
+    assert(raw.NumberOfPoints, raw.Points) == (2, ['1.5', '2'])
@@ -41,4 +41,7 @@ def test0_PFPlanMachine():
             '4e',
             1.0
         )
-        
\ No newline at end of file
+        
+def test1_PFPlanMachine_lightweight():
+    pfMachineLight = readMachine(prjpath+'examples/Patient_6204/', planid=0, lightweight=True)
+    assert(pfMachineLight.dict() == pfMachine.dict())
@@ -1,6 +1,7 @@
 import os
 import pytest
 import logging
+import numpy as np
 from pftools.PFPlanROI import PFPlanROI, readPlanROI
 # from pftools.readPFile import readPFile
 
@@ -43,3 +44,31 @@ def test1_PFPlanROI():
             49,
             -67.9697
         )
+
+def test2_PFPlanROI_points():
+    roi = pfPlanRoi_0.roi[0]
+    ncurve = len(roi.curve)
+    # the same ROI from plain point lists
+    roi_lists = PFPlanROI(roi=[{'name': roi.name, 'num_curve': roi.num_curve,
+        'curve': [{'num_points': c.num_points, 'points': c.points.tolist()} for c in roi.curve]}]).roi[0]
+    assert(roi.points.shape,
+           len(roi.curve_offsets) == ncurve + 1,
+           all(np.shares_memory(c.points, roi.points) for c in roi.curve),
+           all(len(c.points) == 3*c.num_points for c in roi.curve),
+           roi.getCurveZ()[0] == roi.curve[0].points[2],
+           np.array_equal(roi_lists.points, roi.points),
+           np.array_equal(roi_lists.curve_offsets, roi.curve_offsets)
+        ) == (
+            (int(roi.curve_offsets[-1]), 3), True, True, True, True, True, True
+        )
+
+def test3_PFPlanROI_eq_json():
+    import json
+    from pftools.PFPlanROI import _Curve
+    again = readPlanROI(prjpath+'examples/Patient_6204/', planid=0)
+    changed = again.copy(deep=True)
+    changed.roi[0].points[0, 0] += 1
+    roi = json.loads(pfPlanRoi_0.json())['roi'][0]
+    assert(again == pfPlanRoi_0, changed == pfPlanRoi_0, pfPlanRoi_0.roi[0] == pfPlanRoi_0.roi[1],
+           roi['points'][0] == pfPlanRoi_0.roi[0].points[0].tolist(), _Curve().points) == (
+           True, False, False, True, [])
@@ -1,7 +1,8 @@
 import os
 import pytest
 import logging
-from pftools.PFPlanTrial import PFPlanTrial, readPlanTrial
+import numpy as np
+from pftools.PFPlanTrial import PFPlanTrial, _ControlPoint, readPlanTrial, iterTrials, iterBeams
 # from pftools.readPFile import readPFile
 
 prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
@@ -124,3 +125,66 @@ def test1_PFPlanTrial_BM():
         None
     )
 
+
+def test2_PFPlanTrial_lightweight():
+    trialLight = readPlanTrial(prjpath+'examples/Patient_6204/', planid=0, lightweight=True)
+    full = pfPlanTrial_0.dict()
+    for trial in full['Trial']:
+        for beam in trial['BeamList']['Beam']:
+            beam['CPManager'] = None
+    assert(trialLight.Trial[0].BeamList.Beam[0].CPManager, trialLight.dict() == full) == (None, True)
+
+def test3_PFPlanTrial_stream():
+    pfpath = prjpath+'examples/Patient_6204/'
+    trials = list(iterTrials(pfpath, 0))
+    beams = list(iterBeams(pfpath, 0))
+    full = pfPlanTrial_0.Trial
+    assert(len(trials), trials[0] == full[0].copy(update={'BeamList': None}),
+           [(itrial, beam.BeamIndex) for (itrial, beam) in beams],
+           all([beam == full[itrial].BeamList.Beam[beam.BeamIndex]
+                for (itrial, beam) in beams]),
+           len(list(iterBeams(pfpath, 0, trialindex=1)))) == (
+           1, True, [(0, 0), (0, 1), (0, 2), (0, 3)], True, 0)
+
+def test4_PFPlanTrial_CP_arrays():
+    cpmgr = pfPlanTrial_0.Trial[0].BeamList.Beam[1].CPManager.CPManagerObject[0]
+    cps = cpmgr.ControlPointList.ControlPoint
+    assert(cpmgr.MLCLeafPositions.shape, cpmgr.Gantry.tolist(), cpmgr.Weight.tolist() == [cp.Weight for cp in cps],
+           cpmgr.LeftJawPosition.tolist() == [cp.LeftJawPosition for cp in cps],
+           cpmgr.MLCLeafPositions[-1].ravel().tolist() == cps[-1].MLCLeafPositions.RawData.Points.tolist(),
+           np.shares_memory(cps[-1].MLCLeafPositions.RawData.Points, cpmgr.MLCLeafPositions)) == (
+           (len(cps), 60, 2), [cp.Gantry for cp in cps], True, True, True, True)
+
+def test5_PFPlanTrial_CP_view():
+    from pydantic import ValidationError
+    from pftools.PFModel import buildModel
+    from pftools.PFPlanTrial import _CPManagerObject
+    cpmgr = pfPlanTrial_0.Trial[0].BeamList.Beam[1].CPManager.CPManagerObject[0]
+    cps = cpmgr.ControlPointList.ControlPoint
+    # the values are read from the columns, not kept in the control points
+    rebuilt = _CPManagerObject(ControlPointList=cpmgr.ControlPointList)
+    cp = cps[-1].dict()
+    cp['Gantry'] = 'not a number'
+    with pytest.raises(ValidationError):
+        buildModel(_CPManagerObject, {'ControlPointList': {'ControlPoint': [cp]}})
+    assert('Gantry' in cps[-1].__dict__, cps[-1].Columns['Gantry'] is cpmgr.Gantry,
+           cps[-1].dict()['Gantry'], rebuilt.Gantry.tolist() == cpmgr.Gantry.tolist(),
+           [cp.Weight for cp in rebuilt.ControlPointList.ControlPoint] == cpmgr.Weight.tolist()) == (
+           False, True, cpmgr.Gantry[-1], True, True)
+
+def test6_PFPlanTrial_CP_values():
+    import json
+    trial = readPlanTrial(prjpath+'examples/Patient_6204/', planid=0)
+    cpmgr = trial.Trial[0].BeamList.Beam[1].CPManager.CPManagerObject[0]
+    cp = cpmgr.ControlPointList.ControlPoint[0]
+    same = trial == pfPlanTrial_0
+    # set through the control point, into the column
+    cp.Gantry = 10
+    cp.Weight = None
+    single = _ControlPoint(Gantry=30, Weight=1)
+    single.Couch = 5
+    assert(same, trial == pfPlanTrial_0, cpmgr.Gantry[0], np.isnan(cpmgr.Weight[0]), cp.Weight,
+           single.Gantry, single.Weight, single.Couch, single.Collimator, _ControlPoint().Gantry,
+           json.loads(cp.json())['Gantry'], json.loads(single.json())['Couch'],
+           json.loads(trial.json())['Trial'][0]['Name']) == (
+           True, False, 10.0, True, None, 30.0, 1.0, 5.0, None, None, 10.0, 5.0, 'sMLC')
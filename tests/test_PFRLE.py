@@ -0,0 +1,36 @@
+import os
+import pytest
+import logging
+import numpy as np
+from pydicom.pixel_data_handlers.rle_handler import _rle_decode_frame
+from pftools.PFRLE import encodeRLEFrame, _packBits
+
+prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+FORMAT = "[%(asctime)s %(levelname)s - %(funcName)s] %(message)s"
+logging.basicConfig(format=FORMAT, filename=prjpath+'logs/pytest.log', level=logging.WARNING)
+
+def _decode(data, frame):
+    dtype = frame.dtype.newbyteorder('<')
+    decoded = _rle_decode_frame(data, frame.shape[0], frame.shape[1], 1, dtype.itemsize*8)
+    return np.frombuffer(decoded, dtype=dtype).reshape(frame.shape)
+
+def test0_PFRLE_packBits():
+    # a run of 130, a literal of 6 taking in a run of 2, then a run of 3 at the row end
+    row = np.array([5]*130 + [1, 2, 3, 9, 9, 4] + [6, 6, 6], dtype=np.uint8)
+    packed = _packBits(np.vstack([row, row]))
+    assert(list(packed[:13]), len(packed)) == (
+        [129, 5, 255, 5, 5, 1, 2, 3, 9, 9, 4, 254, 6], 2*13)
+
+def test1_PFRLE_frames():
+    rng = np.random.default_rng(0)
+    frames = [np.zeros((3, 4), dtype=np.uint8),
+              rng.integers(-1000, 3000, size=(20, 300)).astype(np.int16),
+              np.repeat(rng.integers(0, 2**32, size=(7, 1), dtype=np.uint32), 260, axis=1),
+              rng.integers(0, 3, size=(33, 129)).astype('>u2')]
+    encoded = [encodeRLEFrame(frame) for frame in frames]
+    assert([np.array_equal(_decode(data, frame), frame) for (data, frame) in zip(encoded, frames)],
+           [len(data) % 2 for data in encoded],
+           [int.from_bytes(data[:4], 'little') for data in encoded]) == (
+           [True]*4, [0]*4, [1, 2, 4, 2])
+    with pytest.raises(ValueError):
+        encodeRLEFrame(np.zeros((2, 2, 2), dtype=np.uint8))
@@ -0,0 +1,73 @@
+import os
+import struct
+import pytest
+import logging
+import numpy as np
+from pftools.PFTrialBinary import getTrialBinaryName, readPlanTrialBinary, PFDoseCache, PFTrialBinaryVolume
+
+prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+FORMAT = "[%(asctime)s %(levelname)s - %(funcName)s] %(message)s"
+logging.basicConfig(format=FORMAT, filename=prjpath+'logs/pytest.log', level=logging.WARNING)
+
+# Patient_4604 Plan_0, Trial 'Rt Breast': DoseVolume XDR:4, 81x68x87 grid
+pfpath = prjpath+'examples/Patient_4604/'
+shape = (87, 68, 81)
+beamdose = readPlanTrialBinary(pfpath, planid=0, binid=4, shape=shape)
+beamdose_mmap = readPlanTrialBinary(pfpath, planid=0, binid=4, shape=shape, mmap=True)
+
+def _unpack(ivox):
+    with open(getTrialBinaryName(pfpath, 0, 4), 'rb') as bfile:
+        bfile.seek(4*ivox)
+        return struct.unpack('>f', bfile.read(4))[0]
+
+def test0_PFTrialBinary():
+    ivox = int(np.argmax(beamdose))
+    assert(beamdose.shape,
+            beamdose.dtype,
+            float(beamdose.ravel()[ivox]),
+            float(beamdose[40, 30, 20])
+        ) == (
+            shape,
+            np.float32,
+            _unpack(ivox),
+            _unpack(40*68*81 + 30*81 + 20)
+        )
+
+def test1_PFTrialBinary_mmap():
+    assert(isinstance(beamdose_mmap, PFTrialBinaryVolume),
+            beamdose_mmap.shape,
+            beamdose_mmap.dtype,
+            np.array_equal(beamdose_mmap[40], beamdose[40]),
+            np.array_equal(np.stack([f.copy() for f in beamdose_mmap.iterFrames()]), beamdose),
+            np.array_equal(beamdose_mmap, beamdose)
+        ) == (
+            True,
+            shape,
+            np.float32,
+            True,
+            True,
+            True
+        )
+
+def test2_PFTrialBinary_scale():
+    scaled = readPlanTrialBinary(pfpath, planid=0, binid=4, shape=shape, scale=1.25)
+    assert np.allclose(scaled, beamdose*1.25, rtol=1e-6)
+
+def test3_PFTrialBinary_mismatch():
+    with pytest.raises(ValueError):
+        readPlanTrialBinary(pfpath, planid=0, binid=4, shape=(87, 68, 80))
+
+def test4_PFTrialBinary_cache():
+    fname = getTrialBinaryName(pfpath, 0, 4)
+    cache = PFDoseCache(maxsize=2*beamdose.nbytes)
+    first = cache.getDose(fname, shape, 1.25)
+    again = cache.getDose(fname, shape, 1.25)
+    counts = (cache.hits, cache.misses)
+    # a second scale is another entry; a third one evicts the least recently used
+    cache.getDose(fname, shape, 2.0)
+    cache.getDose(fname, shape, 1.25)
+    cache.getDose(fname, shape, 3.0)
+    cache.getDose(fname, shape, 2.0)
+    assert(counts, (cache.hits, cache.misses), cache.size, again is first,
+           first.flags.writeable, np.array_equal(first, readPlanTrialBinary(pfpath, 0, 4, shape, 1.25))) == (
+           (1, 1), (2, 4), 2*beamdose.nbytes, True, False, True)
@@ -1,7 +1,9 @@
 from logging import lastResort
 import os
+import io
 import pytest
-from pftools.readPFile import readPFile
+from pftools.readPFile import readPFile, _readPFDict, _PFNumericBlocks, _getKeyFilter
+import yaml
 import logging
 
 prjpath = os.path.dirname(os.path.abspath(__file__))+'/../'
@@ -216,7 +218,7 @@ def test1_plantrial0_controlpoint_read():
             '60',
             3.9,
             6.3,
-            '  2. Y : -18.50 cm'
+            '  2. Y = -18.50 cm'
         )
 
 def test1_plantrial1_controlpoint_read():
@@ -247,7 +249,7 @@ def test1_plantrial1_controlpoint_read():
             '60',
             3.0,
             3.0,
-            '  2. Y : -18.50 cm'
+            '  2. Y = -18.50 cm'
         )
 
 def test2_plantrial0_controlpoint_read():
@@ -299,4 +301,80 @@ def test2_plantrial1_controlpoint_read():
             '263.158',
             '3.31767',
             '100'
-        )
\ No newline at end of file
+        )
+# strings as the yaml text had them: the line rewrites hit quoted values too
+def _yamlStrings(obj):
+    if isinstance(obj, dict):
+        return {k: _yamlStrings(v) for (k, v) in obj.items()}
+    if isinstance(obj, list):
+        return [_yamlStrings(v) for v in obj]
+    for (a, b) in [('=', ':'), ('{', ''), ('}', ''), (';', ''), ('#', '_')]:
+        obj = obj.replace(a, b)
+    return obj.strip()
+
+def test3_native_matches_yaml():
+    # the native parser must build the same dict as the yaml round-trip,
+    # but for the rewrites the yaml text made inside quoted strings
+    for (fname, ptype) in [('Plan_0/plan.Trial', 'plan.Trial'),
+                           ('Plan_0/plan.roi', 'plan.roi'),
+                           ('ImageSet_0.ImageInfo', 'ImageSet.ImageInfo'),
+                           ('Plan_0/plan.Pinnacle.Machines', 'plan.Machine')]:
+        fpath = prjpath+'examples/Patient_6204/'+fname
+        with open(fpath, 'r', encoding='latin1') as f:
+            native = _readPFDict(f, ptype, _getKeyFilter(ptype))
+        fromyaml = yaml.load(readPFile(fpath, ptype, 'yaml'), Loader=yaml.BaseLoader)
+        assert(_yamlStrings(native) == _yamlStrings(fromyaml))
+
+def test4_numeric_blocks():
+    text = ('MLCLeafPositions ={\n  RawData ={\n    NumberOfDimensions = 2;\n    NumberOfPoints = 2;\n'
+            '    Points[] ={\n      -4.89678,-10.5667,\n      3,1e-2\n    };\n  };\n};\n'
+            'Data ={\n  Points[] ={\n    1,2\n  };\n};\n'
+            'Curve ={\n  RawData ={\n    Points[] ={\n      1,2, // comment\n    };\n  };\n};\n')
+    blocks = _PFNumericBlocks('plan.Trial')
+    text = blocks.extract(text)
+    # only the MLC block is taken out; other parents and blocks with comments stay
+    assert(len(blocks.values), text.count('Points = @PFBLOCK0;'), text.count('Points[] ={'),
+           blocks.get('@PFBLOCK0').tolist(), blocks.get('1,2')) == (
+           1, 1, 2, [-4.89678, -10.5667, 3.0, 0.01], None)
+
+    # points from the blocks are the same as from the parsed text
+    fpath = prjpath+'examples/Patient_6204/Plan_0/plan.Trial'
+    with open(fpath, 'r', encoding='latin1') as f:
+        parsed = _readPFDict(f, 'plan.Trial')
+    cps = parsed['Trial'][0]['BeamList']['Beam'][0]['CPManager']['CPManagerObject'][0]['ControlPointList']['ControlPoint']
+    cps0 = PlanTrial0['Trial'][0]['BeamList']['Beam'][0]['CPManager']['CPManagerObject'][0]['ControlPointList']['ControlPoint']
+    for (cp, cp0) in zip(cps, cps0):
+        assert(cp0['MLCLeafPositions']['RawData']['Points'] ==
+               [float(pt) for pt in cp['MLCLeafPositions']['RawData']['Points'].split(',')])
+    fpath = prjpath+'examples/Patient_6204/Plan_0/plan.roi'
+    with open(fpath, 'r', encoding='latin1') as f:
+        parsed = _readPFDict(f, 'plan.roi')
+    assert(ROIList['roi'][1]['curve'][1]['points'].tolist() ==
+           [float(pt) for pt in parsed['roi'][1]['curve'][1]['points'][0].split()])
+
+def test5_key_filter():
+    fpath = prjpath+'examples/Patient_6204/Patient'
+    header = readPFile(fpath, 'Patient', exclude=['PlanList', 'ImageSetList', 'ObjectVersion'])
+    assert(header['MedicalRecordNumber'], 'PlanList' in header, 'ImageSetList' in header,
+           'ObjectVersion' in header) == ('00003030', False, False, False)
+
+    fpath = prjpath+'examples/Patient_6204/Plan_0/plan.Trial'
+    names = readPFile(fpath, 'plan.Trial', include=['Trial/Name', 'Trial/BeamList/Beam/Name'])
+    assert(names == {'Trial': [{'Name': 'sMLC', 'BeamList': {'Beam': [{'Name': beam['Name']}
+           for beam in PlanTrial0['Trial'][0]['BeamList']['Beam']]}}]})
+
+    # the same keys at any depth
+    nomlc = readPFile(fpath, 'plan.Trial', exclude=['**/MLCLeafPositions', '**/ModifierList'])
+    cp = nomlc['Trial'][0]['BeamList']['Beam'][0]['CPManager']['CPManagerObject'][0]['ControlPointList']['ControlPoint'][0]
+    cp0 = PlanTrial0['Trial'][0]['BeamList']['Beam'][0]['CPManager']['CPManagerObject'][0]['ControlPointList']['ControlPoint'][0]
+    assert(cp['Gantry'], 'MLCLeafPositions' in cp, 'ModifierList' in cp, 'WedgeContext' in cp) == (
+           cp0['Gantry'], False, False, True)
+
+def test6_quoted_values():
+    text = io.StringIO('Name = "a = b; {c} #1 // d";\n'
+                       'Note = "x /* y */";  // comment\n'
+                       'List ={ Label = "}"; Empty = ""; };\n'
+                       '/* Hidden = 1;\n   Inner ={ */\n'
+                       'date : 2006-03-01\n')
+    assert(_readPFDict(text, 'plan.Trial') == {'Name': 'a = b; {c} #1 // d', 'Note': 'x /* y */',
+           'List': {'Label': '}', 'Empty': ''}, 'date': '20060301'})